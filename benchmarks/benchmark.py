@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`benchmark` -- Load test and latency benchmarks for Flask-PyBankID
+=======================================================================
+
+Runs scripted load scenarios against a Flask app using
+:class:`flask_pybankid.PyBankID` with the JSON backend, pointed at the local
+BankID stand-in in :mod:`mock_bankid`, and reports throughput, latency
+percentiles and memory use per scenario:
+
+.. code-block:: bash
+
+    $ python benchmarks/benchmark.py --latency 0.05 --concurrency 32
+    $ python benchmarks/benchmark.py --scenario collect_storm \\
+          --config PYBANKID_COLLECT_POLLER=true
+
+Extension settings are given with ``--config KEY=VALUE``, values being
+parsed as JSON when possible, so that releases and options can be compared.
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import flask  # noqa: E402
+
+from flask_pybankid import PyBankID  # noqa: E402
+from mock_bankid import MockBankIDServer  # noqa: E402
+
+_now = getattr(time, "perf_counter", time.time)
+
+
+def personal_number():
+    """Random, valid Swedish personal number."""
+    pn = "{0:04d}{1:02d}{2:02d}{3:03d}".format(
+        random.randint(1900, 2014),
+        random.randint(1, 12),
+        random.randint(1, 28),
+        random.randint(0, 999),
+    )
+    digits = [int(d) for d in pn[2:]]
+    checksum = sum(sum(divmod(d * (2 - i % 2), 10)) for i, d in enumerate(digits))
+    return pn + str(-checksum % 10)
+
+
+def make_app(api_url, config=None):
+    app = flask.Flask("benchmark")
+    app.config["PYBANKID_BACKEND"] = "json"
+    app.config["PYBANKID_API_URL"] = api_url
+    app.config["PYBANKID_POOL_SIZE"] = 64
+    app.config.update(config or {})
+    bankid = PyBankID(app)
+    return app, bankid
+
+
+def run_requests(app, requests, concurrency):
+    """Send `requests`, ``(method, path, kwargs)`` tuples, from `concurrency`
+    threads, and return the latencies and the number of failed requests."""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    work = list(reversed(requests))
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                if not work:
+                    return
+                method, path, kwargs = work.pop()
+            start = _now()
+            response = client.open(path, method=method, **kwargs)
+            elapsed = _now() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, errors[0]
+
+
+def auth_burst(app, server, args):
+    """Many concurrent authentication orders."""
+    requests = [
+        ("GET", "/authenticate/" + personal_number(), {}) for _ in range(args.requests)
+    ]
+    return run_requests(app, requests, args.concurrency)
+
+
+def sign_large_document(app, server, args):
+    """Signing orders with a large ``userVisibleData``."""
+    document = "Lorem ipsum dolor sit amet. " * (args.document_size // 28 + 1)
+    document = document[: args.document_size]
+    requests = [
+        (
+            "GET",
+            "/sign/{0}?{1}".format(
+                personal_number(), urlencode({"userVisibleData": document})
+            ),
+            {},
+        )
+        for _ in range(args.requests)
+    ]
+    return run_requests(app, requests, args.concurrency)
+
+
+def collect_storm(app, server, args):
+    """Many watchers polling the same pending orders."""
+    client = app.test_client()
+    order_refs = [
+        json.loads(client.get("/authenticate/" + personal_number()).data)["orderRef"]
+        for _ in range(args.orders)
+    ]
+    server.reset_counts()
+    requests = [
+        ("GET", "/collect/" + order_ref, {})
+        for _ in range(args.requests // max(len(order_refs), 1))
+        for order_ref in order_refs
+    ]
+    return run_requests(app, requests, args.concurrency)
+
+
+SCENARIOS = OrderedDict(
+    [
+        ("auth_burst", auth_burst),
+        ("sign_large_document", sign_large_document),
+        ("collect_storm", collect_storm),
+    ]
+)
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def max_rss_mb():
+    if resource is None:
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes on Linux and in bytes on macOS.
+    return rss / (1024.0 * 1024.0) if sys.platform == "darwin" else rss / 1024.0
+
+
+def run_scenario(name, args, config):
+    server = MockBankIDServer(
+        latency=args.latency,
+        jitter=args.jitter,
+    ).start()
+    try:
+        app, bankid = make_app(server.api_url, config)
+        gc.collect()
+        if args.trace_memory and tracemalloc is not None:
+            tracemalloc.start()
+        start = _now()
+        latencies, errors = SCENARIOS[name](app, server, args)
+        elapsed = _now() - start
+        peak = float("nan")
+        if args.trace_memory and tracemalloc is not None:
+            peak = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+            tracemalloc.stop()
+        return OrderedDict(
+            [
+                ("scenario", name),
+                ("requests", len(latencies)),
+                ("errors", errors),
+                ("throughput_rps", len(latencies) / elapsed if elapsed else 0.0),
+                ("p50_ms", percentile(latencies, 50) * 1000),
+                ("p95_ms", percentile(latencies, 95) * 1000),
+                ("p99_ms", percentile(latencies, 99) * 1000),
+                ("upstream_calls", sum(server.calls.values())),
+                ("traced_peak_mb", peak),
+                ("max_rss_mb", max_rss_mb()),
+            ]
+        )
+    finally:
+        server.stop()
+
+
+def parse_config(items):
+    config = {}
+    for item in items:
+        key, _, value = item.partition("=")
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    return config
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Load test and latency benchmarks for Flask-PyBankID."
+    )
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="Scenario to run; may be repeated. Default is all of them.",
+    )
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--document-size", type=int, default=4000)
+    parser.add_argument("--orders", type=int, default=10)
+    parser.add_argument("--config", action="append", default=[], metavar="KEY=VALUE")
+    parser.add_argument("--trace-memory", action="store_true")
+    parser.add_argument("--json", action="store_true", help="Output JSON lines.")
+    args = parser.parse_args(argv)
+
+    config = parse_config(args.config)
+    results = [run_scenario(name, args, config) for name in args.scenario or SCENARIOS]
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                "  ".join(
+                    (
+                        "{0}={1:.2f}".format(k, v)
+                        if isinstance(v, float)
+                        else "{0}={1}".format(k, v)
+                    )
+                    for k, v in result.items()
+                )
+            )
+    return results
+
+
+if __name__ == "__main__":
+    main()
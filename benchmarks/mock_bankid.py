@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`mock_bankid` -- Local stand-in for the BankID RP API v5
+=============================================================
+
+A threaded HTTP server answering ``auth``, ``sign``, ``collect`` and
+``cancel`` like the BankID RP API v5 does, after a configurable latency.
+Each order walks through a configurable sequence of collect results, one
+step per collect call.
+
+It is used by :mod:`benchmark` but can also be started on its own:
+
+.. code-block:: bash
+
+    $ python benchmarks/mock_bankid.py --port 8800 --latency 0.05
+
+and used from an app with ``PYBANKID_BACKEND = 'json'`` and
+``PYBANKID_API_URL = 'http://127.0.0.1:8800/rp/v5/'``.
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+#: Collect results of an order, in order. The last one is repeated.
+DEFAULT_STATUS_SEQUENCE = (
+    ("pending", "outstandingTransaction"),
+    ("pending", "outstandingTransaction"),
+    ("pending", "userSign"),
+    ("complete", None),
+)
+
+
+class MockBankIDServer(ThreadingMixIn, HTTPServer):
+    """A local BankID RP API v5 stand-in.
+
+    :param tuple address: ``(host, port)`` to listen on; port 0 picks a free one.
+    :param float latency: Seconds to wait before answering each call.
+    :param float jitter: Maximum number of seconds added at random to `latency`.
+    :param status_sequence: ``(status, hintCode)`` tuples that the collect
+        results of each order walk through.
+
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        address=("127.0.0.1", 0),
+        latency=0.0,
+        jitter=0.0,
+        status_sequence=DEFAULT_STATUS_SEQUENCE,
+    ):
+        HTTPServer.__init__(self, address, _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.status_sequence = status_sequence
+        self.orders = {}
+        self.calls = {"auth": 0, "sign": 0, "collect": 0, "cancel": 0}
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def api_url(self):
+        return "http://{0}:{1}/rp/v5/".format(*self.server_address[:2])
+
+    def start(self):
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def reset_counts(self):
+        with self.lock:
+            for key in self.calls:
+                self.calls[key] = 0
+
+    def handle_call(self, endpoint, data):
+        with self.lock:
+            if endpoint in self.calls:
+                self.calls[endpoint] += 1
+
+        if endpoint in ("auth", "sign"):
+            order_ref = str(uuid.uuid4())
+            with self.lock:
+                self.orders[order_ref] = 0
+            return 200, {"orderRef": order_ref, "autoStartToken": str(uuid.uuid4())}
+        elif endpoint == "collect":
+            order_ref = data.get("orderRef")
+            with self.lock:
+                step = self.orders.get(order_ref)
+                if step is None:
+                    return 400, {
+                        "errorCode": "invalidParameters",
+                        "details": "No such order",
+                    }
+                self.orders[order_ref] = step + 1
+            status, hint_code = self.status_sequence[
+                min(step, len(self.status_sequence) - 1)
+            ]
+            response = {"orderRef": order_ref, "status": status}
+            if hint_code:
+                response["hintCode"] = hint_code
+            if status == "complete":
+                response["completionData"] = {
+                    "user": {
+                        "personalNumber": "190000000000",
+                        "name": "Karl Karlsson",
+                        "givenName": "Karl",
+                        "surname": "Karlsson",
+                    },
+                    "device": {"ipAddress": "127.0.0.1"},
+                    "cert": {"notBefore": "1502983274000", "notAfter": "1563549674000"},
+                    "signature": "c2lnbmF0dXJl",
+                    "ocspResponse": "b2NzcA==",
+                }
+            return 200, response
+        elif endpoint == "cancel":
+            with self.lock:
+                self.orders.pop(data.get("orderRef"), None)
+            return 200, {}
+        return 404, {"errorCode": "notFound", "details": "Unknown endpoint"}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            data = json.loads(body.decode("utf-8") or "{}")
+        except ValueError:
+            data = {}
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        status_code, response = server.handle_call(
+            self.path.rstrip("/").rsplit("/", 1)[-1], data
+        )
+        payload = json.dumps(response).encode("utf-8")
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local BankID RP API v5 stand-in.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    args = parser.parse_args()
+    server = MockBankIDServer((args.host, args.port), args.latency, args.jitter)
+    print("Serving BankID RP API v5 stand-in at {0}".format(server.api_url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`startup` -- Cold start benchmark for Flask-PyBankID
+=========================================================
+
+Measures, in fresh interpreters, how long it takes to import
+:mod:`flask_pybankid`, to set up an app with :class:`flask_pybankid.PyBankID`
+and to build its client with :meth:`flask_pybankid.PyBankID.warmup`, and
+checks that PyBankID itself is not imported before the client is needed:
+
+.. code-block:: bash
+
+    $ python benchmarks/startup.py --runs 10 --max-import-ms 400
+
+The exit status is non-zero if PyBankID is imported eagerly, or if the
+median import time exceeds ``--max-import-ms``.
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import OrderedDict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#: Run in a fresh interpreter; prints the timings of one cold start as JSON.
+PROBE = """
+import json, sys, time
+start = time.time()
+import flask_pybankid
+imported = time.time()
+eager = sorted(m for m in ("bankid", "zeep") if m in sys.modules)
+import flask
+app = flask.Flask("startup")
+app.config["PYBANKID_BACKEND"] = "json"
+bankid = flask_pybankid.PyBankID(app)
+initialised = time.time()
+bankid.warmup()
+warm = time.time()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "init_app_ms": (initialised - imported) * 1000,
+    "warmup_ms": (warm - initialised) * 1000,
+    "eager_imports": eager,
+}))
+"""
+
+
+def measure():
+    """Time one cold start in a fresh interpreter."""
+    output = subprocess.check_output([sys.executable, "-c", PROBE], cwd=ROOT)
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Cold start benchmark for Flask-PyBankID."
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=None)
+    parser.add_argument("--json", action="store_true", help="Output JSON.")
+    args = parser.parse_args(argv)
+
+    runs = [measure() for _ in range(args.runs)]
+    result = OrderedDict([("runs", args.runs)])
+    for key in ("import_ms", "init_app_ms", "warmup_ms"):
+        result[key] = median([run[key] for run in runs])
+    result["eager_imports"] = sorted(
+        set(m for run in runs for m in run["eager_imports"])
+    )
+
+    if args.json:
+        print(json.dumps(result))
+    else:
+        print(
+            "  ".join(
+                (
+                    "{0}={1:.2f}".format(k, v)
+                    if isinstance(v, float)
+                    else "{0}={1}".format(k, v)
+                )
+                for k, v in result.items()
+            )
+        )
+
+    failed = bool(result["eager_imports"]) or (
+        args.max_import_ms is not None and result["import_ms"] > args.max_import_ms
+    )
+    return result, failed
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main()[1] else 0)
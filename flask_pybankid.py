@@ -15,13 +15,110 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from __future__ import absolute_import
 
-from flask import current_app, jsonify, request
-from bankid import BankIDClient, BankIDJSONClient, exceptions
+import base64
+import datetime
+import hashlib
+import hmac
+import importlib
+import json
+import logging
+import math
+import os
+import random
+import re
+import sqlite3
+import ssl
+import threading
+import time
+import weakref
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
 try:
-    from flask import _app_ctx_stack as stack
+    from queue import Empty, Full, Queue
 except ImportError:
-    from flask import _request_ctx_stack as stack
+    from Queue import Empty, Full, Queue
+
+import requests
+
+from flask import (
+    Response,
+    after_this_request,
+    current_app,
+    g,
+    has_app_context,
+    has_request_context,
+    jsonify,
+    request,
+)
+from requests.adapters import HTTPAdapter
+from requests.compat import basestring, unquote, urljoin, urlparse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class _Lazy(object):
+    """Stands in for an object that is created, e.g. imported, on first use.
+
+    Attribute access, calls, item lookups and :py:func:`isinstance` checks
+    are passed on to the object returned by `factory`.
+
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._object = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._object is None:
+            with self._lock:
+                if self._object is None:
+                    self._object = self._factory()
+        return self._object
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+    def __contains__(self, key):
+        return key in self._resolve()
+
+    def __instancecheck__(self, instance):
+        return isinstance(instance, self._resolve())
+
+
+# PyBankID imports its SOAP stack on import, so it is only imported once a
+# client is built or a BankID exception has to be handled.
+_bankid = _Lazy(lambda: importlib.import_module("bankid"))
+exceptions = _Lazy(lambda: importlib.import_module("bankid.exceptions"))
+BankIDClient = _Lazy(lambda: _bankid.BankIDClient)
+
+
+def _import_opentelemetry():
+    try:
+        from opentelemetry import propagate, trace
+    except ImportError:
+        return False
+    return trace, propagate
+
+
+# OpenTelemetry is optional, and only imported once tracing is enabled.
+_opentelemetry = _Lazy(_import_opentelemetry)
+_default_tracer = _Lazy(
+    lambda: _opentelemetry._resolve()
+    and _opentelemetry._resolve()[0].get_tracer(__name__)
+)
 
 
 class PyBankID(object):
@@ -45,6 +142,10 @@ class PyBankID(object):
         PYBANKID_KEY_PATH = 'path/to/key.pem'
         PYBANKID_TEST_SERVER = True
 
+    Further settings, e.g. to use the JSON backend, to poll, cache or store
+    collect results, to limit calls to BankID or to serve several tenants,
+    are described in the documentation.
+
     Should several BankID clients with different settings be desired, one
     can change the prefix `PYBANKID` to an arbitrarily chosen prefix instead,
     and initiate the :class:`~PyBankID` extension with the extra
@@ -63,8 +164,10 @@ class PyBankID(object):
         called automatically if `app` is passed to :meth:`~PyBankID.__init__`.
 
         The app is configured according to the configuration variables
-        ``PREFIX_CERT_PATH``, ``PREFIX_KEY_PATH`` and ``PREFIX_TEST_SERVER``,
-         where "PREFIX" defaults to "PYBANKID".
+        ``PREFIX_CERT_PATH``, ``PREFIX_KEY_PATH``, ``PREFIX_TEST_SERVER``,
+        ``PREFIX_BACKEND`` and ``PREFIX_POOL_SIZE``, where "PREFIX" defaults
+        to "PYBANKID", as well as the optional settings described in the
+        documentation.
 
         :param flask.Flask app: the application to configure for use with
            this :class:`~PyBankID`
@@ -72,31 +175,168 @@ class PyBankID(object):
            variables used to configure this :class:`~PyBankID`.
 
         """
+        self.config_prefix = config_prefix
         if "pybankid" not in app.extensions:
             app.extensions["pybankid"] = {}
 
         if config_prefix in app.extensions["pybankid"]:
             raise Exception('duplicate config_prefix "{0}"'.format(config_prefix))
+        app.extensions["pybankid"][config_prefix] = _PyBankIDState(self)
 
         app.config.setdefault(self._config_key("CERT_PATH"), "")
         app.config.setdefault(self._config_key("KEY_PATH"), "")
         app.config.setdefault(self._config_key("TEST_SERVER"), False)
+        app.config.setdefault(self._config_key("BACKEND"), "soap")
+        app.config.setdefault(self._config_key("POOL_SIZE"), 10)
+        app.config.setdefault(self._config_key("API_URL"), None)
+        app.config.setdefault(self._config_key("METRICS_ENDPOINT"), None)
+        app.config.setdefault(self._config_key("FAST_JSON"), False)
+        app.config.setdefault(self._config_key("TRACING"), False)
+        app.config.setdefault(self._config_key("VALIDATE_PERSONAL_NUMBER"), False)
+        app.config.setdefault(self._config_key("TRACER"), None)
+        app.config.setdefault(self._config_key("REQUEST_TIMEOUT"), None)
+        app.config.setdefault(self._config_key("PREFORK_WARMUP"), False)
+        app.config.setdefault(self._config_key("TENANTS"), None)
+        app.config.setdefault(self._config_key("TENANT_HEADER"), None)
+        app.config.setdefault(self._config_key("TENANT_URL_PREFIX"), None)
+        app.config.setdefault(self._config_key("TENANT_MAX_CLIENTS"), 32)
+        app.config.setdefault(self._config_key("TENANT_IDLE_TIMEOUT"), 300.0)
+        app.config.setdefault(self._config_key("CERT_CHECK_INTERVAL"), 1.0)
+        app.config.setdefault(self._config_key("CIRCUIT_BREAKER"), False)
+        app.config.setdefault(self._config_key("BREAKER_FAILURE_THRESHOLD"), 5)
+        app.config.setdefault(self._config_key("BREAKER_SLOW_CALL_DURATION"), 10.0)
+        app.config.setdefault(self._config_key("BREAKER_RESET_TIMEOUT"), 30.0)
+        app.config.setdefault(self._config_key("RATE_LIMIT"), None)
+        app.config.setdefault(self._config_key("RATE_BURST"), None)
+        app.config.setdefault(self._config_key("MAX_CONCURRENCY"), None)
+        app.config.setdefault(self._config_key("MAX_QUEUE"), 100)
+        app.config.setdefault(self._config_key("QUEUE_TIMEOUT"), 5.0)
+        app.config.setdefault(self._config_key("COLLECT_RETRIES"), 0)
+        app.config.setdefault(self._config_key("RETRY_BACKOFF"), 0.1)
+        app.config.setdefault(self._config_key("RETRY_BACKOFF_MAX"), 2.0)
+        app.config.setdefault(self._config_key("RETRY_BUDGET_RATIO"), 0.1)
+        app.config.setdefault(self._config_key("RETRY_BUDGET_MIN"), 10)
+        app.config.setdefault(self._config_key("HEDGE_COLLECT"), False)
+        app.config.setdefault(self._config_key("HEDGE_PERCENTILE"), 95)
+        app.config.setdefault(self._config_key("HEDGE_MIN_DELAY"), 0.05)
+        app.config.setdefault(self._config_key("HEDGE_WORKERS"), 8)
+        app.config.setdefault(self._config_key("HEDGE_PRIMARY_WORKERS"), 32)
+        app.config.setdefault(self._config_key("ADAPTIVE_TIMEOUT"), False)
+        app.config.setdefault(self._config_key("TIMEOUT_PERCENTILE"), 99)
+        app.config.setdefault(self._config_key("TIMEOUT_MULTIPLIER"), 3.0)
+        app.config.setdefault(self._config_key("TIMEOUT_MIN"), 1.0)
+        app.config.setdefault(self._config_key("COLLECT_POLLER"), False)
+        app.config.setdefault(self._config_key("COLLECT_INTERVAL"), 2.0)
+        app.config.setdefault(self._config_key("COLLECT_RETENTION"), 60.0)
+        app.config.setdefault(self._config_key("POLLER_WORKERS"), 4)
+        app.config.setdefault(self._config_key("COLLECT_MAX_WAIT"), 30.0)
+        app.config.setdefault(self._config_key("STREAM_TIMEOUT"), 180.0)
+        app.config.setdefault(self._config_key("SINGLE_FLIGHT"), True)
+        app.config.setdefault(self._config_key("SINGLE_FLIGHT_MAX_KEYS"), 10000)
+        app.config.setdefault(self._config_key("SINGLE_FLIGHT_TIMEOUT"), 30.0)
+        app.config.setdefault(self._config_key("ORDER_STORE"), None)
+        app.config.setdefault(self._config_key("ORDER_RETENTION"), 600.0)
+        app.config.setdefault(self._config_key("COLLECT_CACHE"), None)
+        app.config.setdefault(self._config_key("AUTH_DEDUPE"), False)
+        app.config.setdefault(self._config_key("AUTH_DEDUPE_TTL"), 30.0)
+        app.config.setdefault(self._config_key("AUTH_DEDUPE_COOKIE"), "pybankid_client")
+        app.config.setdefault(self._config_key("REAP_AFTER"), None)
+        app.config.setdefault(self._config_key("CALLBACK_URLS"), ())
+        app.config.setdefault(self._config_key("CALLBACK_SECRET"), None)
+        app.config.setdefault(self._config_key("CALLBACK_WORKERS"), 2)
+        app.config.setdefault(self._config_key("CALLBACK_QUEUE_SIZE"), 1000)
+        app.config.setdefault(self._config_key("CALLBACK_RETRIES"), 3)
+        app.config.setdefault(self._config_key("CALLBACK_BACKOFF"), 0.5)
+        app.config.setdefault(self._config_key("CALLBACK_TIMEOUT"), 5.0)
+        app.config.setdefault(self._config_key("REAP_BATCH_SIZE"), 100)
+        app.config.setdefault(self._config_key("REAP_WORKERS"), 4)
+        app.config.setdefault(self._config_key("COLLECT_CACHE_TTL"), 1.0)
+        app.config.setdefault(self._config_key("COLLECT_CACHE_TERMINAL_TTL"), 300.0)
+        app.config.setdefault(self._config_key("COLLECT_CACHE_MAX_ENTRIES"), 10000)
+        app.config.setdefault(self._config_key("COLLECT_CACHE_MAX_BYTES"), 2**24)
+        app.config.setdefault(self._config_key("BATCH_WORKERS"), 8)
+        app.config.setdefault(self._config_key("BATCH_MAX_SIZE"), 1000)
+        app.config.setdefault(self._config_key("BATCH_STREAM_THRESHOLD"), 100)
+        app.config.setdefault(self._config_key("SIGN_MAX_BYTES"), 2**18)
+        app.config.setdefault(self._config_key("SIGN_CACHE_MAX_BYTES"), 2**23)
+        app.config.setdefault(self._config_key("SIGN_CACHE_TTL"), 300.0)
 
-        # Adding the three url endpoints.
-        app.add_url_rule(
-            "/authenticate/<personal_number>", view_func=self._authenticate
-        )
-        app.add_url_rule("/sign/<personal_number>", view_func=self._sign)
-        app.add_url_rule("/collect/<order_ref>", view_func=self._collect)
+        if app.config.get(self._config_key("REAP_AFTER")) is not None and (
+            app.config.get(self._config_key("BACKEND")) != "json"
+        ):
+            raise ValueError(
+                "{0} requires the json backend, which can cancel orders".format(
+                    self._config_key("REAP_AFTER")
+                )
+            )
+
+        # Adding the url endpoints, also under the tenant URL prefix if set.
+        url_prefixes = [""]
+        tenant_url_prefix = app.config.get(self._config_key("TENANT_URL_PREFIX"))
+        if tenant_url_prefix:
+            url_prefixes.append(tenant_url_prefix.rstrip("/"))
+            app.url_value_preprocessor(self._pop_tenant)
+        for url_prefix in url_prefixes:
+            app.add_url_rule(
+                url_prefix + "/authenticate/<personal_number>",
+                view_func=self._authenticate,
+            )
+            app.add_url_rule(
+                url_prefix + "/sign/<personal_number>",
+                view_func=self._sign,
+                methods=["GET", "POST"],
+            )
+            app.add_url_rule(
+                url_prefix + "/collect/<order_ref>", view_func=self._collect
+            )
+            app.add_url_rule(
+                url_prefix + "/collect", view_func=self._collect_batch, methods=["POST"]
+            )
+            app.add_url_rule(
+                url_prefix + "/collect/<order_ref>/stream",
+                view_func=self._collect_stream,
+            )
+            app.add_url_rule(
+                url_prefix + "/cancel/<order_ref>",
+                view_func=self._cancel,
+                methods=["GET", "POST"],
+            )
+
+        metrics_endpoint = app.config.get(self._config_key("METRICS_ENDPOINT"))
+        if metrics_endpoint:
+            app.add_url_rule(metrics_endpoint, view_func=self._metrics_view)
 
         if hasattr(app, "teardown_appcontext"):
             app.teardown_appcontext(self.teardown)
         else:
             app.teardown_request(self.teardown)
 
+        if app.config.get(self._config_key("PREFORK_WARMUP")):
+            self.warmup(app)
+
     def _config_key(self, suffix):
         return "{0}_{1}".format(self.config_prefix, suffix)
 
+    def warmup(self, app=None):
+        """Import PyBankID and build the BankID client ahead of the first
+        call, e.g. in the master process of a pre-forking server.
+
+        :param flask.Flask app: the application whose client to build;
+            defaults to the one given to the constructor or the current app.
+        :return: The BankID client.
+        :rtype: :py:class:`bankid.client.BankIDClient`
+
+        """
+        app = app or self.app or current_app._get_current_object()
+        for lazy in (
+            _bankid,
+            exceptions,
+            _exception_class_to_status_code,
+            _failed_hint_to_exception_class,
+        ):
+            lazy._resolve()
+        return self._get_client(app)
+
     def teardown(self, exception):
         pass
 
@@ -104,63 +344,1085 @@ class PyBankID(object):
     def client(self):
         """The automatically created :py:class:`bankid.client.BankIDClient` object.
 
+        The client is created on first use and then shared by all threads
+        and application contexts in the process. It is rebuilt if the
+        certificate, key or test server settings change, or if the
+        certificate or key files are modified.
+
+        With ``PREFIX_BACKEND = 'json'`` a client using the RP API v5 is
+        returned instead, with the same call signatures and response format.
+
         :return: The BankID client.
-        :rtype: :py:class:`bankid.jsonclient.BankIDJSONClient`
-
-        """
-        ctx = stack.top
-        attr_name = self._config_key("client")
-        if ctx is not None:
-            if not hasattr(ctx, attr_name):
-                setattr(
-                    ctx,
-                    attr_name,
-                    BankIDClient(
-                        (
-                            current_app.config.get(self._config_key("CERT_PATH")),
-                            current_app.config.get(self._config_key("KEY_PATH")),
+        :rtype: :py:class:`bankid.client.BankIDClient`
+
+        """
+        if has_app_context():
+            return self._get_client(current_app, self._tenant())
+
+    @property
+    def metrics(self):
+        """The process-wide telemetry of BankID calls.
+
+        :rtype: :py:class:`~Metrics`
+
+        """
+        return _metrics
+
+    @property
+    def client_stats(self):
+        """Reuse statistics of the pooled client for this config prefix.
+
+        :return: Dictionary with ``hits``, ``misses`` and ``builds`` counts.
+        :rtype: dict
+
+        """
+        return _client_registry.stats(self.config_prefix)
+
+    @property
+    def tenant_stats(self):
+        """Number of live tenant clients (``clients``), and of tenant clients
+        built (``builds``) and closed for being idle or least recently used
+        (``evictions``), for this config prefix.
+
+        :rtype: dict
+
+        """
+        clients = self._get_tenant_clients(current_app)
+        return {
+            "clients": len(clients),
+            "builds": clients.builds,
+            "evictions": clients.evictions,
+        }
+
+    def _tenant(self):
+        """The tenant of the current request, or ``None`` for the default
+        settings.
+
+        :raises FlaskPyBankIDError: with status 404 for unknown tenants.
+
+        """
+        if not has_request_context():
+            return None
+        tenants = current_app.config.get(self._config_key("TENANTS"))
+        if not tenants:
+            return None
+        tenant = getattr(g, "pybankid_tenant", None)
+        header = current_app.config.get(self._config_key("TENANT_HEADER"))
+        if tenant is None and header:
+            tenant = request.headers.get(header)
+        if tenant is None:
+            return None
+        if "/" in tenant or self._tenant_settings(current_app, tenant) is None:
+            raise FlaskPyBankIDError('Unknown tenant "{0}".'.format(tenant), 404)
+        return tenant
+
+    def _tenant_settings(self, app, tenant):
+        tenants = app.config.get(self._config_key("TENANTS")) or {}
+        return tenants(tenant) if callable(tenants) else tenants.get(tenant)
+
+    def _pop_tenant(self, endpoint, values):
+        if values and endpoint in _ENDPOINTS and "tenant" in values:
+            g.pybankid_tenant = values.pop("tenant")
+
+    def _get_tenant_clients(self, app):
+        state = self._state(app)
+        if state.tenant_clients is None:
+            with state.lock:
+                if state.tenant_clients is None:
+                    state.tenant_clients = _ClientRegistry(
+                        max_size=app.config.get(self._config_key("TENANT_MAX_CLIENTS")),
+                        idle_timeout=app.config.get(
+                            self._config_key("TENANT_IDLE_TIMEOUT")
+                        ),
+                    )
+        return state.tenant_clients
+
+    def _state(self, app=None):
+        return (app or current_app).extensions["pybankid"][self.config_prefix]
+
+    @property
+    def poller(self):
+        """The background collect poller of the current app, started on first
+        use.
+
+        :return: The poller.
+        :rtype: :py:class:`~_CollectPoller`
+
+        """
+        state = self._state()
+        if state.poller is None:
+            with state.lock:
+                if state.poller is None:
+                    app = current_app._get_current_object()
+                    config = app.config
+                    state.poller = _CollectPoller(
+                        lambda order_ref: self._collect_order(app, order_ref),
+                        interval=config.get(self._config_key("COLLECT_INTERVAL")),
+                        retention=config.get(self._config_key("COLLECT_RETENTION")),
+                        workers=config.get(self._config_key("POLLER_WORKERS")),
+                        seen=lambda order_ref: self._order_seen(app, order_ref),
+                    )
+        return state.poller
+
+    def add_callback(self, order_ref, callback):
+        """Deliver the final result of an order, once it is complete or has
+        failed, to `callback`.
+
+        The order is collected by the :attr:`~PyBankID.poller` until then. The
+        result is a dictionary with the ``orderRef`` and ``status`` of the
+        order, and either the collect response as ``result`` or the error as
+        ``error``.
+
+        :param str order_ref: The ``orderRef`` of the order.
+        :param callback: A URL to post the result to as JSON, or a function
+            called with the ``orderRef`` and the result.
+
+        """
+        delivery = self._get_delivery(current_app)
+        self.poller.subscribe(
+            _order_key(self._tenant(), order_ref),
+            lambda response, error: delivery.submit(
+                callback, order_ref, response, error
+            ),
+            key=callback,
+        )
+
+    @property
+    def callback_stats(self):
+        """Number of results delivered to callbacks (``delivered``), given up
+        on after all retries (``failed``) and dropped for lack of room in the
+        delivery queue (``dropped``), for the current app.
+
+        :rtype: dict
+
+        """
+        return self._get_delivery(current_app).stats()
+
+    def _get_delivery(self, app):
+        state = self._state(app)
+        if state.delivery is None:
+            with state.lock:
+                if state.delivery is None:
+                    config = app.config
+                    state.delivery = _CallbackDelivery(
+                        self.config_prefix,
+                        secret=config.get(self._config_key("CALLBACK_SECRET")),
+                        workers=config.get(self._config_key("CALLBACK_WORKERS")),
+                        queue_size=config.get(self._config_key("CALLBACK_QUEUE_SIZE")),
+                        retries=config.get(self._config_key("CALLBACK_RETRIES")),
+                        backoff=config.get(self._config_key("CALLBACK_BACKOFF")),
+                        timeout=config.get(self._config_key("CALLBACK_TIMEOUT")),
+                    )
+        return state.delivery
+
+    def _callback_url(self, app):
+        """The ``callbackUrl`` of the current request, if any.
+
+        :raises FlaskPyBankIDError: with status 400 if it is not allowed.
+
+        """
+        url = request.args.get("callbackUrl")
+        if url is None:
+            return None
+        allowed = app.config.get(self._config_key("CALLBACK_URLS")) or ()
+        if not any(_url_is_under(url, prefix) for prefix in allowed):
+            raise FlaskPyBankIDError("Callback URL not allowed.", 400)
+        return url
+
+    @property
+    def reaper(self):
+        """The canceller of abandoned orders of the current app, or ``None``
+        if ``PREFIX_REAP_AFTER`` is not set.
+
+        :rtype: :py:class:`~_OrderReaper`
+
+        """
+        return self._get_reaper(current_app) or None
+
+    def _get_reaper(self, app):
+        state = self._state(app)
+        if state.reaper is None:
+            with state.lock:
+                if state.reaper is None:
+                    if app is current_app:
+                        # The reaper cancels orders outside of app contexts.
+                        app = current_app._get_current_object()
+                    timeout = app.config.get(self._config_key("REAP_AFTER"))
+                    state.reaper = timeout is not None and _OrderReaper(
+                        lambda order_key: self._cancel_order(app, order_key),
+                        self.config_prefix,
+                        timeout=timeout,
+                        batch_size=app.config.get(self._config_key("REAP_BATCH_SIZE")),
+                        workers=app.config.get(self._config_key("REAP_WORKERS")),
+                        last_seen=lambda order_key: self._order_last_seen(
+                            app, order_key
                         ),
-                        current_app.config.get(self._config_key("TEST_SERVER")),
+                    )
+        return state.reaper
+
+    def _order_seen(self, app, order_key):
+        reaper = self._get_reaper(app)
+        if reaper:
+            reaper.seen(order_key)
+            store = self._get_order_store(app)
+            if store is not False:
+                store.seen(order_key)
+
+    def _order_last_seen(self, app, order_key):
+        """When the status of an order was last asked for, by any process
+        sharing the order store, as a UNIX timestamp, ``None`` if that is not
+        known, or ``False`` if the order has finished."""
+        store = self._get_order_store(app)
+        if store is False:
+            return None
+        record = store.get(order_key)
+        if record is not None and record["terminal"]:
+            return False
+        return store.last_seen(order_key)
+
+    @property
+    def cache_stats(self):
+        """Collect cache hit and miss counts of the current app, per endpoint.
+
+        :return: Dictionary mapping endpoint names to dictionaries with
+            ``hits`` and ``misses`` counts.
+        :rtype: dict
+
+        """
+        state = self._state()
+        with state.lock:
+            return dict((k, dict(v)) for k, v in state.cache_stats.items())
+
+    def _get_cache(self, app):
+        state = self._state(app)
+        if state.cache is None:
+            cache = app.config.get(self._config_key("COLLECT_CACHE"))
+            if cache == "memory":
+                cache = MemoryCollectCache(
+                    max_entries=app.config.get(
+                        self._config_key("COLLECT_CACHE_MAX_ENTRIES")
+                    ),
+                    max_bytes=app.config.get(
+                        self._config_key("COLLECT_CACHE_MAX_BYTES")
                     ),
                 )
-            return getattr(ctx, attr_name)
+            state.cache = False if cache is None else cache
+        return state.cache
 
-    def _authenticate(self, personal_number):
-        try:
-            response = self.client.authenticate(personal_number)
-        except exceptions.BankIDError as e:
-            return self.handle_exception(
-                FlaskPyBankIDError.create_from_pybankid_exception(e)
+    def _count_cache_lookup(self, app, hit, endpoint=None):
+        state = self._state(app)
+        if endpoint is None and has_request_context():
+            endpoint = request.endpoint
+        with state.lock:
+            stats = state.cache_stats.setdefault(
+                endpoint or "poller", {"hits": 0, "misses": 0}
             )
-        except Exception as e:
-            return self.handle_exception(FlaskPyBankIDError(str(e), 500))
+            stats["hits" if hit else "misses"] += 1
+
+    @property
+    def single_flight_stats(self):
+        """Number of collects sent upstream (``issued``) and of concurrent
+        identical collects that waited for one of those instead
+        (``coalesced``), for the current app.
+
+        :rtype: dict
+
+        """
+        flight = self._get_single_flight(current_app)
+        return flight.stats() if flight else {"issued": 0, "coalesced": 0}
+
+    def _get_single_flight(self, app):
+        state = self._state(app)
+        if state.single_flight is None:
+            if app.config.get(self._config_key("SINGLE_FLIGHT")):
+                state.single_flight = _SingleFlight(
+                    max_keys=app.config.get(self._config_key("SINGLE_FLIGHT_MAX_KEYS")),
+                    timeout=app.config.get(self._config_key("SINGLE_FLIGHT_TIMEOUT")),
+                )
+            else:
+                state.single_flight = False
+        return state.single_flight
+
+    def _get_pending_orders(self, app):
+        state = self._state(app)
+        if state.pending_orders is None:
+            index = app.config.get(self._config_key("AUTH_DEDUPE"))
+            if index is True or index == "memory":
+                index = MemoryCollectCache()
+            state.pending_orders = False if index is None else index
+        return state.pending_orders
+
+    def _deduplicated(self, app, personal_number, start):
+        """Call `start` to start an authentication, unless one is already
+        pending for the same personal number and end user, in which case its
+        response is returned instead.
+
+        Pending orders are only handed back to the client that started them,
+        as told by a random token kept in a cookie; personal numbers and IP
+        addresses are no secret.
+
+        """
+        index = self._get_pending_orders(app)
+        if index is False:
+            return start()
+        cookie = app.config.get(self._config_key("AUTH_DEDUPE_COOKIE"))
+        token = request.cookies.get(cookie)
+        new_client = not token
+        if new_client:
+            token = base64.urlsafe_b64encode(os.urandom(24)).decode("ascii")
+
+            @after_this_request
+            def set_token(response):
+                response.set_cookie(
+                    cookie,
+                    token,
+                    httponly=True,
+                    secure=request.is_secure,
+                    samesite="Lax",
+                )
+                return response
+
+        secret = app.secret_key or b""
+        if not isinstance(secret, bytes):
+            secret = secret.encode("utf-8")
+        digest = hmac.new(
+            secret,
+            "\0".join(
+                (self._tenant() or "", personal_number, _end_user_ip(), token)
+            ).encode("utf-8"),
+            hashlib.sha256,
+        ).hexdigest()
+        key = "{0}:pending:{1}".format(self.config_prefix, digest)
+        pending = None if new_client else index.get(key)
+        if pending is not None:
+            _metrics.add(
+                "pybankid_auth_dedupe_hits_total", 1, prefix=self.config_prefix
+            )
+            return json.loads(pending)
+
+        def fetch():
+            response = start()
+            if response.get("orderRef"):
+                ttl = app.config.get(self._config_key("AUTH_DEDUPE_TTL"))
+                order_key = _order_key(self._tenant(), response["orderRef"])
+                index.set(key, json.dumps(response, default=str), ttl)
+                index.set(self._pending_order_key(order_key), key, ttl)
+            return response
+
+        flight = self._get_single_flight(app)
+        return flight.do(key, fetch) if flight else fetch()
+
+    def _pending_order_key(self, order_key):
+        return "{0}:pending-order:{1}".format(self.config_prefix, order_key)
+
+    def _order_finished(self, app, order_key):
+        reaper = self._get_reaper(app)
+        if reaper:
+            reaper.forget(order_key)
+        index = self._get_pending_orders(app)
+        if index is not False:
+            key = index.get(self._pending_order_key(order_key))
+            if key is not None:
+                index.delete(key)
+                index.delete(self._pending_order_key(order_key))
+
+    def _collect_order(self, app, order_key, endpoint=None):
+        """Collect an order, using the collect cache if one is configured and
+        sharing the upstream call with concurrent collects of the same order.
+
+        `order_key` is the orderRef, preceded by ``tenant/`` for tenants.
+
+        """
+        store = self._get_order_store(app)
+        if store is not False:
+            record = store.get(order_key)
+            if record is not None and record["terminal"]:
+                return _decode_collect_result(record["result"])
+            polling = store.acquire_poll(
+                order_key, app.config.get(self._config_key("COLLECT_INTERVAL"))
+            )
+            if not polling and record is not None and record["result"] is not None:
+                return _decode_collect_result(record["result"])
+
+        cache = self._get_cache(app)
+        key = "{0}:{1}".format(self.config_prefix, order_key)
+        if cache is not False:
+            cached = cache.get(key)
+            self._count_cache_lookup(app, cached is not None, endpoint)
+            if cached is not None:
+                return _decode_collect_result(cached)
+
+        retrier = self._get_retrier(app)
+
+        def fetch():
+            response, error = None, None
+            try:
+                if retrier:
+                    response = retrier.collect(order_key)
+                else:
+                    response = self._collect_upstream(app, order_key)
+            except Exception as e:
+                error = e
+            if cache is not False:
+                self._store_collect_result(app, cache, key, response, error)
+            if store is not False and (error is None or _is_terminal(response, error)):
+                store.update(
+                    order_key,
+                    _encode_collect_result(response, error),
+                    _collect_status(response, error),
+                    _is_terminal(response, error),
+                )
+            if _is_terminal(response, error):
+                self._order_finished(app, order_key)
+            if error is not None:
+                raise error
+            return response
+
+        flight = self._get_single_flight(app)
+        return flight.do(key, fetch) if flight else fetch()
+
+    def _collect_upstream(self, app, order_key):
+        tenant, order_ref = _split_order_key(order_key)
+        with self._span(app, "client"):
+            client = self._get_client(app, tenant)
+        return self._call_upstream(app, "collect", tenant, client.collect, order_ref)
+
+    @property
+    def retry_stats(self):
+        """Number of collects retried after a transient failure
+        (``retries``), hedged with a second collect (``hedges``) and answered
+        by that second collect (``hedge_wins``), and of retries and hedges not
+        made for lack of budget (``budget_exhausted``), for this config prefix.
+
+        :rtype: dict
+
+        """
+        return dict(
+            (key, int(_metrics.get(name, prefix=self.config_prefix)))
+            for key, name in (
+                ("retries", "pybankid_collect_retries_total"),
+                ("hedges", "pybankid_collect_hedges_total"),
+                ("hedge_wins", "pybankid_collect_hedge_wins_total"),
+                ("budget_exhausted", "pybankid_retry_budget_exhausted_total"),
+            )
+        )
+
+    def _get_retrier(self, app):
+        state = self._state(app)
+        if state.retrier is None:
+            with state.lock:
+                if state.retrier is None:
+                    state.retrier = self._create_retrier(app)
+        return state.retrier
+
+    def _create_retrier(self, app):
+        config = app.config
+        retries = config.get(self._config_key("COLLECT_RETRIES"))
+        hedge = config.get(self._config_key("HEDGE_COLLECT"))
+        if not retries and not hedge:
+            return False
+        hedge_tracker = None
+        if hedge:
+            hedge_tracker = _LatencyTracker(
+                percentile=config.get(self._config_key("HEDGE_PERCENTILE")),
+                multiplier=1.0,
+                minimum=config.get(self._config_key("HEDGE_MIN_DELAY")),
+                maximum=config.get(self._config_key("REQUEST_TIMEOUT")) or 30.0,
+            )
+        return _CollectRetrier(
+            self.config_prefix,
+            lambda order_key: self._collect_upstream(app, order_key),
+            retries=retries or 0,
+            backoff=config.get(self._config_key("RETRY_BACKOFF")),
+            backoff_max=config.get(self._config_key("RETRY_BACKOFF_MAX")),
+            budget=_RetryBudget(
+                ratio=config.get(self._config_key("RETRY_BUDGET_RATIO")),
+                minimum=config.get(self._config_key("RETRY_BUDGET_MIN")),
+            ),
+            hedge_tracker=hedge_tracker,
+            hedge_workers=config.get(self._config_key("HEDGE_WORKERS")),
+            primary_workers=config.get(self._config_key("HEDGE_PRIMARY_WORKERS")),
+        )
+
+    @property
+    def order_store(self):
+        """The :class:`~OrderStore` of the current app, or ``None`` if it is
+        not enabled.
+
+        :rtype: :py:class:`~OrderStore`
+
+        """
+        return self._get_order_store(current_app) or None
+
+    def _get_order_store(self, app):
+        state = self._state(app)
+        if state.order_store is None:
+            with state.lock:
+                if state.order_store is None:
+                    state.order_store = _create_order_store(
+                        app.config.get(self._config_key("ORDER_STORE")),
+                        app.config.get(self._config_key("ORDER_RETENTION")),
+                    )
+        return state.order_store
+
+    def _order_started(self, app, operation, response):
+        if not response.get("orderRef"):
+            return
+        order_key = _order_key(self._tenant(), response["orderRef"])
+        store = self._get_order_store(app)
+        if store is not False:
+            store.add(order_key, operation)
+        reaper = self._get_reaper(app)
+        if reaper:
+            reaper.add(order_key)
+
+    def _store_collect_result(self, app, cache, key, response, error):
+        if _is_terminal(response, error):
+            ttl = app.config.get(self._config_key("COLLECT_CACHE_TERMINAL_TTL"))
+        elif error is None:
+            ttl = app.config.get(self._config_key("COLLECT_CACHE_TTL"))
+        else:
+            ttl = None
+        if ttl:
+            cache.set(key, _encode_collect_result(response, error), ttl)
+
+    def _client_settings(self, app, tenant=None):
+        overrides = self._tenant_settings(app, tenant) if tenant else {}
+
+        def get(suffix, default=None):
+            if suffix in overrides:
+                return overrides[suffix]
+            return app.config.get(self._config_key(suffix), default)
+
+        return (
+            get("CERT_PATH"),
+            get("KEY_PATH"),
+            get("TEST_SERVER"),
+            get("BACKEND", "soap"),
+            get("POOL_SIZE", 10),
+            get("API_URL"),
+            get("REQUEST_TIMEOUT"),
+        )
+
+    def _get_client(self, app, tenant=None):
+        settings = self._client_settings(app, tenant)
+        files = _certificate_watchers.get(settings[:2], _CertificateWatcher)
+        signature = files.signature(
+            settings[:2], app.config.get(self._config_key("CERT_CHECK_INTERVAL"))
+        )
+        if tenant is None:
+            registry, key = _client_registry, self.config_prefix
         else:
-            return jsonify(**response)
+            registry, key = self._get_tenant_clients(app), tenant
+        return registry.get(
+            key, settings + (signature,), lambda: _create_client(*settings)
+        )
+
+    def _authenticate(self, personal_number):
+        with self._span(current_app, "authenticate", kind="server") as span:
+            try:
+                personal_number = self._personal_number(current_app, personal_number)
+                callback_url = self._callback_url(current_app)
+
+                def start():
+                    with self._span(current_app, "client"):
+                        client = self.client
+                    response = self._call_upstream(
+                        current_app,
+                        "authenticate",
+                        self._tenant(),
+                        client.authenticate,
+                        personal_number,
+                    )
+                    self._order_started(current_app, "authenticate", response)
+                    return response
+
+                response = self._deduplicated(current_app, personal_number, start)
+                if callback_url and response.get("orderRef"):
+                    self.add_callback(response["orderRef"], callback_url)
+            except Exception as e:
+                return self._error_response(span, e)
+            _set_result_attributes(span, response)
+            with self._span(current_app, "respond"):
+                return self._respond(response)
 
     def _sign(self, personal_number):
-        text_to_sign = request.args.get("userVisibleData", "")
+        with self._span(current_app, "sign", kind="server") as span:
+            try:
+                personal_number = self._personal_number(current_app, personal_number)
+                callback_url = self._callback_url(current_app)
+                text_to_sign, hidden_data = self._sign_data(current_app)
+                with self._span(current_app, "client"):
+                    client = self.client
+                kwargs = {}
+                if hidden_data:
+                    kwargs["userNonVisibleData"] = self._encode_user_data(
+                        current_app, hidden_data
+                    )
+                if isinstance(client, _JSONClient):
+                    text_to_sign = _EncodedUserData(
+                        self._encode_user_data(current_app, text_to_sign)
+                    )
+                elif isinstance(text_to_sign, bytearray):
+                    text_to_sign = _decode_body(text_to_sign)
+                response = self._call_upstream(
+                    current_app,
+                    "sign",
+                    self._tenant(),
+                    client.sign,
+                    text_to_sign,
+                    personal_number,
+                    **kwargs
+                )
+                self._order_started(current_app, "sign", response)
+                if callback_url and response.get("orderRef"):
+                    self.add_callback(response["orderRef"], callback_url)
+            except Exception as e:
+                return self._error_response(span, e)
+            _set_result_attributes(span, response)
+            with self._span(current_app, "respond"):
+                return self._respond(response)
+
+    def _sign_data(self, app):
+        """The ``userVisibleData`` and ``userNonVisibleData`` of a signing,
+        from the query string or the body of the request. A body that is not
+        JSON is returned as it is read, as UTF-8 encoded bytes."""
+        if request.method != "POST":
+            return (
+                request.args.get("userVisibleData", ""),
+                request.args.get("userNonVisibleData"),
+            )
+        body = _read_request_body(app.config.get(self._config_key("SIGN_MAX_BYTES")))
+        if request.mimetype != "application/json":
+            return body, request.args.get("userNonVisibleData")
         try:
-            response = self.client.sign(text_to_sign, personal_number)
-        except exceptions.BankIDError as e:
-            return self.handle_exception(
-                FlaskPyBankIDError.create_from_pybankid_exception(e)
+            data = json.loads(_decode_body(body))
+        except ValueError:
+            raise FlaskPyBankIDError("Could not decode the request body.", 400)
+        if not isinstance(data, dict) or not all(
+            isinstance(data.get(key, ""), basestring)
+            for key in ("userVisibleData", "userNonVisibleData")
+        ):
+            raise FlaskPyBankIDError(
+                "Expected an object with userVisibleData and userNonVisibleData.",
+                400,
             )
-        except Exception as e:
-            return self.handle_exception(FlaskPyBankIDError(str(e), 500))
-        else:
-            return jsonify(**response)
+        return data.get("userVisibleData", ""), data.get("userNonVisibleData")
+
+    def _encode_user_data(self, app, data):
+        """Base64-encode data to sign, given as text or as the UTF-8 encoded
+        body of the request, reusing earlier encodings of the same data."""
+        body = isinstance(data, bytearray)
+        if not body:
+            data = data.encode("utf-8")
+        cache = self._get_user_data_cache(app)
+        encoded = None
+        if cache is not False:
+            key = hashlib.sha256(data).digest()
+            encoded = cache.get(key)
+            _metrics.add(
+                "pybankid_sign_data_cache_lookups_total",
+                1,
+                prefix=self.config_prefix,
+                result="miss" if encoded is None else "hit",
+            )
+        if encoded is None:
+            if body:
+                # Only to refuse bodies that are not UTF-8; those found in
+                # the cache have already been checked.
+                _decode_body(data)
+            encoded = base64.b64encode(data).decode("ascii")
+            if cache is not False:
+                cache.set(
+                    key, encoded, app.config.get(self._config_key("SIGN_CACHE_TTL"))
+                )
+        return encoded
+
+    def _get_user_data_cache(self, app):
+        max_bytes = app.config.get(self._config_key("SIGN_CACHE_MAX_BYTES"))
+        if not max_bytes:
+            return False
+        state = self._state(app)
+        if state.user_data_cache is None:
+            with state.lock:
+                if state.user_data_cache is None:
+                    state.user_data_cache = MemoryCollectCache(max_bytes=max_bytes)
+        return state.user_data_cache
+
+    def _personal_number(self, app, personal_number):
+        """The personal number to send to BankID, normalized if validation is
+        enabled."""
+        if not app.config.get(self._config_key("VALIDATE_PERSONAL_NUMBER")):
+            return personal_number
+        try:
+            return normalize_personal_number(personal_number)
+        except ValueError as e:
+            _metrics.add(
+                "pybankid_personal_number_rejections_total",
+                1,
+                prefix=self.config_prefix,
+            )
+            raise FlaskPyBankIDError(str(e), 400)
 
     def _collect(self, order_ref):
+        wait = request.args.get("wait", type=float)
+        with self._span(
+            current_app, "collect", kind="server", **{"bankid.order_ref": order_ref}
+        ) as span:
+            try:
+                # Also refuses NaN, for which every comparison is false.
+                if wait is not None and not 0 < wait < float("inf"):
+                    raise FlaskPyBankIDError(
+                        "wait must be a positive number of seconds.", 400
+                    )
+                order_key = _order_key(self._tenant(), order_ref)
+                self._order_seen(current_app, order_key)
+                if wait:
+                    response = self._wait_for_change(
+                        order_key, wait, request.args.get("status")
+                    )
+                elif current_app.config.get(self._config_key("COLLECT_POLLER")):
+                    response = self.poller.status(order_key)
+                else:
+                    response = self._collect_order(
+                        current_app._get_current_object(), order_key
+                    )
+            except Exception as e:
+                return self._error_response(span, e)
+            _set_result_attributes(span, response)
+            with self._span(current_app, "respond"):
+                return self._respond(response)
+
+    def _cancel(self, order_ref):
+        with self._span(
+            current_app, "cancel", kind="server", **{"bankid.order_ref": order_ref}
+        ) as span:
+            try:
+                cancelled = self._cancel_order(
+                    current_app._get_current_object(),
+                    _order_key(self._tenant(), order_ref),
+                )
+            except Exception as e:
+                return self._error_response(span, e)
+            return self._respond({"cancelled": bool(cancelled)})
+
+    def _cancel_order(self, app, order_key):
+        tenant, order_ref = _split_order_key(order_key)
+        with self._span(app, "client"):
+            client = self._get_client(app, tenant)
+        if not hasattr(client, "cancel"):
+            raise FlaskPyBankIDError(
+                "Orders can only be cancelled with the JSON backend.", 501
+            )
+        cancelled = self._call_upstream(app, "cancel", tenant, client.cancel, order_ref)
+        self._order_finished(app, order_key)
+        return cancelled
+
+    def _collect_batch(self):
         try:
-            response = self.client.collect(order_ref)
-        except exceptions.BankIDError as e:
-            return self.handle_exception(
-                FlaskPyBankIDError.create_from_pybankid_exception(e)
+            tenant = self._tenant()
+            order_refs = self._batch_order_refs(current_app)
+        except FlaskPyBankIDError as e:
+            return self.handle_exception(e)
+
+        app = current_app._get_current_object()
+        poller = (
+            self.poller if app.config.get(self._config_key("COLLECT_POLLER")) else None
+        )
+
+        def collect(order_ref):
+            order_key = _order_key(tenant, order_ref)
+            self._order_seen(app, order_key)
+            try:
+                if poller is not None:
+                    response = poller.status(order_key)
+                else:
+                    response = self._collect_order(app, order_key, "_collect_batch")
+            except Exception as e:
+                error = _wrap_exception(e)
+                return order_ref, dict(error.to_dict(), status=error.status_code)
+            return order_ref, response
+
+        pool = self._get_batch_pool(app)
+        threshold = app.config.get(self._config_key("BATCH_STREAM_THRESHOLD"))
+        if threshold is not None and len(order_refs) > threshold:
+            _count_response(200)
+
+            def generate():
+                for order_ref, result in pool.imap_unordered(collect, order_refs):
+                    yield _dumps({order_ref: result}) + b"\n"
+
+            return Response(generate(), mimetype="application/x-ndjson")
+        return self._respond(dict(pool.map(collect, order_refs)))
+
+    def _batch_order_refs(self, app):
+        """The distinct orderRefs posted to ``/collect``, either as a list or
+        as ``{"orderRefs": [...]}``."""
+        data = request.get_json(force=True, silent=True)
+        if isinstance(data, dict):
+            data = data.get("orderRefs")
+        if not isinstance(data, list) or not all(
+            isinstance(order_ref, basestring) and order_ref and "/" not in order_ref
+            for order_ref in data
+        ):
+            raise FlaskPyBankIDError("Expected a list of orderRefs.", 400)
+        order_refs = list(OrderedDict.fromkeys(data))
+        max_size = app.config.get(self._config_key("BATCH_MAX_SIZE"))
+        if max_size is not None and len(order_refs) > max_size:
+            raise FlaskPyBankIDError(
+                "At most {0} orderRefs can be collected at once.".format(max_size),
+                413,
             )
-        except Exception as e:
-            return self.handle_exception(FlaskPyBankIDError(str(e), 500))
-        else:
-            return jsonify(**response)
+        return order_refs
+
+    def _get_batch_pool(self, app):
+        state = self._state(app)
+        if state.batch_pool is None:
+            with state.lock:
+                if state.batch_pool is None:
+                    state.batch_pool = ThreadPool(
+                        app.config.get(self._config_key("BATCH_WORKERS"))
+                    )
+        return state.batch_pool
+
+    def _call_upstream(self, app, operation, tenant, func, *args, **kwargs):
+        """Make a call to BankID for a tenant, or ``None`` for the default
+        settings, recording its latency and guarding it with the admission
+        control, circuit breaker and adaptive timeout of the tenant, if
+        enabled."""
+        admission = self._get_admission_control(app, operation, tenant)
+        if admission:
+            with self._span(app, "admission"):
+                admission.acquire()
+        try:
+            return self._call_guarded(app, operation, tenant, func, *args, **kwargs)
+        finally:
+            if admission:
+                admission.release()
+
+    def _call_guarded(self, app, operation, tenant, func, *args, **kwargs):
+        labels = {"prefix": self.config_prefix, "operation": operation}
+        breaker = self._get_circuit_breaker(app, tenant)
+        if breaker:
+            breaker.before_call()
+        tracker = self._get_latency_tracker(app, operation, tenant)
+        _call_context.timeout = tracker.timeout() if tracker else None
+
+        _metrics.add("pybankid_calls_in_flight", 1, **labels)
+        with self._span(
+            app, "upstream", kind="client", **{"bankid.operation": operation}
+        ) as span:
+            _call_context.traced = span.is_recording()
+            _call_context.http_elapsed = None
+            start = _now()
+            try:
+                response = func(*args, **kwargs)
+            except Exception as e:
+                if breaker:
+                    breaker.record(_now() - start, e)
+                raise
+            else:
+                if breaker:
+                    breaker.record(_now() - start)
+                return response
+            finally:
+                elapsed = _now() - start
+                _call_context.timeout = None
+                _call_context.traced = False
+                if _call_context.http_elapsed is not None:
+                    span.set_attribute(
+                        "bankid.http_seconds", _call_context.http_elapsed
+                    )
+                    span.set_attribute(
+                        "bankid.parse_seconds",
+                        max(elapsed - _call_context.http_elapsed, 0.0),
+                    )
+                if tracker:
+                    tracker.add(elapsed)
+                _metrics.observe("pybankid_call_duration_seconds", elapsed, **labels)
+                _metrics.add("pybankid_calls_in_flight", -1, **labels)
+
+    @property
+    def admission_control(self):
+        """The limiter of authentications and signings for this config
+        prefix and the tenant of the current request, or ``None`` if no
+        limit is set.
+
+        :rtype: :py:class:`~AdmissionControl`
+
+        """
+        return (
+            self._get_admission_control(current_app, "authenticate", self._tenant())
+            or None
+        )
+
+    def _get_admission_control(self, app, operation, tenant=None):
+        if operation not in ("authenticate", "sign"):
+            return False
+        config = app.config
+        rate = config.get(self._config_key("RATE_LIMIT"))
+        max_concurrency = config.get(self._config_key("MAX_CONCURRENCY"))
+        if not rate and not max_concurrency:
+            return False
+        return self._state(app).admission_controls.get(
+            tenant,
+            lambda: AdmissionControl(
+                self.config_prefix,
+                rate=rate,
+                burst=config.get(self._config_key("RATE_BURST")),
+                max_concurrency=max_concurrency,
+                max_queue=config.get(self._config_key("MAX_QUEUE")),
+                queue_timeout=config.get(self._config_key("QUEUE_TIMEOUT")),
+                tenant=tenant,
+            ),
+        )
+
+    @property
+    def circuit_breaker(self):
+        """The circuit breaker guarding calls to BankID for this config
+        prefix and the tenant of the current request, or ``None`` if it is
+        not enabled.
+
+        :rtype: :py:class:`~CircuitBreaker`
+
+        """
+        return self._get_circuit_breaker(current_app, self._tenant()) or None
+
+    def _get_circuit_breaker(self, app, tenant=None):
+        if not app.config.get(self._config_key("CIRCUIT_BREAKER")):
+            return False
+        return self._state(app).circuit_breakers.get(
+            tenant,
+            lambda: CircuitBreaker(
+                self.config_prefix,
+                failure_threshold=app.config.get(
+                    self._config_key("BREAKER_FAILURE_THRESHOLD")
+                ),
+                slow_call_duration=app.config.get(
+                    self._config_key("BREAKER_SLOW_CALL_DURATION")
+                ),
+                reset_timeout=app.config.get(self._config_key("BREAKER_RESET_TIMEOUT")),
+                tenant=tenant,
+            ),
+        )
+
+    def _get_latency_tracker(self, app, operation, tenant=None):
+        if not app.config.get(self._config_key("ADAPTIVE_TIMEOUT")):
+            return False
+        return self._state(app).latency_trackers.get(
+            (operation, tenant),
+            lambda: _LatencyTracker(
+                percentile=app.config.get(self._config_key("TIMEOUT_PERCENTILE")),
+                multiplier=app.config.get(self._config_key("TIMEOUT_MULTIPLIER")),
+                minimum=app.config.get(self._config_key("TIMEOUT_MIN")),
+                maximum=app.config.get(self._config_key("REQUEST_TIMEOUT")) or 30.0,
+            ),
+        )
+
+    def _tracer(self, app):
+        if not app.config.get(self._config_key("TRACING")):
+            return None
+        return app.config.get(self._config_key("TRACER")) or _default_tracer._resolve()
+
+    def _span(self, app, name, kind="internal", **attributes):
+        """A span named ``pybankid.<name>``, or a no-op span if tracing is
+        disabled. Server spans continue the trace of the current request."""
+        tracer = self._tracer(app)
+        if not tracer:
+            return _NOOP_SPAN
+        kwargs = {"attributes": attributes}
+        otel = _opentelemetry._resolve()
+        if otel:
+            trace, propagate = otel
+            kwargs["kind"] = getattr(trace.SpanKind, kind.upper())
+            if kind == "server" and has_request_context():
+                kwargs["context"] = propagate.extract(request.headers)
+        return tracer.start_as_current_span("pybankid." + name, **kwargs)
+
+    def _error_response(self, span, exception):
+        error = _wrap_exception(exception)
+        if span.is_recording():
+            span.set_attribute("bankid.error_class", exception.__class__.__name__)
+            span.set_attribute("http.status_code", error.status_code)
+            span.record_exception(exception)
+            otel = _opentelemetry._resolve()
+            if otel and error.status_code >= 500:
+                span.set_status(otel[0].Status(otel[0].StatusCode.ERROR, error.message))
+        return self.handle_exception(error)
+
+    def _respond(self, response):
+        _count_response(200)
+        if not current_app.config.get(self._config_key("FAST_JSON")):
+            return jsonify(response)
+        body = None
+        status = response.get("progressStatus")
+        if len(response) == 1 and isinstance(status, basestring):
+            body = _pending_bodies.get(status)
+        return Response(body or _dumps(response), mimetype="application/json")
+
+    def _metrics_view(self):
+        return Response(_metrics.render(), content_type=_PROMETHEUS_TYPE)
+
+    def _wait_for_change(self, order_key, wait, last_status=None):
+        """Wait up to `wait` seconds for the status of an order to change.
+
+        With `last_status`, the status the client last saw, a status that
+        already differs from it is returned at once.
+
+        """
+        wait = min(wait, current_app.config.get(self._config_key("COLLECT_MAX_WAIT")))
+        revision, response, error = self.poller.wait(order_key)
+        if not _is_terminal(response, error) and (
+            last_status is None or last_status == _collect_status(response, error)
+        ):
+            revision, response, error = self.poller.wait(order_key, revision, wait)
+        if error is not None:
+            raise error
+        return response
+
+    def _collect_stream(self, order_ref):
+        try:
+            order_key = _order_key(self._tenant(), order_ref)
+        except FlaskPyBankIDError as e:
+            return self.handle_exception(e)
+        poller = self.poller
+        reaper = self._get_reaper(current_app)
+        timeout = current_app.config.get(self._config_key("STREAM_TIMEOUT"))
+
+        def generate():
+            deadline = _now() + timeout
+            revision = None
+            while True:
+                remaining = deadline - _now()
+                if remaining <= 0:
+                    return
+                if reaper:
+                    # The order is not abandoned while it is being streamed.
+                    reaper.seen(order_key)
+                try:
+                    new_revision, response, error = poller.wait(
+                        order_key, revision, min(remaining, 15.0)
+                    )
+                except FlaskPyBankIDError as e:
+                    yield _sse_event("error", dict(e.to_dict(), status=e.status_code))
+                    return
+                if new_revision == revision:
+                    yield ": keep-alive\n\n"
+                    continue
+                revision = new_revision
+                if error is not None:
+                    e = _wrap_exception(error)
+                    yield _sse_event("error", dict(e.to_dict(), status=e.status_code))
+                else:
+                    yield _sse_event("status", response)
+                if _is_terminal(response, error):
+                    return
+
+        return Response(
+            generate(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
     @staticmethod
     def handle_exception(error):
@@ -171,32 +1433,2391 @@ class PyBankID(object):
         :rtype: dict
 
         """
+        _count_response(error.status_code)
         response = jsonify(error.to_dict())
         response.status_code = error.status_code
+        if error.headers:
+            response.headers.extend(error.headers)
         return response
 
 
-class FlaskPyBankIDError(Exception):
-    """An exception wrapper to handle error output to JSON in a simple way."""
+def _create_client(
+    cert_path,
+    key_path,
+    test_server,
+    backend="soap",
+    pool_size=10,
+    api_url=None,
+    request_timeout=None,
+):
+    kwargs = {} if request_timeout is None else {"request_timeout": request_timeout}
+    if backend == "json":
+        client = _JSONClient(
+            (cert_path, key_path),
+            test_server,
+            pool_size=pool_size,
+            api_url=api_url,
+            **kwargs
+        )
+    elif backend == "soap":
+        client = BankIDClient((cert_path, key_path), test_server, **kwargs)
+        transport = getattr(getattr(client, "client", None), "transport", None)
+        if transport is not None:
+            _mount_ssl_context(transport.session, client.certs, client.verify_cert)
+    else:
+        raise ValueError('unknown BankID backend "{0}"'.format(backend))
+    for session in _client_sessions(client):
+        session.hooks["response"].append(_record_http_elapsed)
+    return client
 
-    status_code = 400
 
-    def __init__(self, message, status_code=None, payload=None):
-        Exception.__init__(self)
-        self.message = message
-        if status_code is not None:
-            self.status_code = status_code
-        self.payload = payload
+def _record_http_elapsed(response, *args, **kwargs):
+    """Note the time from sending a request until its response headers were
+    read, i.e. connecting, the TLS handshake and waiting for BankID."""
+    _call_context.http_elapsed = response.elapsed.total_seconds()
 
-    @classmethod
-    def create_from_pybankid_exception(cls, exception):
-        """Class method for initiating from a `PyBankID` exception.
 
-        :param bankid.exceptions.BankIDError exception:
-        :return: The wrapped exception.
-        :rtype: :py:class:`~FlaskPyBankIDError`
+def _trace_headers():
+    """W3C trace context headers of the BankID call being traced, if any."""
+    if not getattr(_call_context, "traced", False):
+        return None
+    otel = _opentelemetry._resolve()
+    if not otel:
+        return None
+    headers = {}
+    otel[1].inject(headers)
+    return headers
 
-        """
+
+def _set_result_attributes(span, response):
+    if span.is_recording():
+        for key in ("orderRef", "progressStatus", "status", "hintCode"):
+            if response.get(key):
+                span.set_attribute("bankid." + _snake_case(key), response[key])
+
+
+_PERSONAL_NUMBER = re.compile(
+    r"^([0-9]{2})?([0-9]{2})([0-9]{2})([0-9]{2})([-+]?)([0-9]{3})([0-9])$"
+)
+_LUHN_DOUBLED = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+
+
+def normalize_personal_number(personal_number, today=None):
+    """Check a Swedish personal or coordination number and return it in the
+    12 digit form ``YYYYMMDDNNNC`` used by BankID.
+
+    Both ``YYYYMMDDNNNC`` and ``YYMMDDNNNC`` are accepted, with or without a
+    separator before the last four digits. The century of 10 digit numbers is
+    the latest one not putting the date in the future, or the one before it
+    if the separator is a ``+``, as for people aged 100 or more.
+
+    :param str personal_number: The personal number to check.
+    :param datetime.date today: The current date; defaults to today.
+    :return: The personal number as 12 digits.
+    :rtype: str
+    :raises ValueError: if the format, date or control digit is invalid.
+
+    """
+    match = _PERSONAL_NUMBER.match(personal_number)
+    if match is None:
+        raise ValueError("Invalid personal number format.")
+    century, year, month, day, separator, serial, control = match.groups()
+    digits = year + month + day + serial
+    checksum = int(control)
+    for i, digit in enumerate(digits):
+        checksum += _LUHN_DOUBLED[int(digit)] if i % 2 == 0 else int(digit)
+    if checksum % 10:
+        raise ValueError("Invalid personal number control digit.")
+
+    today = today or datetime.date.today()
+    day = int(day)
+    if day > 60:
+        day -= 60  # Coordination numbers
+    if century is None:
+        full_year = today.year - (today.year - int(year)) % 100
+        if (full_year, int(month), day) > (today.year, today.month, today.day):
+            full_year -= 100
+        if separator == "+":
+            full_year -= 100
+    else:
+        full_year = int(century + year)
+    try:
+        birth_date = datetime.date(full_year, int(month), day)
+    except ValueError:
+        raise ValueError("Invalid personal number date.")
+    if birth_date > today or full_year < 1800:
+        raise ValueError("Invalid personal number date.")
+    return "{0:04d}{1}{2}{3}{4}".format(
+        full_year, month, match.group(4), serial, control
+    )
+
+
+def _snake_case(name):
+    return re.sub(r"([A-Z])", lambda m: "_" + m.group(1).lower(), name)
+
+
+class _NoopSpan(object):
+    """Stands in for a span, and its context manager, when not tracing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def is_recording(self):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_status(self, status, description=None):
+        pass
+
+    def record_exception(self, exception, attributes=None):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+_DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def _url_is_under(url, base):
+    """Whether `url` has the scheme, host and port of `base`, and a path
+    that is the path of `base` or below it."""
+    try:
+        url, base = urlparse(url), urlparse(base)
+        url_port, base_port = url.port, base.port
+    except ValueError:
+        return False
+    if not base.hostname or url.hostname != base.hostname:
+        return False
+    scheme = base.scheme.lower()
+    if url.scheme.lower() != scheme or scheme not in _DEFAULT_PORTS:
+        return False
+    if (url_port or _DEFAULT_PORTS[scheme]) != (base_port or _DEFAULT_PORTS[scheme]):
+        return False
+    path = url.path or "/"
+    if any(segment in (".", "..") for segment in unquote(path).split("/")):
+        return False
+    return path == (base.path or "/") or path.startswith(base.path.rstrip("/") + "/")
+
+
+def _end_user_ip():
+    if has_request_context() and request.remote_addr:
+        return request.remote_addr
+    return "127.0.0.1"
+
+
+def _define_json_client():
+    class _JSONClient(_bankid.BankIDJSONClient):
+        """A :py:class:`bankid.jsonclient.BankIDJSONClient` that can be used in
+        place of a :py:class:`bankid.client.BankIDClient`.
+
+        The end user IP is taken from the current request, and collect responses
+        are translated to the format of the SOAP API: pending orders are reported
+        in ``progressStatus`` and failed orders raise the same exceptions as the
+        SOAP client does.
+
+        :param certificates: Tuple of string paths to the certificate to use and
+            the key to sign with.
+        :type certificates: tuple
+        :param test_server: Use the test server for authenticating and signing.
+        :type test_server: bool
+        :param pool_size: Maximum number of kept-alive connections.
+        :type pool_size: int
+        :param api_url: Base URL of another RP API v5 server to use, e.g. a
+            local stand-in for benchmarks.
+        :type api_url: str
+
+        """
+
+        def __init__(
+            self, certificates, test_server=False, pool_size=10, api_url=None, **kwargs
+        ):
+            super(_JSONClient, self).__init__(certificates, test_server, **kwargs)
+            if api_url:
+                self.api_url = api_url
+                self._auth_endpoint = urljoin(api_url, "auth")
+                self._sign_endpoint = urljoin(api_url, "sign")
+                self._collect_endpoint = urljoin(api_url, "collect")
+                self._cancel_endpoint = urljoin(api_url, "cancel")
+            _mount_ssl_context(self.client, self.certs, self.verify_cert, pool_size)
+
+        def _post(self, endpoint, *args, **kwargs):
+            timeout = getattr(_call_context, "timeout", None) or getattr(
+                self, "_request_timeout", None
+            )
+            headers = _trace_headers()
+            if headers:
+                kwargs["headers"] = dict(kwargs.get("headers") or {}, **headers)
+            return self.client.post(endpoint, *args, timeout=timeout, **kwargs)
+
+        def authenticate(self, personal_number=None, end_user_ip=None, **kwargs):
+            return super(_JSONClient, self).authenticate(
+                end_user_ip or _end_user_ip(), personal_number, **kwargs
+            )
+
+        def sign(
+            self, user_visible_data, personal_number=None, end_user_ip=None, **kwargs
+        ):
+            return super(_JSONClient, self).sign(
+                end_user_ip or _end_user_ip(),
+                user_visible_data,
+                personal_number,
+                **kwargs
+            )
+
+        def collect(self, order_ref):
+            return _collect_response_from_json(
+                super(_JSONClient, self).collect(order_ref)
+            )
+
+        def _encode_user_data(self, user_data):
+            if isinstance(user_data, _EncodedUserData):
+                return user_data.encoded
+            return super(_JSONClient, self)._encode_user_data(user_data)
+
+    return _JSONClient
+
+
+class _EncodedUserData(object):
+    """Text to sign that has already been base64-encoded."""
+
+    __slots__ = ("encoded",)
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+
+def _read_request_body(max_bytes=None):
+    """The body of the current request as a :class:`bytearray`, decompressed
+    if it is gzip-encoded.
+
+    :raises FlaskPyBankIDError: with status 413 if the body is larger than
+        `max_bytes`, or 400 or 415 if it is empty or cannot be decoded.
+
+    """
+    encoding = request.headers.get("Content-Encoding", "identity").lower()
+    too_large = FlaskPyBankIDError(
+        "The request body is larger than {0} bytes.".format(max_bytes), 413
+    )
+    if encoding == "identity":
+        if max_bytes and (request.content_length or 0) > max_bytes:
+            raise too_large
+        decompressor = None
+    elif encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    else:
+        raise FlaskPyBankIDError(
+            'Unsupported Content-Encoding "{0}".'.format(encoding), 415
+        )
+
+    # A body of known length, which is within max_bytes, is read straight
+    # into a buffer of its size.
+    if decompressor is None and request.content_length and max_bytes:
+        body = _read_into(bytearray(request.content_length))
+        if not body:
+            raise FlaskPyBankIDError("The request body is empty.", 400)
+        return body
+
+    # Read, and decompress, the body a chunk at a time, so that neither a
+    # body without Content-Length nor a small compressed one can take up
+    # more than max_bytes in memory.
+    body = bytearray()
+    try:
+        while True:
+            chunk = request.stream.read(65536)
+            if not chunk:
+                break
+            if decompressor is not None:
+                chunk = decompressor.decompress(
+                    chunk, max_bytes + 1 - len(body) if max_bytes else 0
+                )
+            body += chunk
+            if max_bytes and len(body) > max_bytes:
+                raise too_large
+        if decompressor is not None:
+            body += decompressor.flush()
+    except zlib.error:
+        raise FlaskPyBankIDError("Could not decompress the request body.", 400)
+    if max_bytes and len(body) > max_bytes:
+        raise too_large
+    if not body:
+        raise FlaskPyBankIDError("The request body is empty.", 400)
+    return body
+
+
+def _read_into(body):
+    """Fill `body` from the stream of the current request, and cut it short
+    if the stream ends first."""
+    view = memoryview(body)
+    size = 0
+    while size < len(body):
+        chunk = request.stream.read(min(65536, len(body) - size))
+        if not chunk:
+            break
+        view[size : size + len(chunk)] = chunk
+        size += len(chunk)
+    del view  # a bytearray cannot be resized while it is viewed
+    del body[size:]
+    return body
+
+
+def _decode_body(body):
+    """The text of a UTF-8 encoded request body.
+
+    :raises FlaskPyBankIDError: with status 400 if it is not UTF-8.
+
+    """
+    try:
+        return body.decode("utf-8")
+    except UnicodeDecodeError:
+        raise FlaskPyBankIDError("Could not decode the request body.", 400)
+
+
+_JSONClient = _Lazy(_define_json_client)
+
+
+def _load_ssl_context(certificates, verify_cert):
+    """Create an SSL context holding the client certificate and trusting
+    `verify_cert`, or return ``None`` if the certificate or key is missing.
+
+    """
+    if not all(path and os.path.isfile(path) for path in certificates):
+        return None
+    context = ssl.create_default_context(cafile=verify_cert)
+    context.load_cert_chain(*certificates)
+    return context
+
+
+def _mount_ssl_context(session, certificates, verify_cert, pool_size=10):
+    """Have `session` connect with one shared SSL context, so that the
+    certificate and key files are not read again for each new connection.
+
+    """
+    adapter = _SSLContextAdapter(
+        _load_ssl_context(certificates, verify_cert),
+        pool_connections=1,
+        pool_maxsize=pool_size,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+
+class _SSLContextAdapter(HTTPAdapter):
+    """A transport adapter opening all connections with `ssl_context`.
+
+    The certificate and CA paths given by the session are then ignored, as
+    they are already loaded into the context. Without a context, it works
+    like a plain :py:class:`requests.adapters.HTTPAdapter`.
+
+    """
+
+    def __init__(self, ssl_context=None, **kwargs):
+        self.ssl_context = ssl_context
+        super(_SSLContextAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+        return super(_SSLContextAdapter, self).init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+        return super(_SSLContextAdapter, self).proxy_manager_for(*args, **kwargs)
+
+    def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super(
+            _SSLContextAdapter, self
+        ).build_connection_pool_key_attributes(request, verify, cert)
+        if self.ssl_context is not None:
+            for key in ("ca_certs", "ca_cert_dir", "cert_file", "key_file"):
+                pool_kwargs.pop(key, None)
+        return host_params, pool_kwargs
+
+    def cert_verify(self, conn, url, verify, cert):
+        super(_SSLContextAdapter, self).cert_verify(conn, url, verify, cert)
+        if self.ssl_context is not None:
+            conn.ca_certs = conn.ca_cert_dir = None
+            conn.cert_file = conn.key_file = None
+
+
+def _file_signature(path):
+    """The inode, size and modification time of the file at `path`."""
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime
+
+
+class _CertificateWatcher(object):
+    """Detects replaced or modified certificate and key files.
+
+    The files are looked up with :py:func:`os.stat` at most once every
+    `interval` seconds; in between, the last signature is returned.
+
+    """
+
+    def __init__(self):
+        self._paths = None
+        self._checked = None
+        self._signature = None
+
+    def signature(self, paths, interval=1.0):
+        now = _now()
+        if (
+            paths == self._paths
+            and self._checked is not None
+            and (interval is None or now - self._checked < interval)
+        ):
+            return self._signature
+        signature = tuple(_file_signature(path) for path in paths)
+        if paths == self._paths and signature != self._signature:
+            log.info("BankID certificate files %s changed, reloading.", paths)
+        self._paths, self._checked, self._signature = paths, now, signature
+        return signature
+
+
+def _progress_status(hint_code):
+    """Translate e.g. ``userSign`` to ``USER_SIGN``."""
+    return re.sub(r"([A-Z])", r"_\1", hint_code or "").upper()
+
+
+def _collect_response_from_json(response):
+    status = response.get("status")
+    if status == "complete":
+        data = response.get("completionData", {})
+        user = data.get("user", {})
+        return {
+            "progressStatus": "COMPLETE",
+            "signature": data.get("signature"),
+            "ocspResponse": data.get("ocspResponse"),
+            "userInfo": {
+                "personalNumber": user.get("personalNumber"),
+                "name": user.get("name"),
+                "givenName": user.get("givenName"),
+                "surname": user.get("surname"),
+                "ipAddress": data.get("device", {}).get("ipAddress"),
+                "notBefore": data.get("cert", {}).get("notBefore"),
+                "notAfter": data.get("cert", {}).get("notAfter"),
+            },
+        }
+    elif status == "failed":
+        code = _progress_status(response.get("hintCode"))
+        raise _failed_hint_to_exception_class.get(code, exceptions.BankIDError)(
+            "{0}: Collect of order {1} failed.".format(code, response.get("orderRef"))
+        )
+    return {"progressStatus": _progress_status(response.get("hintCode"))}
+
+
+class _ClientRegistry(object):
+    """Process-wide store of BankID clients, keyed by config prefix.
+
+    A client is only rebuilt when the settings it was created with change.
+    All access is guarded by a lock, so it can be shared between threads;
+    clients are built outside of it, under a lock of their own key, so that
+    building one client does not hold up the others.
+
+    If `max_size` is given, the least recently used clients beyond it are
+    closed and dropped, as are clients unused for `idle_timeout` seconds.
+
+    """
+
+    def __init__(self, max_size=None, idle_timeout=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.builds = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._clients = OrderedDict()
+        self._stats = {}
+        self._building = {}
+
+    def __len__(self):
+        return len(self._clients)
+
+    def get(self, key, settings, factory):
+        with self._lock:
+            client = self._hit(key, settings)
+            if client is not None:
+                return client
+            build_lock = self._building.setdefault(key, threading.Lock())
+        with build_lock:
+            with self._lock:
+                client = self._hit(key, settings)
+                if client is not None:
+                    return client
+                stats = self._stats.setdefault(
+                    key, {"hits": 0, "misses": 0, "builds": 0}
+                )
+                stats["misses"] += 1
+            client = factory()
+            with self._lock:
+                stats = self._stats.setdefault(
+                    key, {"hits": 0, "misses": 0, "builds": 0}
+                )
+                stats["builds"] += 1
+                self.builds += 1
+                _metrics.add("pybankid_client_builds_total", 1, prefix=key)
+                now = _now()
+                self._clients.pop(key, None)
+                self._clients[key] = (settings, client, now)
+                self._evict(now)
+            return client
+
+    def _hit(self, key, settings):
+        entry = self._clients.get(key)
+        if entry is None or entry[0] != settings:
+            return None
+        now = _now()
+        self._stats[key]["hits"] += 1
+        del self._clients[key]
+        self._clients[key] = (settings, entry[1], now)
+        self._evict(now)
+        return entry[1]
+
+    def _evict(self, now):
+        while self._clients:
+            key, (_, client, used) = next(iter(self._clients.items()))
+            idle = self.idle_timeout is not None and now - used > self.idle_timeout
+            if not idle and (self.max_size is None or len(self) <= self.max_size):
+                return
+            del self._clients[key]
+            self._stats.pop(key, None)
+            self._building.pop(key, None)
+            self.evictions += 1
+            for session in _client_sessions(client):
+                session.close()
+
+    def discard(self, key):
+        with self._lock:
+            self._clients.pop(key, None)
+
+    def after_fork(self):
+        """Keep the clients in a forked child process, but not the
+        connections they opened in the parent."""
+        self._lock = threading.Lock()
+        self._building = {}
+        for _, client, _ in self._clients.values():
+            for session in _client_sessions(client):
+                session.close()
+
+    def stats(self, key):
+        with self._lock:
+            return dict(self._stats.get(key, {"hits": 0, "misses": 0, "builds": 0}))
+
+
+_client_registry = _ClientRegistry()
+
+_ENDPOINTS = frozenset(
+    (
+        "_authenticate",
+        "_sign",
+        "_collect",
+        "_collect_batch",
+        "_collect_stream",
+        "_cancel",
+    )
+)
+
+
+def _order_key(tenant, order_ref):
+    """Identifies an order of a tenant, or of the default settings."""
+    return order_ref if tenant is None else "{0}/{1}".format(tenant, order_ref)
+
+
+def _split_order_key(order_key):
+    tenant, _, order_ref = order_key.rpartition("/")
+    return tenant or None, order_ref
+
+
+def _client_sessions(client):
+    """The :py:class:`requests.Session` objects that `client` connects with."""
+    session = getattr(client, "client", None)
+    if hasattr(session, "mount"):
+        return [session]
+    transport = getattr(session, "transport", None)
+    if hasattr(getattr(transport, "session", None), "mount"):
+        return [transport.session]
+    return []
+
+
+class Metrics(object):
+    """Process-wide counters, gauges and histograms of Flask-PyBankID.
+
+    Every metric is identified by a name and a set of labels. The metrics
+    can be read with :meth:`get` and rendered in the Prometheus text format
+    with :meth:`render`.
+
+    """
+
+    #: Upper bounds, in seconds, of the latency histogram buckets.
+    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._histograms = {}
+
+    def add(self, name, value=1, **labels):
+        """Add `value` to a counter or gauge."""
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge to `value`."""
+        key = _metric_key(name, labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        """Record `value` in a histogram."""
+        key = _metric_key(name, labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def get(self, name, **labels):
+        """Return the value of a counter or gauge, or the ``(count, sum)`` of
+        a histogram."""
+        key = _metric_key(name, labels)
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][-1], self._histograms[key][-2]
+            return self._values.get(key, 0)
+
+    def reset(self):
+        """Remove all recorded metrics."""
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format.
+
+        :rtype: str
+
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted((k, list(v)) for k, v in self._histograms.items())
+        lines = []
+        for (name, labels), value in values:
+            if not lines or not lines[-1].startswith(name + "{"):
+                kind = "counter" if name.endswith("_total") else "gauge"
+                lines.append("# TYPE {0} {1}".format(name, kind))
+            lines.append("{0}{1} {2}".format(name, _format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if not lines or not lines[-1].startswith(name + "_count"):
+                lines.append("# TYPE {0} histogram".format(name))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram[:-2]):
+                cumulative += count
+                lines.append(
+                    "{0}_bucket{1} {2}".format(
+                        name, _format_labels(labels + (("le", str(bound)),)), cumulative
+                    )
+                )
+            lines.append(
+                "{0}_sum{1} {2}".format(name, _format_labels(labels), histogram[-2])
+            )
+            lines.append(
+                "{0}_count{1} {2}".format(name, _format_labels(labels), histogram[-1])
+            )
+        return "\n".join(lines) + "\n"
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{0}}}".format(
+        ",".join('{0}="{1}"'.format(k, v.replace('"', '\\"')) for k, v in labels)
+    )
+
+
+def _count_response(status_code):
+    endpoint = request.endpoint if has_request_context() else None
+    _metrics.add(
+        "pybankid_responses_total", 1, endpoint=endpoint or "", status=status_code
+    )
+
+
+_metrics = Metrics()
+
+log = logging.getLogger(__name__)
+
+_call_context = threading.local()
+
+
+class _Registry(object):
+    """Lock-guarded map of lazily created objects."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, key, factory):
+        item = self._items.get(key)
+        if item is None:
+            with self._lock:
+                item = self._items.get(key)
+                if item is None:
+                    item = self._items[key] = factory()
+        return item
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def after_fork(self):
+        """Start afresh in a forked child process."""
+        self._lock = threading.Lock()
+        self._items.clear()
+
+
+def _is_failure(error):
+    """Whether an error means that BankID is failing, rather than that the
+    request or the order was refused."""
+    if error is None:
+        return False
+    return not isinstance(error, exceptions.BankIDError) or isinstance(
+        error,
+        (exceptions.RetryError, exceptions.InternalError, exceptions.MaintenanceError),
+    )
+
+
+class CircuitBreaker(object):
+    """Fails calls fast while BankID appears to be down.
+
+    The breaker opens when `failure_threshold` calls in a row have failed,
+    or have taken more than `slow_call_duration` seconds. While open, calls
+    are refused with status 503. After `reset_timeout` seconds, one probe
+    call is let through: the breaker closes if it succeeds and opens again
+    otherwise.
+
+    State changes are logged, and the current state is kept in the
+    ``pybankid_circuit_state`` metric (0 closed, 1 half open, 2 open).
+
+    :param str name: Name of the breaker, i.e. the config prefix.
+    :param str tenant: Tenant whose calls the breaker guards, if any; added
+        as a ``tenant`` label to its metrics.
+    :param int failure_threshold: Failures in a row that open the breaker.
+    :param float slow_call_duration: Seconds after which a call counts as failed.
+    :param float reset_timeout: Seconds before a probe call is let through.
+
+    """
+
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+    _state_values = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(
+        self,
+        name,
+        failure_threshold=5,
+        slow_call_duration=10.0,
+        reset_timeout=30.0,
+        tenant=None,
+    ):
+        self.name = name
+        self.tenant = tenant
+        self._labels = _tenant_labels(name, tenant)
+        self.failure_threshold = failure_threshold
+        self.slow_call_duration = slow_call_duration
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Check whether a call may be made.
+
+        :raises FlaskPyBankIDError: with status 503 if the breaker is open.
+
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                if _now() - self.opened_at < self.reset_timeout:
+                    raise self._open_error()
+                self._set_state(self.HALF_OPEN)
+            if self._probing:
+                raise self._open_error()
+            self._probing = True
+
+    def record(self, duration, error=None):
+        """Record the outcome of a call.
+
+        :param float duration: Seconds the call took.
+        :param Exception error: The error raised by the call, if any.
+
+        """
+        failed = _is_failure(error) or (
+            self.slow_call_duration is not None and duration > self.slow_call_duration
+        )
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                if failed:
+                    self._open()
+                else:
+                    self.failures = 0
+                    self._set_state(self.CLOSED)
+            elif failed:
+                self.failures += 1
+                if (
+                    self.state == self.CLOSED
+                    and self.failures >= self.failure_threshold
+                ):
+                    self._open()
+            else:
+                self.failures = 0
+
+    def _open(self):
+        self.opened_at = _now()
+        self._set_state(self.OPEN)
+
+    def _set_state(self, state):
+        if state != self.state:
+            log.warning(
+                "BankID circuit breaker %s changed from %s to %s",
+                (
+                    self.name
+                    if self.tenant is None
+                    else "{0}/{1}".format(self.name, self.tenant)
+                ),
+                self.state,
+                state,
+            )
+            _metrics.add(
+                "pybankid_circuit_transitions_total", 1, state=state, **self._labels
+            )
+        self.state = state
+        _metrics.set(
+            "pybankid_circuit_state", self._state_values[state], **self._labels
+        )
+
+    def _open_error(self):
+        retry_after = max(self.reset_timeout - (_now() - self.opened_at), 0)
+        return FlaskPyBankIDError(
+            "BankID is unavailable, retry in {0:.0f} seconds.".format(retry_after),
+            503,
+            headers={"Retry-After": _retry_after(retry_after)},
+        )
+
+
+class AdmissionControl(object):
+    """Limits the rate and concurrency of calls to BankID.
+
+    Calls are let through at a rate of `rate` calls per second, in bursts
+    of at most `burst` calls, and at most `max_concurrency` at a time. Up to
+    `max_queue` calls wait at most `queue_timeout` seconds for a running
+    call to finish. All other calls are refused at once with status 429 and
+    a ``Retry-After`` header.
+
+    The number of waiting calls is kept in the
+    ``pybankid_admission_queue_depth`` metric, and refused calls are counted
+    in ``pybankid_admission_rejections_total``.
+
+    :param str name: Name of the limiter, i.e. the config prefix.
+    :param float rate: Calls per second, or ``None`` for no rate limit.
+    :param int burst: Calls that can be made at once after a pause;
+        defaults to `rate`, but at least one.
+    :param int max_concurrency: Calls at a time, or ``None`` for no limit.
+    :param int max_queue: Calls that may wait for a running call to finish.
+    :param float queue_timeout: Seconds a call may wait.
+    :param str tenant: Tenant whose calls are limited, if any; added as a
+        ``tenant`` label to the metrics.
+
+    """
+
+    def __init__(
+        self,
+        name,
+        rate=None,
+        burst=None,
+        max_concurrency=None,
+        max_queue=100,
+        queue_timeout=5.0,
+        tenant=None,
+    ):
+        self.name = name
+        self.tenant = tenant
+        self._labels = _tenant_labels(name, tenant)
+        self.rate = rate
+        self.burst = burst or max(rate or 0, 1)
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue or 0
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self._tokens = self.burst
+        self._updated = _now()
+        self._condition = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """Wait for a call to be let through.
+
+        :raises FlaskPyBankIDError: with status 429 if the call is refused.
+
+        """
+        with self._condition:
+            if self.max_concurrency:
+                self._wait_for_slot()
+            if self.rate:
+                self._refill()
+                if self._tokens < 1:
+                    if self.max_concurrency:
+                        self._release_slot()
+                    raise self._rejection("rate", (1 - self._tokens) / self.rate)
+                self._tokens -= 1
+
+    def release(self):
+        """Mark a call that was let through as finished."""
+        if self.max_concurrency:
+            with self._condition:
+                self._release_slot()
+
+    def _wait_for_slot(self):
+        if self.active >= self.max_concurrency:
+            if self.waiting >= self.max_queue:
+                raise self._rejection("queue_full", 1)
+            deadline = _now() + self.queue_timeout
+            self._set_waiting(1)
+            try:
+                while self.active >= self.max_concurrency:
+                    remaining = deadline - _now()
+                    if remaining <= 0:
+                        raise self._rejection("queue_timeout", 1)
+                    self._condition.wait(remaining)
+            finally:
+                self._set_waiting(-1)
+        self.active += 1
+
+    def _release_slot(self):
+        self.active -= 1
+        self._condition.notify()
+
+    def _set_waiting(self, change):
+        self.waiting += change
+        _metrics.set("pybankid_admission_queue_depth", self.waiting, **self._labels)
+
+    def _refill(self):
+        now = _now()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _rejection(self, reason, retry_after):
+        _metrics.add(
+            "pybankid_admission_rejections_total", 1, reason=reason, **self._labels
+        )
+        return FlaskPyBankIDError(
+            "Too many requests to BankID, retry later.",
+            429,
+            headers={"Retry-After": _retry_after(retry_after)},
+        )
+
+
+def _tenant_labels(prefix, tenant):
+    """Metric labels of the calls of a tenant, or of the default settings."""
+    if tenant is None:
+        return {"prefix": prefix}
+    return {"prefix": prefix, "tenant": tenant}
+
+
+def _retry_after(seconds):
+    """Whole seconds to wait, as a ``Retry-After`` header value."""
+    return str(max(int(math.ceil(seconds)), 1))
+
+
+class _LatencyTracker(object):
+    """Derives a call timeout from a percentile of recent call latencies."""
+
+    def __init__(
+        self, percentile=99, multiplier=3.0, minimum=1.0, maximum=30.0, size=200
+    ):
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.minimum = minimum
+        self.maximum = maximum
+        self._latencies = deque(maxlen=size)
+        self._timeout = maximum
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            if len(self._latencies) >= 20 and len(self._latencies) % 10 == 0:
+                ordered = sorted(self._latencies)
+                index = int(self.percentile / 100.0 * (len(ordered) - 1))
+                self._timeout = min(
+                    max(ordered[index] * self.multiplier, self.minimum), self.maximum
+                )
+
+    def timeout(self):
+        return self._timeout
+
+
+class _RetryBudget(object):
+    """Allows extra calls for at most `ratio` of all calls, after a reserve
+    of `minimum` extra calls."""
+
+    def __init__(self, ratio=0.1, minimum=10):
+        self.ratio = ratio
+        self.capacity = max(minimum, 1)
+        self._tokens = float(minimum)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.capacity)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+def _is_transient(error):
+    """Whether a failed collect may succeed if it is made again."""
+    return _is_failure(error) and not isinstance(error, FlaskPyBankIDError)
+
+
+class _CollectRetrier(object):
+    """Makes collects, retrying transient failures and hedging slow calls.
+
+    Failed collects are made again up to `retries` times, after sleeping a
+    random time of at most `backoff` seconds, doubled for each retry but
+    capped at `backoff_max`. With a `hedge_tracker`, a second collect is sent
+    when the first has not answered within the tracked latency percentile,
+    and the first answer of the two is used. First collects run on a pool of
+    `primary_workers` threads and hedges on a separate pool of
+    `hedge_workers`, so that hedges never hold up first collects. Each retry
+    and hedge is taken from `budget`, to which each collect adds.
+
+    """
+
+    def __init__(
+        self,
+        name,
+        collect,
+        retries=2,
+        backoff=0.1,
+        backoff_max=2.0,
+        budget=None,
+        hedge_tracker=None,
+        hedge_workers=8,
+        primary_workers=32,
+    ):
+        self.name = name
+        self._collect = collect
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.budget = budget or _RetryBudget()
+        self.hedge_tracker = hedge_tracker
+        self._pool = ThreadPool(hedge_workers) if hedge_tracker else None
+        self._primary_pool = ThreadPool(primary_workers) if hedge_tracker else None
+
+    def collect(self, order_ref):
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                if self._pool is not None:
+                    return self._hedged_collect(order_ref)
+                return self._collect(order_ref)
+            except Exception as e:
+                if attempt >= self.retries or not _is_transient(e):
+                    raise
+                if not self.budget.withdraw():
+                    self._count("pybankid_retry_budget_exhausted_total")
+                    raise
+            attempt += 1
+            self._count("pybankid_collect_retries_total")
+            time.sleep(
+                random.uniform(
+                    0, min(self.backoff * 2 ** (attempt - 1), self.backoff_max)
+                )
+            )
+
+    def _hedged_collect(self, order_ref):
+        results = Queue()
+
+        def run(primary):
+            start = _now()
+            try:
+                result = (self._collect(order_ref), None, primary)
+            except Exception as e:
+                result = (None, e, primary)
+            if primary:
+                self.hedge_tracker.add(_now() - start)
+            results.put(result)
+
+        self._primary_pool.apply_async(run, (True,))
+        try:
+            response, error, primary = results.get(timeout=self.hedge_tracker.timeout())
+        except Empty:
+            if self.budget.withdraw():
+                self._count("pybankid_collect_hedges_total")
+                self._pool.apply_async(run, (False,))
+                response, error, primary = results.get()
+                if error is not None:
+                    response, error, primary = results.get()
+                if error is None and not primary:
+                    self._count("pybankid_collect_hedge_wins_total")
+            else:
+                self._count("pybankid_retry_budget_exhausted_total")
+                response, error, primary = results.get()
+        if error is not None:
+            raise error
+        return response
+
+    def _count(self, name):
+        _metrics.add(name, 1, prefix=self.name)
+
+
+_certificate_watchers = _Registry()
+
+_PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _PyBankIDState(object):
+    """Per application state of a :class:`~PyBankID` extension."""
+
+    def __init__(self, extension):
+        self.extension = extension
+        self.lock = threading.Lock()
+        self.poller = None
+        self.cache = None
+        self.cache_stats = {}
+        self.single_flight = None
+        self.order_store = None
+        self.pending_orders = None
+        self.reaper = None
+        self.delivery = None
+        self.batch_pool = None
+        self.retrier = None
+        self.tenant_clients = None
+        self.user_data_cache = None
+        self.admission_controls = _Registry()
+        self.circuit_breakers = _Registry()
+        self.latency_trackers = _Registry()
+        _states.add(self)
+
+    def after_fork(self):
+        """Drop the threads and locks of the parent in a forked child
+        process; the poller and pools are started again on first use."""
+        self.lock = threading.Lock()
+        self.poller = None
+        self.reaper = None
+        self.delivery = None
+        self.single_flight = None
+        self.batch_pool = None
+        self.retrier = None
+        self.admission_controls.after_fork()
+        self.circuit_breakers.after_fork()
+        self.latency_trackers.after_fork()
+        for shared in (
+            self.cache,
+            self.order_store,
+            self.pending_orders,
+            self.tenant_clients,
+            self.user_data_cache,
+        ):
+            if shared is not None and shared is not False:
+                shared.after_fork()
+
+
+_states = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    """Reset the state that must not be shared with the parent process:
+    open connections, threads, which do not survive a fork, and locks,
+    which other threads of the parent may have held while forking."""
+    for lazy in (
+        _bankid,
+        exceptions,
+        BankIDClient,
+        _JSONClient,
+        _exception_class_to_status_code,
+        _failed_hint_to_exception_class,
+        _opentelemetry,
+        _default_tracer,
+    ):
+        lazy._lock = threading.Lock()
+    _client_registry.after_fork()
+    _metrics._lock = threading.Lock()
+    _certificate_watchers.after_fork()
+    for state in list(_states):
+        state.after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+_now = getattr(time, "monotonic", time.time)
+
+
+def _is_terminal(response, error):
+    """Whether a collect result is final, i.e. need not be collected again.
+
+    Only completed orders and errors saying that the order has failed or does
+    not exist are final; anything else, e.g. maintenance, may pass.
+
+    """
+    if error is None:
+        return response.get("progressStatus") == "COMPLETE"
+    return isinstance(
+        error,
+        tuple(_failed_hint_to_exception_class.values())
+        + (exceptions.InvalidParametersError,),
+    )
+
+
+def _same_collect_result(a, b):
+    (response_a, error_a), (response_b, error_b) = a, b
+    if error_a is not None or error_b is not None:
+        return type(error_a) is type(error_b) and str(error_a) == str(error_b)
+    return response_a == response_b
+
+
+class _PolledOrder(object):
+    __slots__ = (
+        "response",
+        "error",
+        "version",
+        "revision",
+        "terminal",
+        "next_poll",
+        "last_seen",
+        "in_flight",
+        "callbacks",
+    )
+
+    def __init__(self, now):
+        self.in_flight = False
+        self.callbacks = None
+        self.response = None
+        self.error = None
+        self.version = 0
+        self.revision = 0
+        self.terminal = False
+        self.next_poll = now
+        self.last_seen = now
+
+
+class _CollectPoller(object):
+    """Collects the status of pending orders in the background.
+
+    Each order is collected once per `interval`, however many callers ask
+    for its status, and not at all once it has reached a terminal status.
+    A slow collect only delays the next collect of its own order.
+    Orders are forgotten `retention` seconds after their status was last
+    asked for.
+
+    :param collect: Callable collecting an order given its ``orderRef``.
+    :param float interval: Seconds between collects of an order.
+    :param float retention: Seconds to keep orders nobody asks for.
+    :param int workers: Number of threads collecting in parallel.
+    :param seen: Callable called with the ``orderRef`` of each order that is
+        collected because a callback waits for it, as nobody else may be
+        asking for its status.
+
+    """
+
+    def __init__(self, collect, interval=2.0, retention=60.0, workers=4, seen=None):
+        self._collect = collect
+        self._seen = seen
+        self.interval = interval
+        self.retention = retention
+        self.workers = workers
+        self.upstream_calls = 0
+        self._condition = threading.Condition()
+        self._orders = {}
+        self._thread = None
+        self._pool = None
+        self._stopped = False
+
+    def status(self, order_ref, timeout=30.0):
+        """Return the latest collect result of an order, waiting for the
+        first one if the order is new.
+
+        :param str order_ref: The ``orderRef`` of the order.
+        :param float timeout: Maximum number of seconds to wait.
+        :return: The collect response.
+        :rtype: dict
+        :raises BankIDError: the error of the latest collect, if any.
+
+        """
+        revision, response, error = self.wait(order_ref, timeout=timeout)
+        if error is not None:
+            raise error
+        return response
+
+    def wait(self, order_ref, revision=None, timeout=30.0):
+        """Wait until the status of an order differs from the one with the
+        given `revision`, or until `timeout` seconds have passed.
+
+        The status of an order that is complete or has failed is returned
+        at once.
+
+        :param str order_ref: The ``orderRef`` of the order.
+        :param int revision: The revision of the last known status.
+        :param float timeout: Maximum number of seconds to wait.
+        :return: A tuple of the revision, the collect response and the
+            collect error of the latest status of the order.
+        :rtype: tuple
+
+        """
+        if not timeout >= 0:
+            timeout = 0.0
+        with self._condition:
+            deadline = _now() + timeout
+            while True:
+                order = self._watch(order_ref)
+                if order.version and (order.revision != revision or order.terminal):
+                    break
+                remaining = deadline - _now()
+                if remaining <= 0:
+                    if order.version:
+                        break
+                    raise FlaskPyBankIDError(
+                        "Timed out waiting for collect of {0}".format(order_ref), 504
+                    )
+                self._condition.wait(min(remaining, self.interval))
+            response = None if order.response is None else dict(order.response)
+            return order.revision, response, order.error
+
+    def subscribe(self, order_ref, callback, key=None):
+        """Call `callback` with the collect response and error of an order
+        once it is complete or has failed. The order is polled until then,
+        whether or not its status is asked for.
+
+        :param str order_ref: The ``orderRef`` of the order.
+        :param callback: Function called with the response and the error.
+        :param key: Identifies the callback; a callback with the same key as
+            one already subscribed to the order is not added again.
+
+        """
+        with self._condition:
+            order = self._watch(order_ref)
+            if not order.terminal:
+                if order.callbacks is None:
+                    order.callbacks = OrderedDict()
+                order.callbacks.setdefault(
+                    key if key is not None else object(), callback
+                )
+                return
+            response, error = order.response, order.error
+        callback(response, error)
+
+    def stats(self):
+        """Return the number of upstream calls made and of orders polled.
+
+        :rtype: dict
+
+        """
+        with self._condition:
+            return {
+                "upstream_calls": self.upstream_calls,
+                "active_orders": sum(
+                    1 for o in self._orders.values() if not o.terminal
+                ),
+                "orders": len(self._orders),
+            }
+
+    def stop(self):
+        """Stop the polling thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _watch(self, order_ref):
+        order = self._orders.get(order_ref)
+        now = _now()
+        if order is None:
+            order = self._orders[order_ref] = _PolledOrder(now)
+            self._start()
+            self._condition.notify_all()
+        order.last_seen = now
+        return order
+
+    def _start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._pool = ThreadPool(self.workers)
+            self._thread = threading.Thread(
+                target=self._run, name="pybankid-collect-poller"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                now = _now()
+                self._expire(now)
+                pending = [
+                    o
+                    for o in self._orders.values()
+                    if not o.terminal and not o.in_flight
+                ]
+                due = [
+                    ref
+                    for ref, o in self._orders.items()
+                    if not o.terminal and not o.in_flight and o.next_poll <= now
+                ]
+                if not due:
+                    next_poll = min([o.next_poll for o in pending] or [now + 1.0])
+                    self._condition.wait(max(next_poll - now, 0.001))
+                    continue
+                for ref in due:
+                    self._orders[ref].next_poll = now + self.interval
+                    self._orders[ref].in_flight = True
+                for ref in due:
+                    self._pool.apply_async(self._poll, (ref,))
+
+    def _expire(self, now):
+        for ref, order in list(self._orders.items()):
+            if order.last_seen + self.retention < now and not order.callbacks:
+                del self._orders[ref]
+
+    def _poll(self, order_ref):
+        if self._seen is not None:
+            with self._condition:
+                order = self._orders.get(order_ref)
+                subscribed = order is not None and bool(order.callbacks)
+            if subscribed:
+                self._seen(order_ref)
+        response, error = None, None
+        try:
+            response = self._collect(order_ref)
+        except Exception as e:
+            error = e
+        callbacks = None
+        with self._condition:
+            self.upstream_calls += 1
+            order = self._orders.get(order_ref)
+            if order is not None:
+                order.in_flight = False
+                if order.version == 0 or not _same_collect_result(
+                    (order.response, order.error), (response, error)
+                ):
+                    order.revision += 1
+                order.response, order.error = response, error
+                order.terminal = _is_terminal(response, error)
+                order.version += 1
+                if order.terminal and order.callbacks:
+                    callbacks, order.callbacks = order.callbacks, None
+            self._condition.notify_all()
+        for callback in (callbacks or {}).values():
+            callback(response, error)
+
+
+class _CallbackDelivery(object):
+    """Delivers the final results of orders to callbacks in the background.
+
+    Results wait in a bounded queue, and are dropped if it is full. Failed
+    deliveries are retried with exponential backoff and full jitter.
+
+    :param str prefix: Config prefix, used as metric label.
+    :param secret: Key to sign results posted to URLs with.
+    :param int workers: Number of threads delivering results.
+    :param int queue_size: Maximum number of results waiting for delivery.
+    :param int retries: Number of times a failed delivery is retried.
+    :param float backoff: Seconds to wait before the first retry.
+    :param float timeout: Timeout of requests to callback URLs.
+
+    """
+
+    def __init__(
+        self,
+        prefix="PYBANKID",
+        secret=None,
+        workers=2,
+        queue_size=1000,
+        retries=3,
+        backoff=0.5,
+        timeout=5.0,
+    ):
+        self.prefix = prefix
+        if secret is not None and not isinstance(secret, bytes):
+            secret = secret.encode("utf-8")
+        self.secret = secret
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._queue = Queue(queue_size or 0)
+        self._session = None
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._run, name="pybankid-callback-{0}".format(i)
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, callback, order_ref, response, error):
+        """Queue the result of an order for delivery to `callback`."""
+        if error is not None:
+            e = _wrap_exception(error)
+            result = {
+                "orderRef": order_ref,
+                "status": "failed",
+                "error": dict(e.to_dict(), status=e.status_code),
+            }
+        else:
+            result = {
+                "orderRef": order_ref,
+                "status": "complete",
+                "result": response,
+            }
+        try:
+            self._queue.put_nowait((callback, result))
+        except Full:
+            log.warning("Dropped the result of order %s: queue is full", order_ref)
+            self._count("dropped")
+
+    def stats(self):
+        """Return the number of results delivered, failed and dropped.
+
+        :rtype: dict
+
+        """
+        with self._lock:
+            return {
+                "delivered": self.delivered,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+
+    def stop(self):
+        """Deliver the queued results and stop the delivery threads."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _count(self, result):
+        _metrics.add("pybankid_callbacks_total", 1, prefix=self.prefix, result=result)
+        with self._lock:
+            setattr(self, result, getattr(self, result) + 1)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            callback, result = item
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+                try:
+                    self._deliver(callback, result)
+                except Exception as e:
+                    log.debug(
+                        "Could not deliver the result of order %s: %s",
+                        result["orderRef"],
+                        e,
+                    )
+                else:
+                    self._count("delivered")
+                    break
+            else:
+                self._count("failed")
+
+    def _deliver(self, callback, result):
+        if callable(callback):
+            callback(result["orderRef"], result)
+            return
+        body = _dumps(result)
+        headers = {"Content-Type": "application/json"}
+        if self.secret is not None:
+            headers["X-PyBankID-Signature"] = "sha256=" + (
+                hmac.new(self.secret, body, hashlib.sha256).hexdigest()
+            )
+        if self._session is None:
+            self._session = requests.Session()
+        response = self._session.post(
+            callback,
+            data=body,
+            headers=headers,
+            timeout=self.timeout,
+            allow_redirects=False,
+        )
+        if not 200 <= response.status_code < 300:
+            raise FlaskPyBankIDError(
+                "Callback answered with status {0}".format(response.status_code),
+                502,
+            )
+
+
+class _OrderReaper(object):
+    """Cancels orders whose status nobody has asked for in a while, so
+    that abandoned orders do not keep their users from starting new ones.
+
+    :param cancel: Callable cancelling an order given its ``orderRef``.
+    :param str prefix: Config prefix, used as metric label.
+    :param float timeout: Seconds after which an order nobody has asked
+        for is cancelled.
+    :param int batch_size: Maximum number of orders cancelled at a time.
+    :param int workers: Number of threads cancelling in parallel.
+    :param last_seen: Callable returning when the status of an order was
+        last asked for in other processes, as a UNIX timestamp, ``None`` if
+        that is not known, or ``False`` if the order has finished. Orders
+        seen elsewhere within `timeout` are checked again a `timeout` later.
+
+    """
+
+    def __init__(
+        self,
+        cancel,
+        prefix="PYBANKID",
+        timeout=60.0,
+        batch_size=100,
+        workers=4,
+        last_seen=None,
+    ):
+        self._cancel = cancel
+        self._last_seen = last_seen
+        self.prefix = prefix
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.workers = workers
+        self.reaped = 0
+        self.failed = 0
+        self._condition = threading.Condition()
+        # Ordered by the time the orders were last seen, oldest first.
+        self._orders = OrderedDict()
+        self._thread = None
+        self._pool = None
+        self._stopped = False
+
+    def add(self, order_ref):
+        """Start watching an order."""
+        with self._condition:
+            self._orders.pop(order_ref, None)
+            self._orders[order_ref] = _now()
+            self._start()
+
+    def seen(self, order_ref):
+        """Note that the status of an order has been asked for."""
+        with self._condition:
+            if self._orders.pop(order_ref, None) is not None:
+                self._orders[order_ref] = _now()
+
+    def forget(self, order_ref):
+        """Stop watching an order, e.g. because it has finished."""
+        with self._condition:
+            self._orders.pop(order_ref, None)
+
+    def stats(self):
+        """Return the number of orders watched, cancelled and failed to be
+        cancelled.
+
+        :rtype: dict
+
+        """
+        with self._condition:
+            return {
+                "orders": len(self._orders),
+                "reaped": self.reaped,
+                "failed": self.failed,
+            }
+
+    def stop(self):
+        """Stop the reaping thread."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+
+    def _start(self):
+        if self._thread is None:
+            self._stopped = False
+            self._pool = ThreadPool(self.workers)
+            self._thread = threading.Thread(
+                target=self._run, name="pybankid-order-reaper"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                now = _now()
+                due = []
+                for order_ref, last_seen in self._orders.items():
+                    if last_seen + self.timeout > now or len(due) >= self.batch_size:
+                        break
+                    due.append(order_ref)
+                if not due:
+                    oldest = next(iter(self._orders.values()), now)
+                    self._condition.wait(max(oldest + self.timeout - now, 0.001))
+                    continue
+                for order_ref in due:
+                    del self._orders[order_ref]
+            self._pool.map(self._reap, due)
+
+    def _reap(self, order_ref):
+        try:
+            last_seen = self._last_seen and self._last_seen(order_ref)
+        except Exception as e:
+            log.debug("Could not look up order %s: %s", order_ref, e)
+            last_seen = None
+        if last_seen is False:
+            return
+        if last_seen is not None and last_seen + self.timeout > time.time():
+            with self._condition:
+                if order_ref not in self._orders:
+                    self._orders[order_ref] = _now()
+                    self._condition.notify_all()
+            return
+        try:
+            self._cancel(order_ref)
+        except Exception as e:
+            log.debug("Could not cancel abandoned order %s: %s", order_ref, e)
+            with self._condition:
+                self.failed += 1
+        else:
+            _metrics.add("pybankid_orders_reaped_total", 1, prefix=self.prefix)
+            with self._condition:
+                self.reaped += 1
+
+
+class _Flight(object):
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _SingleFlight(object):
+    """Lets concurrent calls with the same key share the outcome of one call.
+
+    :param int max_keys: Maximum number of keys in flight at a time. Calls
+        beyond that are made without sharing.
+    :param float timeout: Maximum number of seconds to wait for the outcome
+        of a call made by another thread.
+
+    """
+
+    def __init__(self, max_keys=10000, timeout=30.0):
+        self.max_keys = max_keys
+        self.timeout = timeout
+        self.issued = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, func):
+        """Call `func`, or wait for the outcome of the ongoing call for `key`.
+
+        :param str key: Identifies calls that can share their outcome.
+        :param func: Callable without arguments.
+        :return: The return value of the call.
+        :raises: The exception raised by the call, if any.
+
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                self.issued += 1
+                leader = True
+                if len(self._flights) < self.max_keys:
+                    flight = self._flights[key] = _Flight()
+
+        if flight is None:
+            return func()
+        elif leader:
+            try:
+                flight.result = func()
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.event.set()
+        elif not flight.event.wait(self.timeout):
+            raise FlaskPyBankIDError(
+                "Timed out waiting for concurrent call for {0}".format(key), 504
+            )
+
+        if flight.error is not None:
+            raise flight.error
+        if isinstance(flight.result, dict):
+            return dict(flight.result)
+        return flight.result
+
+    def stats(self):
+        """Return the number of calls made and of calls that were shared.
+
+        :rtype: dict
+
+        """
+        with self._lock:
+            return {"issued": self.issued, "coalesced": self.coalesced}
+
+
+def _dumps(data):
+    """Serialize `data` to compact JSON bytes, with orjson if installed."""
+    if orjson is not None:
+        return orjson.dumps(data, default=str)
+    return json.dumps(data, separators=(",", ":"), default=str).encode("utf-8")
+
+
+#: Ready-made bodies of the pending collect results seen most often.
+_pending_bodies = dict(
+    (status, _dumps({"progressStatus": status}))
+    for status in (
+        "OUTSTANDING_TRANSACTION",
+        "NO_CLIENT",
+        "STARTED",
+        "USER_SIGN",
+        "USER_REQ",
+        "",
+    )
+)
+
+
+def _sse_event(event, data):
+    return "event: {0}\ndata: {1}\n\n".format(event, json.dumps(data, default=str))
+
+
+def _wrap_exception(error):
+    if isinstance(error, FlaskPyBankIDError):
+        return error
+    elif isinstance(error, exceptions.BankIDError):
+        return FlaskPyBankIDError.create_from_pybankid_exception(error)
+    return FlaskPyBankIDError(str(error), 500)
+
+
+def _encode_collect_result(response, error):
+    if error is not None:
+        return json.dumps(
+            {"error": {"class": error.__class__.__name__, "message": str(error)}}
+        )
+    return json.dumps({"response": response}, default=str)
+
+
+def _decode_collect_result(data):
+    result = json.loads(data)
+    if "error" in result:
+        error_class = getattr(exceptions, result["error"]["class"], None)
+        if not isinstance(error_class, type) or not issubclass(
+            error_class, exceptions.BankIDError
+        ):
+            error_class = exceptions.BankIDError
+        raise error_class(result["error"]["message"])
+    return result["response"]
+
+
+def _collect_status(response, error):
+    if error is not None:
+        return error.__class__.__name__
+    return response.get("progressStatus")
+
+
+def _create_order_store(setting, retention):
+    if setting is None:
+        return False
+    elif setting == "memory":
+        return MemoryOrderStore(retention)
+    elif hasattr(setting, "startswith") and setting.startswith("sqlite:///"):
+        return SQLiteOrderStore(setting[len("sqlite:///") :], retention)
+    elif isinstance(setting, OrderStore):
+        return setting
+    raise ValueError('unknown order store "{0}"'.format(setting))
+
+
+class OrderStore(object):
+    """Base class for stores of BankID orders.
+
+    An order is recorded as a dictionary with the keys ``orderRef``,
+    ``operation``, ``started`` and ``updated`` (UNIX timestamps),
+    ``status`` (the last ``progressStatus`` or error name), ``result`` (the
+    encoded last collect result, or ``None``) and ``terminal`` (whether the
+    order is complete or has failed).
+
+    :param float retention: Seconds to keep orders after their last update.
+
+    """
+
+    def __init__(self, retention=600.0):
+        self.retention = retention
+
+    def add(self, order_ref, operation):
+        """Record that an order has been started."""
+        raise NotImplementedError()
+
+    def get(self, order_ref):
+        """Return the record of an order, or ``None`` if it is unknown."""
+        raise NotImplementedError()
+
+    def update(self, order_ref, result, status, terminal):
+        """Record the latest collect result of an order."""
+        raise NotImplementedError()
+
+    def acquire_poll(self, order_ref, interval):
+        """Claim the right to collect an order for the next `interval`
+        seconds.
+
+        :return: ``True`` if no one else has collected or claimed the order
+            within the last `interval` seconds.
+        :rtype: bool
+
+        """
+        raise NotImplementedError()
+
+    def seen(self, order_ref):
+        """Record that the status of an order has been asked for. By
+        default, nothing is recorded."""
+
+    def last_seen(self, order_ref):
+        """Return when the status of an order was last asked for, as a UNIX
+        timestamp, or ``None`` if it is not known."""
+        return None
+
+    def after_fork(self):
+        """Called in forked child processes, to reopen connections and
+        replace locks that must not be shared with the parent."""
+
+    @staticmethod
+    def _record(order_ref, operation=None, started=None):
+        now = time.time()
+        return {
+            "orderRef": order_ref,
+            "operation": operation,
+            "started": started or now,
+            "updated": now,
+            "status": None,
+            "result": None,
+            "terminal": False,
+        }
+
+
+class MemoryOrderStore(OrderStore):
+    """Order store in process memory."""
+
+    def __init__(self, retention=600.0):
+        super(MemoryOrderStore, self).__init__(retention)
+        self._orders = {}
+        self._next_poll = {}
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._next_purge = time.time() + retention
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def add(self, order_ref, operation):
+        with self._lock:
+            self._purge()
+            self._orders[order_ref] = self._record(order_ref, operation)
+
+    def get(self, order_ref):
+        with self._lock:
+            record = self._orders.get(order_ref)
+            if record is None or record["updated"] + self.retention < time.time():
+                return None
+            return dict(record)
+
+    def update(self, order_ref, result, status, terminal):
+        with self._lock:
+            record = self._orders.get(order_ref)
+            if record is None:
+                record = self._orders[order_ref] = self._record(order_ref)
+            record.update(
+                updated=time.time(), result=result, status=status, terminal=terminal
+            )
+
+    def acquire_poll(self, order_ref, interval):
+        now = time.time()
+        with self._lock:
+            if self._next_poll.get(order_ref, 0) > now:
+                return False
+            self._next_poll[order_ref] = now + interval
+            return True
+
+    def seen(self, order_ref):
+        with self._lock:
+            self._seen[order_ref] = time.time()
+
+    def last_seen(self, order_ref):
+        with self._lock:
+            return self._seen.get(order_ref)
+
+    def _purge(self):
+        now = time.time()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + self.retention
+        for order_ref, record in list(self._orders.items()):
+            if record["updated"] + self.retention < now:
+                del self._orders[order_ref]
+        for order_ref, next_poll in list(self._next_poll.items()):
+            if next_poll < now and order_ref not in self._orders:
+                del self._next_poll[order_ref]
+        for order_ref, seen in list(self._seen.items()):
+            if seen + self.retention < now:
+                del self._seen[order_ref]
+
+
+class SQLiteOrderStore(OrderStore):
+    """Order store in an SQLite database, which can be shared between the
+    processes of one host.
+
+    :param str path: Path of the database file.
+    :param float retention: Seconds to keep orders after their last update.
+
+    """
+
+    def __init__(self, path, retention=600.0):
+        super(SQLiteOrderStore, self).__init__(retention)
+        self.path = path
+        self.after_fork()
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS pybankid_orders ("
+            "order_ref TEXT PRIMARY KEY, operation TEXT, started REAL, "
+            "updated REAL, status TEXT, result TEXT, terminal INTEGER, "
+            "next_poll REAL DEFAULT 0, seen REAL)"
+        )
+        try:
+            self._connection.execute("ALTER TABLE pybankid_orders ADD COLUMN seen REAL")
+        except sqlite3.OperationalError:
+            pass  # The column exists.
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=10.0
+        )
+
+    def add(self, order_ref, operation):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM pybankid_orders WHERE updated < ?", (now - self.retention,)
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO pybankid_orders "
+                "(order_ref, operation, started, updated, terminal) "
+                "VALUES (?, ?, ?, ?, 0)",
+                (order_ref, operation, now, now),
+            )
+
+    def get(self, order_ref):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT operation, started, updated, status, result, terminal "
+                "FROM pybankid_orders WHERE order_ref = ? AND updated >= ?",
+                (order_ref, time.time() - self.retention),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "orderRef": order_ref,
+            "operation": row[0],
+            "started": row[1],
+            "updated": row[2],
+            "status": row[3],
+            "result": row[4],
+            "terminal": bool(row[5]),
+        }
+
+    def update(self, order_ref, result, status, terminal):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO pybankid_orders "
+                "(order_ref, started, updated, terminal) VALUES (?, ?, ?, 0)",
+                (order_ref, now, now),
+            )
+            self._connection.execute(
+                "UPDATE pybankid_orders SET updated = ?, result = ?, status = ?, "
+                "terminal = ? WHERE order_ref = ?",
+                (now, result, status, int(terminal), order_ref),
+            )
+
+    def acquire_poll(self, order_ref, interval):
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO pybankid_orders "
+                "(order_ref, started, updated, terminal) VALUES (?, ?, ?, 0)",
+                (order_ref, now, now),
+            )
+            cursor = self._connection.execute(
+                "UPDATE pybankid_orders SET next_poll = ? "
+                "WHERE order_ref = ? AND next_poll <= ?",
+                (now + interval, order_ref, now),
+            )
+            return cursor.rowcount == 1
+
+    def seen(self, order_ref):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE pybankid_orders SET seen = ? WHERE order_ref = ?",
+                (time.time(), order_ref),
+            )
+
+    def last_seen(self, order_ref):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT seen FROM pybankid_orders WHERE order_ref = ?", (order_ref,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+
+class RedisOrderStore(OrderStore):
+    """Order store in Redis, which can be shared by a cluster.
+
+    :param redis_client: A client object with the ``get``, ``set`` and
+        ``delete`` methods of :py:class:`redis.Redis`.
+    :param float retention: Seconds to keep orders after their last update.
+    :param str prefix: Prefix of all keys written to Redis.
+
+    """
+
+    def __init__(self, redis_client, retention=600.0, prefix="pybankid:order:"):
+        super(RedisOrderStore, self).__init__(retention)
+        self.redis = redis_client
+        self.prefix = prefix
+
+    def _set(self, record):
+        self.redis.set(
+            self.prefix + record["orderRef"],
+            json.dumps(record),
+            px=int(self.retention * 1000),
+        )
+
+    def add(self, order_ref, operation):
+        self._set(self._record(order_ref, operation))
+
+    def get(self, order_ref):
+        value = self.redis.get(self.prefix + order_ref)
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return json.loads(value)
+
+    def update(self, order_ref, result, status, terminal):
+        record = self.get(order_ref) or self._record(order_ref)
+        record.update(
+            updated=time.time(), result=result, status=status, terminal=terminal
+        )
+        self._set(record)
+
+    def acquire_poll(self, order_ref, interval):
+        return bool(
+            self.redis.set(
+                self.prefix + order_ref + ":poll",
+                "1",
+                nx=True,
+                px=max(int(interval * 1000), 1),
+            )
+        )
+
+    def seen(self, order_ref):
+        self.redis.set(
+            self.prefix + order_ref + ":seen",
+            repr(time.time()),
+            px=int(self.retention * 1000),
+        )
+
+    def last_seen(self, order_ref):
+        value = self.redis.get(self.prefix + order_ref + ":seen")
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return float(value)
+
+
+class CollectCache(object):
+    """Base class for caches of collect results.
+
+    Values are strings, and are stored under string keys for a number of
+    seconds. Subclass and implement :meth:`get` and :meth:`set` to use
+    another storage.
+
+    """
+
+    def get(self, key):
+        """Return the value stored under `key`, or ``None`` if there is none
+        or it has expired."""
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl):
+        """Store `value` under `key` for `ttl` seconds."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        """Remove the value stored under `key`, if any. By default, values
+        are left to expire."""
+
+    def after_fork(self):
+        """Called in forked child processes, to reopen connections and
+        replace locks that must not be shared with the parent."""
+
+
+class MemoryCollectCache(CollectCache):
+    """In-process LRU cache of collect results.
+
+    The least recently used entries are evicted when there are more than
+    `max_entries` entries or their values together exceed `max_bytes`.
+
+    :param int max_entries: Maximum number of entries.
+    :param int max_bytes: Maximum total size of the cached values.
+
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=2**24):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= _now():
+                self._remove(key)
+                return None
+            # Move to the most recently used end.
+            del self._entries[key]
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (_now() + ttl, value)
+            self.size += len(value)
+            while self._entries and (
+                len(self._entries) > self.max_entries or self.size > self.max_bytes
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        self.size -= len(self._entries.pop(key)[1])
+
+
+class RedisCollectCache(CollectCache):
+    """Collect result cache stored in Redis, for sharing between processes.
+
+    :param redis_client: A client object with the ``get`` and ``set`` methods
+        of :py:class:`redis.Redis`.
+    :param str prefix: Prefix of all keys written to Redis.
+
+    """
+
+    def __init__(self, redis_client, prefix="pybankid:collect:"):
+        self.redis = redis_client
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        return value
+
+    def set(self, key, value, ttl):
+        self.redis.set(self.prefix + key, value, px=max(int(ttl * 1000), 1))
+
+    def delete(self, key):
+        self.redis.delete(self.prefix + key)
+
+
+class FlaskPyBankIDError(Exception):
+    """An exception wrapper to handle error output to JSON in a simple way."""
+
+    status_code = 400
+
+    def __init__(self, message, status_code=None, payload=None, headers=None):
+        Exception.__init__(self)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
+        self.payload = payload
+        self.headers = headers
+
+    @classmethod
+    def create_from_pybankid_exception(cls, exception):
+        """Class method for initiating from a `PyBankID` exception.
+
+        :param bankid.exceptions.BankIDError exception:
+        :return: The wrapped exception.
+        :rtype: :py:class:`~FlaskPyBankIDError`
+
+        """
         return cls(
             "{0}: {1}".format(exception.__class__.__name__, str(exception)),
             _exception_class_to_status_code.get(exception.__class__),
@@ -209,21 +3830,35 @@ class FlaskPyBankIDError(Exception):
         :rtype: dict
 
         """
-        rv = dict(self.payload or ())
+        if not self.payload:
+            return {"message": self.message}
+        rv = dict(self.payload)
         rv["message"] = self.message
         return rv
 
 
-_exception_class_to_status_code = {
-    exceptions.AlreadyInProgressError: 409,
-    exceptions.AccessDeniedRPError: 403,
-    exceptions.CancelledError: 409,
-    exceptions.UserCancelError: 409,
-    exceptions.CertificateError: 403,
-    exceptions.StartFailedError: 404,
-    exceptions.ExpiredTransactionError: 408,
-    exceptions.ClientError: 500,
-    exceptions.RetryError: 500,
-    exceptions.InternalError: 500,
-    exceptions.InvalidParametersError: 400,
-}
+_exception_class_to_status_code = _Lazy(
+    lambda: {
+        exceptions.AlreadyInProgressError: 409,
+        exceptions.AccessDeniedRPError: 403,
+        exceptions.CancelledError: 409,
+        exceptions.UserCancelError: 409,
+        exceptions.CertificateError: 403,
+        exceptions.StartFailedError: 404,
+        exceptions.ExpiredTransactionError: 408,
+        exceptions.ClientError: 500,
+        exceptions.RetryError: 500,
+        exceptions.InternalError: 500,
+        exceptions.InvalidParametersError: 400,
+    }
+)
+
+_failed_hint_to_exception_class = _Lazy(
+    lambda: {
+        "EXPIRED_TRANSACTION": exceptions.ExpiredTransactionError,
+        "CERTIFICATE_ERR": exceptions.CertificateError,
+        "USER_CANCEL": exceptions.UserCancelError,
+        "CANCELLED": exceptions.CancelledError,
+        "START_FAILED": exceptions.StartFailedError,
+    }
+)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+flask_pybankid_async  -- Asyncio variant of Flask-PyBankID
+==========================================================
+
+Serves the ``/authenticate``, ``/sign`` and ``/collect`` endpoints of
+:class:`flask_pybankid.PyBankID` as an ASGI application, talking to the
+BankID RP API v5 through one shared, non-blocking
+`httpx <https://www.python-httpx.org/>`_ connection pool. A single process
+can thereby keep a large number of BankID calls in flight without tying up
+a worker thread per call.
+
+Requires Python 3 and ``httpx`` (``pip install Flask-PyBankID[async]``).
+
+"""
+
+import asyncio
+import base64
+import json
+import ssl
+
+from urllib.parse import parse_qs, urljoin
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+from bankid import exceptions
+from bankid.exceptions import get_json_error_class
+from pkg_resources import resource_filename
+
+from flask_pybankid import FlaskPyBankIDError, _collect_response_from_json
+
+
+class AsyncBankIDJSONClient(object):
+    """Asyncio client for the BankID RP API v5.
+
+    Has the same call signatures and response format as the clients used by
+    :class:`flask_pybankid.PyBankID`, but all calls are coroutines.
+
+    :param certificates: Tuple of string paths to the certificate to use and
+        the key to sign with.
+    :type certificates: tuple
+    :param test_server: Use the test server for authenticating and signing.
+    :type test_server: bool
+    :param pool_size: Maximum number of open connections to BankID.
+    :type pool_size: int
+    :param request_timeout: Timeout for BankID requests.
+    :type request_timeout: float
+    :param transport: Optional ``httpx`` transport to send requests with.
+
+    """
+
+    def __init__(
+        self,
+        certificates,
+        test_server=False,
+        pool_size=100,
+        request_timeout=None,
+        transport=None,
+    ):
+        if httpx is None:
+            raise ImportError("httpx is required for the asyncio BankID client.")
+        self.certs = certificates
+
+        if test_server:
+            self.api_url = "https://appapi2.test.bankid.com/rp/v5/"
+            self.verify_cert = resource_filename(
+                "bankid.certs", "appapi2.test.bankid.com.pem"
+            )
+        else:
+            self.api_url = "https://appapi2.bankid.com/rp/v5/"
+            self.verify_cert = resource_filename(
+                "bankid.certs", "appapi2.bankid.com.pem"
+            )
+
+        kwargs = {}
+        if transport is not None:
+            kwargs["transport"] = transport
+        else:
+            context = ssl.create_default_context(cafile=self.verify_cert)
+            context.load_cert_chain(*self.certs)
+            kwargs["verify"] = context
+        self.client = httpx.AsyncClient(
+            headers={"Content-Type": "application/json"},
+            limits=httpx.Limits(
+                max_connections=pool_size, max_keepalive_connections=pool_size
+            ),
+            timeout=request_timeout,
+            **kwargs
+        )
+
+    async def _post(self, endpoint, data):
+        response = await self.client.post(urljoin(self.api_url, endpoint), json=data)
+        if response.status_code == 200:
+            return response.json()
+        raise get_json_error_class(response)
+
+    async def authenticate(self, personal_number=None, end_user_ip="127.0.0.1"):
+        data = {"endUserIp": end_user_ip}
+        if personal_number:
+            data["personalNumber"] = personal_number
+        return await self._post("auth", data)
+
+    async def sign(
+        self, user_visible_data, personal_number=None, end_user_ip="127.0.0.1"
+    ):
+        if not isinstance(user_visible_data, bytes):
+            user_visible_data = user_visible_data.encode("utf-8")
+        data = {
+            "endUserIp": end_user_ip,
+            "userVisibleData": base64.b64encode(user_visible_data).decode("ascii"),
+        }
+        if personal_number:
+            data["personalNumber"] = personal_number
+        return await self._post("sign", data)
+
+    async def collect(self, order_ref):
+        return _collect_response_from_json(
+            await self._post("collect", {"orderRef": order_ref})
+        )
+
+    async def cancel(self, order_ref):
+        return (await self._post("cancel", {"orderRef": order_ref})) == {}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+class AsyncPyBankID(object):
+    """ASGI application serving the PyBankID endpoints with asyncio.
+
+    It is configured from the same Flask config variables as
+    :class:`flask_pybankid.PyBankID`, and answers with the same JSON
+    responses and error status codes:
+
+    .. code-block:: python
+
+        from flask import Flask
+        from flask_pybankid_async import AsyncPyBankID
+
+        app = Flask(__name__)
+        bankid_asgi = AsyncPyBankID(app)
+
+    ``bankid_asgi`` can then be served by any ASGI server, e.g.
+    ``uvicorn myapp:bankid_asgi``, or be mounted next to the WSGI app.
+    The connection pool size is set with ``PYBANKID_POOL_SIZE``.
+
+    """
+
+    def __init__(self, app=None, config_prefix="PYBANKID"):
+        self.config_prefix = config_prefix
+        self.app = None
+        self._client = None
+        if app is not None:
+            self.init_app(app, config_prefix)
+
+    def init_app(self, app, config_prefix="PYBANKID"):
+        """Read the BankID settings of `app`.
+
+        :param flask.Flask app: the application to read configuration from.
+        :param str config_prefix: determines the set of configuration
+           variables used to configure this :class:`~AsyncPyBankID`.
+
+        """
+        self.config_prefix = config_prefix
+        self.app = app
+        app.config.setdefault(self._config_key("CERT_PATH"), "")
+        app.config.setdefault(self._config_key("KEY_PATH"), "")
+        app.config.setdefault(self._config_key("TEST_SERVER"), False)
+        app.config.setdefault(self._config_key("POOL_SIZE"), 10)
+
+    def _config_key(self, suffix):
+        return "{0}_{1}".format(self.config_prefix, suffix)
+
+    @property
+    def client(self):
+        """The shared :class:`~AsyncBankIDJSONClient`, created on first use.
+
+        :return: The BankID client.
+        :rtype: :py:class:`~AsyncBankIDJSONClient`
+
+        """
+        if self._client is None:
+            config = self.app.config
+            self._client = AsyncBankIDJSONClient(
+                (
+                    config.get(self._config_key("CERT_PATH")),
+                    config.get(self._config_key("KEY_PATH")),
+                ),
+                config.get(self._config_key("TEST_SERVER")),
+                pool_size=config.get(self._config_key("POOL_SIZE")),
+            )
+        return self._client
+
+    async def _call(self, coroutine_function, *args, **kwargs):
+        try:
+            response = await coroutine_function(*args, **kwargs)
+        except exceptions.BankIDError as e:
+            error = FlaskPyBankIDError.create_from_pybankid_exception(e)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            error = FlaskPyBankIDError(str(e), 500)
+        else:
+            return 200, response
+        return error.status_code, error.to_dict()
+
+    async def _authenticate(self, personal_number, end_user_ip):
+        return await self._call(
+            self.client.authenticate, personal_number, end_user_ip=end_user_ip
+        )
+
+    async def _sign(self, personal_number, end_user_ip, query):
+        text_to_sign = query.get("userVisibleData", [""])[0]
+        return await self._call(
+            self.client.sign, text_to_sign, personal_number, end_user_ip=end_user_ip
+        )
+
+    async def _collect(self, order_ref):
+        return await self._call(self.client.collect, order_ref)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        parts = scope["path"].strip("/").split("/")
+        client = scope.get("client") or ("127.0.0.1", 0)
+        if scope["method"] != "GET" or len(parts) != 2:
+            status_code, body = 404, {"message": "Not Found"}
+        elif parts[0] == "authenticate":
+            status_code, body = await self._authenticate(parts[1], client[0])
+        elif parts[0] == "sign":
+            query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+            status_code, body = await self._sign(parts[1], client[0], query)
+        elif parts[0] == "collect":
+            status_code, body = await self._collect(parts[1])
+        else:
+            status_code, body = 404, {"message": "Not Found"}
+
+        payload = json.dumps(body).encode("utf-8")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(payload)).encode("ascii")),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": payload})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._client is not None:
+                    await self._client.aclose()
+                    self._client = None
+                await send({"type": "lifespan.shutdown.complete"})
+                return
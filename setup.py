@@ -28,6 +28,8 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import absolute_import
 
+import sys
+
 from codecs import open
 from setuptools import setup
 
@@ -45,11 +47,19 @@ setup(
     author_email="henrik.blidh@nedomkull.com",
     description="Flask Extension for PyBankID client",
     long_description=read("README.rst"),
-    py_modules=["flask_pybankid"],
+    # The asyncio variant is Python 3 only, so it is left out of Python 2
+    # installs and the wheel is built per major version, not universal.
+    py_modules=["flask_pybankid"]
+    + (["flask_pybankid_async"] if sys.version_info[0] >= 3 else []),
     zip_safe=False,
     include_package_data=True,
     platforms="any",
     install_requires=read("requirements.txt").strip().splitlines(),
+    extras_require={
+        "async": ['httpx; python_version >= "3"'],
+        "fast": ["orjson"],
+        "tracing": ["opentelemetry-api"],
+    },
     test_suite="tests",
     classifiers=[
         "Environment :: Web Environment",
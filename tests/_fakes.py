@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`_fakes`
+=============
+
+Local stand-ins for the BankID clients, used by tests that should not
+need network access.
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import json
+import threading
+import time
+import unittest
+import uuid
+
+import requests
+import requests.adapters
+
+import flask_pybankid
+
+
+class PyBankIDTestCase(unittest.TestCase):
+    """Runs each test with :py:class:`FakeBankIDClient` in place of the SOAP
+    client, and with fresh process-wide clients, certificate watchers and
+    metrics in :mod:`flask_pybankid`, so that tests cannot see each other's.
+
+    """
+
+    def setUp(self):
+        for name in ("BankIDClient", "_client_registry"):
+            self.addCleanup(
+                setattr, flask_pybankid, name, getattr(flask_pybankid, name)
+            )
+        flask_pybankid.BankIDClient = FakeBankIDClient
+        flask_pybankid._client_registry = flask_pybankid._ClientRegistry()
+        flask_pybankid._certificate_watchers.clear()
+        flask_pybankid._metrics.reset()
+
+
+class FakeBankIDClient(object):
+    """Records calls and answers like :py:class:`bankid.BankIDClient`."""
+
+    instances = []
+
+    def __init__(self, certificates, test_server=False, **kwargs):
+        self.certs = certificates
+        self.api_url = "https://fake.bankid.local/rp/v4"
+        self.calls = []
+        self.collect_responses = []
+        self._lock = threading.Lock()
+        FakeBankIDClient.instances.append(self)
+
+    def authenticate(self, personal_number, **kwargs):
+        self.calls.append(("authenticate", personal_number))
+        return {"orderRef": str(uuid.uuid4()), "autoStartToken": str(uuid.uuid4())}
+
+    def sign(self, user_visible_data, personal_number=None, **kwargs):
+        self.calls.append(("sign", personal_number, user_visible_data))
+        return {"orderRef": str(uuid.uuid4()), "autoStartToken": str(uuid.uuid4())}
+
+    def collect(self, order_ref):
+        with self._lock:
+            self.calls.append(("collect", order_ref))
+            if self.collect_responses:
+                response = self.collect_responses.pop(0)
+            else:
+                response = {"progressStatus": "OUTSTANDING_TRANSACTION"}
+        if isinstance(response, Exception):
+            raise response
+        return dict(response)
+
+
+class FakeJSONAdapter(requests.adapters.BaseAdapter):
+    """A transport adapter answering RP API v5 calls from canned replies.
+
+    ``replies`` maps an endpoint name (``auth``, ``sign``, ``collect``,
+    ``cancel``) to a list of ``(status_code, body)`` tuples, consumed in
+    order. The last reply of each list is repeated.
+
+    """
+
+    def __init__(self, replies=None):
+        super(FakeJSONAdapter, self).__init__()
+        self.replies = replies or {}
+        self.requests = []
+        self.headers = []
+
+    def send(self, request, **kwargs):
+        endpoint = request.url.rstrip("/").rsplit("/", 1)[-1]
+        self.requests.append((endpoint, json.loads(request.body.decode("utf-8"))))
+        self.headers.append(dict(request.headers))
+        replies = self.replies.get(endpoint) or [
+            (200, {"orderRef": str(uuid.uuid4()), "autoStartToken": str(uuid.uuid4())})
+        ]
+        status_code, body = replies.pop(0) if len(replies) > 1 else replies[0]
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(body).encode("utf-8")
+        response.headers["Content-Type"] = "application/json"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class FakeRedis(object):
+    """The subset of :py:class:`redis.Redis` used by Flask-PyBankID, in memory."""
+
+    def __init__(self):
+        self.data = {}
+        self._lock = threading.Lock()
+
+    def _alive(self, key):
+        entry = self.data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self.data[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._alive(key)
+            return None if entry is None else entry[0]
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        with self._lock:
+            if nx and self._alive(key) is not None:
+                return None
+            if ex is not None:
+                px = ex * 1000
+            expires = None if px is None else time.time() + px / 1000.0
+            if not isinstance(value, bytes):
+                value = str(value).encode("utf-8")
+            self.data[key] = (value, expires)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(1 for key in keys if self.data.pop(key, None) is not None)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_async`
+=================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import json
+import unittest
+
+import flask
+
+try:
+    import asyncio
+    import flask_pybankid_async
+    from flask_pybankid_async import AsyncBankIDJSONClient, AsyncPyBankID
+except (ImportError, SyntaxError):
+    flask_pybankid_async = None
+
+ORDER_REF = "131daac9-16c6-4618-beb0-365768f37288"
+
+
+@unittest.skipIf(
+    flask_pybankid_async is None or flask_pybankid_async.httpx is None,
+    "httpx is not installed",
+)
+class AsyncPyBankIDTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.requests = []
+        self.replies = {}
+
+        app = flask.Flask("test")
+        app.config["PYBANKID_TEST_SERVER"] = True
+        self.bankid = AsyncPyBankID(app)
+        self.bankid._client = AsyncBankIDJSONClient(
+            ("cert.pem", "key.pem"),
+            True,
+            transport=flask_pybankid_async.httpx.MockTransport(self._handle),
+        )
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.bankid._client.aclose())
+        self.loop.close()
+
+    def _handle(self, request):
+        endpoint = request.url.path.rsplit("/", 1)[-1]
+        self.requests.append((endpoint, json.loads(request.content.decode("utf-8"))))
+        status_code, body = self.replies.get(
+            endpoint, (200, {"orderRef": ORDER_REF, "autoStartToken": ORDER_REF})
+        )
+        return flask_pybankid_async.httpx.Response(status_code, json=body)
+
+    def _get(self, path, query_string=b""):
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "path": path,
+            "query_string": query_string,
+            "client": ("10.1.2.3", 1234),
+        }
+        self.loop.run_until_complete(self.bankid(scope, receive, send))
+        return messages[0]["status"], json.loads(messages[1]["body"].decode("utf-8"))
+
+    def test_authenticate(self):
+        status_code, body = self._get("/authenticate/190001010101")
+        assert status_code == 200
+        assert body == {"orderRef": ORDER_REF, "autoStartToken": ORDER_REF}
+        assert self.requests[-1] == (
+            "auth",
+            {"endUserIp": "10.1.2.3", "personalNumber": "190001010101"},
+        )
+
+    def test_sign_encodes_user_visible_data(self):
+        status_code, body = self._get(
+            "/sign/190001010101", b"userVisibleData=Text+to+sign"
+        )
+        assert status_code == 200
+        assert self.requests[-1][1]["userVisibleData"] == "VGV4dCB0byBzaWdu"
+
+    def test_collect_has_same_shape_as_sync_views(self):
+        self.replies["collect"] = (
+            200,
+            {"orderRef": ORDER_REF, "status": "pending", "hintCode": "noClient"},
+        )
+        status_code, body = self._get("/collect/" + ORDER_REF)
+        assert status_code == 200
+        assert body == {"progressStatus": "NO_CLIENT"}
+
+    def test_errors_are_mapped(self):
+        self.replies["auth"] = (
+            400,
+            {"errorCode": "alreadyInProgress", "details": "Order in progress"},
+        )
+        status_code, body = self._get("/authenticate/190001010101")
+        assert status_code == 409
+        assert body["message"].startswith("AlreadyInProgressError:")
+
+    def test_unknown_path(self):
+        status_code, body = self._get("/nothing/here")
+        assert status_code == 404
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_backends`
+====================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import base64
+import gzip
+import io
+import json
+import time
+
+import flask
+
+import flask_pybankid
+from flask_pybankid import PyBankID
+
+from _fakes import FakeJSONAdapter, PyBankIDTestCase
+
+ORDER_REF = "131daac9-16c6-4618-beb0-365768f37288"
+
+
+class JSONBackendTest(PyBankIDTestCase):
+    def setUp(self):
+        super(JSONBackendTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_CERT_PATH"] = "cert.pem"
+        self.app.config["PYBANKID_KEY_PATH"] = "key.pem"
+        self.app.config["PYBANKID_TEST_SERVER"] = True
+        self.app.config["PYBANKID_BACKEND"] = "json"
+        self.app.config["PYBANKID_POOL_SIZE"] = 4
+        self.bankid = PyBankID(self.app)
+        self.adapter = FakeJSONAdapter()
+        with self.app.app_context():
+            self.bankid.client.client.mount("https://", self.adapter)
+
+    def _get(self, url):
+        out = self.app.test_client().get(url, environ_base={"REMOTE_ADDR": "10.1.2.3"})
+        return out.status_code, json.loads(out.data.decode("utf-8"))
+
+    def test_json_client_is_pooled(self):
+        with self.app.app_context():
+            client = self.bankid.client
+        assert isinstance(client, flask_pybankid._JSONClient)
+        assert client.api_url == "https://appapi2.test.bankid.com/rp/v5/"
+        assert client.client.get_adapter("http://x")._pool_maxsize == 4
+
+    def test_authenticate_sends_end_user_ip(self):
+        status_code, body = self._get("/authenticate/190001010101")
+        assert status_code == 200
+        assert set(body) == {"orderRef", "autoStartToken"}
+        assert self.adapter.requests[-1] == (
+            "auth",
+            {"endUserIp": "10.1.2.3", "personalNumber": "190001010101"},
+        )
+
+    def test_pending_collect_has_soap_shape(self):
+        self.adapter.replies["collect"] = [
+            (200, {"orderRef": ORDER_REF, "status": "pending", "hintCode": "userSign"})
+        ]
+        status_code, body = self._get("/collect/" + ORDER_REF)
+        assert status_code == 200
+        assert body == {"progressStatus": "USER_SIGN"}
+
+    def test_complete_collect_has_soap_shape(self):
+        completion_data = {
+            "user": {
+                "personalNumber": "190000000000",
+                "name": "Karl Karlsson",
+                "givenName": "Karl",
+                "surname": "Karlsson",
+            },
+            "device": {"ipAddress": "192.168.0.1"},
+            "cert": {"notBefore": "1502983274000", "notAfter": "1563549674000"},
+            "signature": "c2lnbmF0dXJl",
+            "ocspResponse": "b2NzcA==",
+        }
+        self.adapter.replies["collect"] = [
+            (
+                200,
+                {
+                    "orderRef": ORDER_REF,
+                    "status": "complete",
+                    "completionData": completion_data,
+                },
+            )
+        ]
+        status_code, body = self._get("/collect/" + ORDER_REF)
+        assert status_code == 200
+        assert body["progressStatus"] == "COMPLETE"
+        assert body["signature"] == "c2lnbmF0dXJl"
+        assert body["userInfo"]["personalNumber"] == "190000000000"
+        assert body["userInfo"]["ipAddress"] == "192.168.0.1"
+
+    def test_failed_collect_is_mapped_like_soap(self):
+        self.adapter.replies["collect"] = [
+            (200, {"orderRef": ORDER_REF, "status": "failed", "hintCode": "userCancel"})
+        ]
+        status_code, body = self._get("/collect/" + ORDER_REF)
+        assert status_code == 409
+        assert body["message"].startswith("UserCancelError:")
+
+    def test_error_reply_is_mapped(self):
+        self.adapter.replies["auth"] = [
+            (400, {"errorCode": "alreadyInProgress", "details": "Order in progress"})
+        ]
+        status_code, body = self._get("/authenticate/190001010101")
+        assert status_code == 409
+        assert body["message"].startswith("AlreadyInProgressError:")
+
+    def test_unknown_backend_raises(self):
+        self.app.config["PYBANKID_BACKEND"] = "xml"
+        with self.app.app_context():
+            self.assertRaises(ValueError, lambda: self.bankid.client)
+
+
+def _b64(text):
+    return base64.b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def _gzip(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode="wb") as f:
+        f.write(data)
+    return out.getvalue()
+
+
+class SignBodyTest(PyBankIDTestCase):
+    def setUp(self):
+        super(SignBodyTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_BACKEND"] = "json"
+        self.app.config["PYBANKID_SIGN_MAX_BYTES"] = 1000
+        self.bankid = PyBankID(self.app)
+        self.adapter = FakeJSONAdapter()
+        with self.app.app_context():
+            self.bankid.client.client.mount("https://", self.adapter)
+
+    def _post(self, data, **kwargs):
+        return self.app.test_client().post("/sign/190001010101", data=data, **kwargs)
+
+    def test_text_body(self):
+        response = self._post(
+            "Köpeavtal".encode("utf-8"), content_type="text/plain; charset=utf-8"
+        )
+        assert response.status_code == 200
+        sent = self.adapter.requests[-1][1]
+        assert sent["userVisibleData"] == _b64("Köpeavtal")
+        assert "userNonVisibleData" not in sent
+
+    def test_json_body_with_non_visible_data(self):
+        response = self._post(
+            json.dumps({"userVisibleData": "Avtal", "userNonVisibleData": "id=1"}),
+            content_type="application/json",
+        )
+        assert response.status_code == 200
+        sent = self.adapter.requests[-1][1]
+        assert sent["userVisibleData"] == _b64("Avtal")
+        assert sent["userNonVisibleData"] == _b64("id=1")
+
+    def test_gzip_body(self):
+        text = "Avtal " * 150
+        response = self._post(
+            _gzip(json.dumps({"userVisibleData": text}).encode("utf-8")),
+            content_type="application/json",
+            headers={"Content-Encoding": "gzip"},
+        )
+        assert response.status_code == 200
+        assert self.adapter.requests[-1][1]["userVisibleData"] == _b64(text)
+
+    def test_too_large_bodies_are_refused(self):
+        response = self._post(b"x" * 1001, content_type="text/plain")
+        assert response.status_code == 413
+        response = self._post(
+            _gzip(b"x" * 100000),
+            content_type="text/plain",
+            headers={"Content-Encoding": "gzip"},
+        )
+        assert response.status_code == 413
+        assert self.adapter.requests == []
+
+    def test_bodies_without_length_are_read_up_to_the_limit(self):
+        def post(data):
+            return self.app.test_client().post(
+                "/sign/190001010101",
+                input_stream=io.BytesIO(data),
+                content_type="text/plain",
+                headers={"Transfer-Encoding": "chunked"},
+                environ_overrides={"wsgi.input_terminated": True},
+            )
+
+        assert post(b"x" * 1001).status_code == 413
+        assert self.adapter.requests == []
+        assert post(b"Avtal").status_code == 200
+        assert self.adapter.requests[-1][1]["userVisibleData"] == _b64("Avtal")
+
+    def test_empty_bodies_are_refused(self):
+        response = self._post(b"", content_type="text/plain")
+        assert response.status_code == 400
+        assert self.adapter.requests == []
+
+    def test_undecodable_bodies_are_refused(self):
+        response = self._post(
+            b"not gzip", content_type="text/plain", headers={"Content-Encoding": "gzip"}
+        )
+        assert response.status_code == 400
+        response = self._post(
+            b"x", content_type="text/plain", headers={"Content-Encoding": "br"}
+        )
+        assert response.status_code == 415
+        response = self._post(
+            json.dumps({"userVisibleData": 1}), content_type="application/json"
+        )
+        assert response.status_code == 400
+        response = self._post(b"\xffAvtal", content_type="text/plain")
+        assert response.status_code == 400
+        assert self.adapter.requests == []
+
+    def test_encodings_are_reused(self):
+        for _ in range(3):
+            self._post("Avtal", content_type="text/plain")
+        assert [r[1]["userVisibleData"] for r in self.adapter.requests] == [
+            _b64("Avtal")
+        ] * 3
+        lookups = dict(
+            (
+                result,
+                flask_pybankid._metrics.get(
+                    "pybankid_sign_data_cache_lookups_total",
+                    prefix="PYBANKID",
+                    result=result,
+                ),
+            )
+            for result in ("hit", "miss")
+        )
+        assert lookups == {"hit": 2, "miss": 1}
+
+    def test_text_body_with_soap_client(self):
+        self.app.config["PYBANKID_BACKEND"] = "soap"
+        with self.app.app_context():
+            client = self.bankid.client
+        client.sign = lambda *args, **kwargs: dict(orderRef="abc", args=list(args))
+        response = self._post(
+            "Köpeavtal".encode("utf-8"), content_type="text/plain; charset=utf-8"
+        )
+        body = json.loads(response.data.decode("utf-8"))
+        assert body["args"] == ["Köpeavtal", "190001010101"]
+        assert self._post(b"\xff", content_type="text/plain").status_code == 400
+
+    def test_query_string_with_soap_client(self):
+        self.app.config["PYBANKID_BACKEND"] = "soap"
+        with self.app.app_context():
+            client = self.bankid.client
+        client.sign = lambda *args, **kwargs: dict(
+            orderRef="abc", args=list(args), kwargs=kwargs
+        )
+        response = self.app.test_client().get(
+            "/sign/190001010101?userVisibleData=Avtal&userNonVisibleData=id"
+        )
+        body = json.loads(response.data.decode("utf-8"))
+        assert body["args"] == ["Avtal", "190001010101"]
+        assert body["kwargs"] == {"userNonVisibleData": _b64("id")}
+
+
+class CancelTest(PyBankIDTestCase):
+    def setUp(self):
+        super(CancelTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_BACKEND"] = "json"
+        self.bankid = PyBankID(self.app)
+        self.adapter = FakeJSONAdapter({"cancel": [(200, {})]})
+        with self.app.app_context():
+            self.bankid.client.client.mount("https://", self.adapter)
+
+    def tearDown(self):
+        reaper = self.app.extensions["pybankid"]["PYBANKID"].reaper
+        if reaper:
+            reaper.stop()
+
+    def _start(self):
+        out = self.app.test_client().get("/authenticate/190001010101")
+        return json.loads(out.data.decode("utf-8"))["orderRef"]
+
+    def _cancelled(self):
+        return [
+            data["orderRef"]
+            for endpoint, data in self.adapter.requests
+            if endpoint == "cancel"
+        ]
+
+    def test_cancel(self):
+        response = self.app.test_client().post("/cancel/" + ORDER_REF)
+        assert response.status_code == 200
+        assert json.loads(response.data.decode("utf-8")) == {"cancelled": True}
+        assert self._cancelled() == [ORDER_REF]
+
+    def test_cancel_error_is_mapped(self):
+        self.adapter.replies["cancel"] = [
+            (400, {"errorCode": "invalidParameters", "details": "No such order"})
+        ]
+        response = self.app.test_client().post("/cancel/" + ORDER_REF)
+        assert response.status_code == 400
+
+    def test_cancel_requires_json_backend(self):
+        self.app.config["PYBANKID_BACKEND"] = "soap"
+        response = self.app.test_client().post("/cancel/" + ORDER_REF)
+        assert response.status_code == 501
+
+    def test_abandoned_orders_are_reaped(self):
+        self.app.config["PYBANKID_REAP_AFTER"] = 0.2
+        self.adapter.replies["collect"] = [
+            (200, {"orderRef": ORDER_REF, "status": "pending", "hintCode": "userSign"})
+        ]
+        abandoned = self._start()
+        watched = self._start()
+        for _ in range(6):
+            time.sleep(0.05)
+            self.app.test_client().get("/collect/" + watched)
+        time.sleep(0.1)
+        with self.app.app_context():
+            stats = self.bankid.reaper.stats()
+        assert self._cancelled() == [abandoned]
+        assert stats == {"orders": 1, "reaped": 1, "failed": 0}
+        assert (
+            flask_pybankid._metrics.get(
+                "pybankid_orders_reaped_total", prefix="PYBANKID"
+            )
+            == 1
+        )
+
+    def test_orders_seen_by_other_processes_are_not_reaped(self):
+        store = flask_pybankid.MemoryOrderStore()
+        self.app.config["PYBANKID_REAP_AFTER"] = 0.2
+        self.app.config["PYBANKID_ORDER_STORE"] = store
+        other = flask.Flask("other")
+        other.config.update(self.app.config)
+        PyBankID(other)
+        self.adapter.replies["collect"] = [
+            (200, {"orderRef": ORDER_REF, "status": "pending", "hintCode": "userSign"})
+        ]
+        order_ref = self._start()
+        try:
+            for _ in range(8):
+                time.sleep(0.05)
+                other.test_client().get("/collect/" + order_ref)
+            time.sleep(0.1)
+            assert self._cancelled() == []
+        finally:
+            other.extensions["pybankid"]["PYBANKID"].reaper.stop()
+
+    def test_reaping_requires_json_backend(self):
+        app = flask.Flask("soap")
+        app.config["PYBANKID_REAP_AFTER"] = 60.0
+        with self.assertRaises(ValueError):
+            PyBankID(app)
+
+    def test_finished_and_cancelled_orders_are_not_reaped(self):
+        self.app.config["PYBANKID_REAP_AFTER"] = 0.1
+        self.adapter.replies["collect"] = [
+            (200, {"orderRef": ORDER_REF, "status": "complete", "completionData": {}})
+        ]
+        finished = self._start()
+        self.app.test_client().get("/collect/" + finished)
+        self.app.test_client().post("/cancel/" + self._start())
+        time.sleep(0.2)
+        with self.app.app_context():
+            assert self.bankid.reaper.stats()["reaped"] == 0
+        assert len(self._cancelled()) == 1
+
+    def test_reaper_batches_cancels(self):
+        reaper = flask_pybankid._OrderReaper(
+            lambda order_ref: time.sleep(0.05), timeout=0, batch_size=2, workers=2
+        )
+        try:
+            for i in range(4):
+                reaper.add(str(i))
+            time.sleep(0.2)
+            assert reaper.stats() == {"orders": 0, "reaped": 4, "failed": 0}
+        finally:
+            reaper.stop()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_benchmarks`
+======================
+
+Smoke test of the benchmark harness, with a tiny load.
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"
+    ),
+)
+
+import flask_pybankid  # noqa: E402
+import benchmark  # noqa: E402
+import startup  # noqa: E402
+
+
+class BenchmarkHarnessTest(unittest.TestCase):
+    def setUp(self):
+        flask_pybankid._client_registry = flask_pybankid._ClientRegistry()
+
+    def test_all_scenarios_run_without_errors(self):
+        results = benchmark.main(
+            ["--requests", "20", "--concurrency", "4", "--latency", "0", "--json"]
+        )
+        assert [r["scenario"] for r in results] == list(benchmark.SCENARIOS)
+        for result in results:
+            assert result["requests"] == 20
+            assert result["errors"] == 0
+            assert result["p99_ms"] >= result["p50_ms"]
+
+
+class StartupBenchmarkTest(unittest.TestCase):
+    def test_pybankid_is_not_imported_eagerly(self):
+        result, failed = startup.main(["--runs", "1", "--json"])
+        assert result["eager_imports"] == []
+        assert result["warmup_ms"] > 0
+        assert not failed
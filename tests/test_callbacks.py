@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_callbacks`
+=====================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import hashlib
+import hmac
+import json
+import threading
+import time
+import unittest
+
+import flask
+from bankid import exceptions
+
+import flask_pybankid
+from flask_pybankid import PyBankID
+
+from _fakes import PyBankIDTestCase
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import quote
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib import quote
+
+SECRET = "s3cret"
+
+
+class Receiver(HTTPServer):
+    """Records the callbacks posted to it, failing the first `failures`."""
+
+    def __init__(self, failures=0):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), _ReceiverHandler)
+        self.failures = failures
+        self.redirect_to = None
+        self.received = []
+        self.attempts = 0
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def url(self):
+        return "http://{0}:{1}/bankid".format(*self.server_address[:2])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+class _ReceiverHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        server = self.server
+        server.attempts += 1
+        if server.attempts <= server.failures:
+            self.send_response(500)
+        elif server.redirect_to:
+            self.send_response(302)
+            self.send_header("Location", server.redirect_to)
+        else:
+            server.received.append((self.path, dict(self.headers), body))
+            self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CallbackTest(PyBankIDTestCase):
+    def setUp(self):
+        super(CallbackTest, self).setUp()
+        self.receiver = Receiver()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_COLLECT_INTERVAL"] = 0.05
+        self.app.config["PYBANKID_CALLBACK_URLS"] = [self.receiver.url]
+        self.app.config["PYBANKID_CALLBACK_SECRET"] = SECRET
+        self.app.config["PYBANKID_CALLBACK_BACKOFF"] = 0.01
+        self.bankid = PyBankID(self.app)
+        with self.app.app_context():
+            self.client = self.bankid.client
+
+    def tearDown(self):
+        state = self.app.extensions["pybankid"]["PYBANKID"]
+        for worker in (state.poller, state.reaper, state.delivery):
+            if worker:
+                worker.stop()
+        self.receiver.stop()
+
+    def _wait_for(self, result):
+        deadline = time.time() + 5
+        with self.app.app_context():
+            while not self.bankid.callback_stats[result] and time.time() < deadline:
+                time.sleep(0.01)
+            return self.bankid.callback_stats[result]
+
+    def _start(self, url):
+        response = self.app.test_client().get(url)
+        return response.status_code, json.loads(response.data.decode("utf-8"))
+
+    def test_signed_result_is_posted_to_callback_url(self):
+        self.client.collect_responses = [
+            {"progressStatus": "USER_SIGN"},
+            {"progressStatus": "COMPLETE", "signature": "abc"},
+        ]
+        status_code, body = self._start(
+            "/authenticate/190001010101?callbackUrl=" + self.receiver.url
+        )
+        assert status_code == 200
+        assert self._wait_for("delivered") == 1
+        path, headers, data = self.receiver.received[0]
+        assert path == "/bankid"
+        assert headers["Content-Type"] == "application/json"
+        assert headers["X-PyBankID-Signature"] == "sha256=" + (
+            hmac.new(SECRET.encode("utf-8"), data, hashlib.sha256).hexdigest()
+        )
+        assert json.loads(data.decode("utf-8")) == {
+            "orderRef": body["orderRef"],
+            "status": "complete",
+            "result": {"progressStatus": "COMPLETE", "signature": "abc"},
+        }
+
+    def test_failed_order_is_delivered_to_hook(self):
+        self.client.collect_responses = [exceptions.UserCancelError("USER_CANCEL")]
+        delivered = []
+        event = threading.Event()
+
+        def hook(order_ref, result):
+            delivered.append((order_ref, result))
+            event.set()
+
+        with self.app.app_context():
+            self.bankid.add_callback("abc", hook)
+        assert event.wait(5)
+        order_ref, result = delivered[0]
+        assert order_ref == "abc"
+        assert result["status"] == "failed"
+        assert result["error"]["status"] == 409
+        assert self.client.calls == [("collect", "abc")]
+
+    def test_failed_deliveries_are_retried(self):
+        self.receiver.failures = 2
+        self.client.collect_responses = [{"progressStatus": "COMPLETE"}]
+        self._start(
+            "/sign/190001010101?userVisibleData=Hi&callbackUrl=" + self.receiver.url
+        )
+        assert self._wait_for("delivered") == 1
+        assert self.receiver.attempts == 3
+        assert (
+            flask_pybankid._metrics.get(
+                "pybankid_callbacks_total", prefix="PYBANKID", result="delivered"
+            )
+            == 1
+        )
+
+    def test_deliveries_are_given_up_after_retries(self):
+        self.receiver.failures = 10
+        self.app.config["PYBANKID_CALLBACK_RETRIES"] = 1
+        self.client.collect_responses = [{"progressStatus": "COMPLETE"}]
+        with self.app.app_context():
+            self.bankid.add_callback("abc", self.receiver.url)
+        assert self._wait_for("failed") == 1
+        assert self.receiver.attempts == 2
+
+    def test_orders_waiting_for_callbacks_are_not_reaped(self):
+        self.app.config["PYBANKID_REAP_AFTER"] = 0.2
+        self._start(
+            "/sign/190001010101?userVisibleData=Hi&callbackUrl=" + self.receiver.url
+        )
+        time.sleep(0.6)
+        with self.app.app_context():
+            stats = self.bankid.reaper.stats()
+        assert stats == {"orders": 1, "reaped": 0, "failed": 0}
+
+    def test_callback_url_must_be_allowed(self):
+        status_code, body = self._start(
+            "/authenticate/190001010101?callbackUrl=http://169.254.169.254/"
+        )
+        assert status_code == 400
+        assert body["message"] == "Callback URL not allowed."
+        assert self.client.calls == []
+
+    def test_callback_url_must_match_host_and_path(self):
+        self.app.config["PYBANKID_CALLBACK_URLS"] = [
+            "https://hooks.example.com/bankid/"
+        ]
+        for url in (
+            "https://hooks.example.com.evil.net/bankid/",
+            "https://hooks.example.com@evil.net/bankid/",
+            "https://hooks.example.com:8443/bankid/",
+            "http://hooks.example.com/bankid/",
+            "https://hooks.example.com/bankidx",
+            "https://hooks.example.com/bankid/../admin",
+        ):
+            status_code, body = self._start(
+                "/authenticate/190001010101?callbackUrl=" + quote(url, safe="")
+            )
+            assert status_code == 400, url
+        assert self.client.calls == []
+        status_code, body = self._start(
+            "/authenticate/190001010101?callbackUrl="
+            + quote("https://hooks.example.com/bankid/done", safe="")
+        )
+        assert status_code == 200
+
+    def test_redirects_are_not_followed(self):
+        self.receiver.redirect_to = self.receiver.url + "/elsewhere"
+        self.app.config["PYBANKID_CALLBACK_RETRIES"] = 0
+        self.client.collect_responses = [{"progressStatus": "COMPLETE"}]
+        with self.app.app_context():
+            self.bankid.add_callback("abc", self.receiver.url)
+        assert self._wait_for("failed") == 1
+        assert self.receiver.attempts == 1
+
+    def test_results_are_dropped_when_queue_is_full(self):
+        release = threading.Event()
+        delivery = flask_pybankid._CallbackDelivery(workers=1, queue_size=1)
+        delivery.submit(lambda *args: release.wait(5), "a", {}, None)
+        time.sleep(0.1)
+        delivery.submit(lambda *args: None, "b", {}, None)
+        delivery.submit(lambda *args: None, "c", {}, None)
+        release.set()
+        delivery.stop()
+        assert delivery.stats() == {"delivered": 2, "failed": 0, "dropped": 1}
+
+
+if __name__ == "__main__":
+    unittest.main()
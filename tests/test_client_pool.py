@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_client_pool`
+=======================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import flask
+from bankid import exceptions
+
+import flask_pybankid
+from flask_pybankid import PyBankID
+
+from _fakes import FakeBankIDClient, PyBankIDTestCase
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"
+    ),
+)
+
+from mock_bankid import MockBankIDServer  # noqa: E402
+
+
+class ClientPoolTest(PyBankIDTestCase):
+    def setUp(self):
+        super(ClientPoolTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_CERT_PATH"] = "cert.pem"
+        self.app.config["PYBANKID_KEY_PATH"] = "key.pem"
+        self.app.config["PYBANKID_TEST_SERVER"] = True
+        self.bankid = PyBankID(self.app)
+
+    def test_client_is_shared_between_app_contexts(self):
+        with self.app.app_context():
+            first = self.bankid.client
+        with self.app.app_context():
+            second = self.bankid.client
+        assert first is second
+        assert self.bankid.client_stats == {"hits": 1, "misses": 1, "builds": 1}
+
+    def test_client_is_shared_between_threads(self):
+        clients = []
+
+        def worker():
+            with self.app.app_context():
+                clients.append(self.bankid.client)
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(id(c) for c in clients)) == 1
+        assert self.bankid.client_stats["builds"] == 1
+
+    def test_client_is_rebuilt_on_config_change(self):
+        with self.app.app_context():
+            first = self.bankid.client
+            self.app.config["PYBANKID_KEY_PATH"] = "other_key.pem"
+            second = self.bankid.client
+        assert first is not second
+        assert second.certs == ("cert.pem", "other_key.pem")
+        assert self.bankid.client_stats["builds"] == 2
+
+    def test_no_client_outside_app_context(self):
+        assert self.bankid.client is None
+
+    def test_warmup_builds_the_shared_client(self):
+        client = self.bankid.warmup()
+        assert isinstance(client, FakeBankIDClient)
+        with self.app.app_context():
+            assert self.bankid.client is client
+        assert self.bankid.client_stats == {"hits": 1, "misses": 1, "builds": 1}
+
+    def test_config_prefix_given_to_init_app(self):
+        app = flask.Flask("prefixed")
+        app.config["MY_CERT_PATH"] = "my_cert.pem"
+        bankid = PyBankID()
+        bankid.init_app(app, config_prefix="MY")
+        response = app.test_client().get("/authenticate/190001010101")
+        assert response.status_code == 200
+        with app.app_context():
+            assert bankid.client.certs[0] == "my_cert.pem"
+
+
+class CertificateReloadTest(PyBankIDTestCase):
+    def setUp(self):
+        super(CertificateReloadTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.cert_path = os.path.join(self.directory, "cert.pem")
+        self.key_path = os.path.join(self.directory, "key.pem")
+        for path in (self.cert_path, self.key_path):
+            with open(path, "w") as f:
+                f.write("original")
+
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_CERT_PATH"] = self.cert_path
+        self.app.config["PYBANKID_KEY_PATH"] = self.key_path
+        self.app.config["PYBANKID_CERT_CHECK_INTERVAL"] = 0
+        self.bankid = PyBankID(self.app)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _replace(self, path, content):
+        with open(path + ".new", "w") as f:
+            f.write(content)
+        os.rename(path + ".new", path)
+
+    def test_client_is_kept_while_files_are_unchanged(self):
+        with self.app.app_context():
+            first = self.bankid.client
+            second = self.bankid.client
+        assert first is second
+        assert self.bankid.client_stats["builds"] == 1
+
+    def test_client_is_rebuilt_when_certificate_is_replaced(self):
+        with self.app.app_context():
+            first = self.bankid.client
+            self._replace(self.cert_path, "rotated certificate")
+            second = self.bankid.client
+            third = self.bankid.client
+        assert first is not second
+        assert second is third
+        assert self.bankid.client_stats["builds"] == 2
+
+    def test_files_are_checked_at_most_once_per_interval(self):
+        self.app.config["PYBANKID_CERT_CHECK_INTERVAL"] = 3600
+        with self.app.app_context():
+            first = self.bankid.client
+            self._replace(self.key_path, "rotated key")
+            second = self.bankid.client
+        assert first is second
+
+    def test_no_ssl_context_without_certificate_files(self):
+        assert (
+            flask_pybankid._load_ssl_context(
+                (os.path.join(self.directory, "missing.pem"), self.key_path), None
+            )
+            is None
+        )
+
+
+class MultiTenantTest(PyBankIDTestCase):
+    def setUp(self):
+        super(MultiTenantTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_CERT_PATH"] = "cert.pem"
+        self.app.config["PYBANKID_KEY_PATH"] = "key.pem"
+        self.app.config["PYBANKID_TENANTS"] = {
+            "acme": {"CERT_PATH": "acme.pem", "KEY_PATH": "acme.key"},
+            "globex": {"CERT_PATH": "globex.pem", "KEY_PATH": "globex.key"},
+        }
+        self.app.config["PYBANKID_TENANT_HEADER"] = "X-Tenant"
+        self.app.config["PYBANKID_TENANT_URL_PREFIX"] = "/tenants/<tenant>"
+        self.bankid = PyBankID(self.app)
+
+    def _clients(self):
+        return dict(
+            (client.certs[0], client)
+            for _, client, _ in self.app.extensions["pybankid"][
+                "PYBANKID"
+            ].tenant_clients._clients.values()
+        )
+
+    def test_tenant_from_header_and_url(self):
+        client = self.app.test_client()
+        assert client.get("/authenticate/190001010101").status_code == 200
+        response = client.get(
+            "/authenticate/190001010102", headers={"X-Tenant": "acme"}
+        )
+        assert response.status_code == 200
+        response = client.get("/tenants/globex/authenticate/190001010103")
+        assert response.status_code == 200
+        clients = self._clients()
+        assert clients["acme.pem"].calls == [("authenticate", "190001010102")]
+        assert clients["acme.pem"].certs == ("acme.pem", "acme.key")
+        assert clients["globex.pem"].calls == [("authenticate", "190001010103")]
+        with self.app.app_context():
+            assert self.bankid.tenant_stats == {
+                "clients": 2,
+                "builds": 2,
+                "evictions": 0,
+            }
+            assert self.bankid.client_stats["builds"] == 1
+
+    def test_collect_uses_the_tenant_client(self):
+        client = self.app.test_client()
+        response = client.get("/tenants/acme/collect/abc")
+        assert response.status_code == 200
+        assert self._clients()["acme.pem"].calls == [("collect", "abc")]
+
+    def test_tenants_have_their_own_circuit_breakers(self):
+        self.app.config["PYBANKID_CIRCUIT_BREAKER"] = True
+        self.app.config["PYBANKID_BREAKER_FAILURE_THRESHOLD"] = 2
+        self.app.config["PYBANKID_SINGLE_FLIGHT"] = False
+        client = self.app.test_client()
+        client.get("/tenants/acme/collect/abc")
+        self._clients()["acme.pem"].collect_responses = [
+            exceptions.InternalError("x")
+        ] * 2
+        for _ in range(2):
+            assert client.get("/tenants/acme/collect/abc").status_code == 500
+        assert client.get("/tenants/acme/collect/abc").status_code == 503
+        assert client.get("/tenants/globex/collect/abc").status_code == 200
+        assert client.get("/collect/abc").status_code == 200
+        with self.app.test_request_context(headers={"X-Tenant": "acme"}):
+            assert self.bankid.circuit_breaker.state == "open"
+        with self.app.test_request_context(headers={"X-Tenant": "globex"}):
+            assert self.bankid.circuit_breaker.state == "closed"
+        assert (
+            flask_pybankid._metrics.get(
+                "pybankid_circuit_state", prefix="PYBANKID", tenant="acme"
+            )
+            == 2
+        )
+
+    def test_unknown_tenant(self):
+        client = self.app.test_client()
+        response = client.get("/tenants/initech/authenticate/190001010101")
+        assert response.status_code == 404
+        response = client.get("/collect/abc", headers={"X-Tenant": "initech"})
+        assert response.status_code == 404
+        with self.app.app_context():
+            assert self.bankid.tenant_stats["builds"] == 0
+
+    def test_tenants_from_a_function(self):
+        self.app.config["PYBANKID_TENANTS"] = lambda tenant: (
+            {"CERT_PATH": tenant + ".pem"} if tenant.startswith("t") else None
+        )
+        client = self.app.test_client()
+        assert client.get("/tenants/t1/collect/abc").status_code == 200
+        assert client.get("/tenants/x1/collect/abc").status_code == 404
+        assert self._clients()["t1.pem"].certs == ("t1.pem", "key.pem")
+
+    def test_least_recently_used_clients_are_evicted(self):
+        self.app.config["PYBANKID_TENANT_MAX_CLIENTS"] = 1
+        client = self.app.test_client()
+        client.get("/tenants/acme/collect/abc")
+        client.get("/tenants/globex/collect/abc")
+        client.get("/tenants/acme/collect/abc")
+        with self.app.app_context():
+            assert self.bankid.tenant_stats == {
+                "clients": 1,
+                "builds": 3,
+                "evictions": 2,
+            }
+
+    def test_idle_clients_are_evicted(self):
+        self.app.config["PYBANKID_TENANT_IDLE_TIMEOUT"] = 0
+        client = self.app.test_client()
+        client.get("/tenants/acme/collect/abc")
+        client.get("/tenants/globex/collect/abc")
+        assert list(self._clients()) == ["globex.pem"]
+
+    def test_building_a_client_does_not_block_other_tenants(self):
+        registry = flask_pybankid._ClientRegistry()
+        building = threading.Event()
+        release = threading.Event()
+        built = []
+
+        def slow_factory():
+            building.set()
+            release.wait(5)
+            built.append("acme")
+            return "acme client"
+
+        threads = [
+            threading.Thread(target=registry.get, args=("acme", 1, slow_factory))
+            for _ in range(2)
+        ]
+        for t in threads:
+            t.start()
+        assert building.wait(5)
+        start = time.time()
+        assert registry.get("globex", 1, lambda: "globex client") == "globex client"
+        assert time.time() - start < 1.0
+        release.set()
+        for t in threads:
+            t.join()
+        assert built == ["acme"]
+        assert registry.get("acme", 1, slow_factory) == "acme client"
+        assert registry.stats("acme") == {"hits": 2, "misses": 1, "builds": 1}
+
+
+@unittest.skipUnless(hasattr(os, "register_at_fork"), "requires os.register_at_fork")
+class PreforkWarmupTest(PyBankIDTestCase):
+    def setUp(self):
+        super(PreforkWarmupTest, self).setUp()
+        self.server = MockBankIDServer().start()
+
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_BACKEND"] = "json"
+        self.app.config["PYBANKID_API_URL"] = self.server.api_url
+        self.app.config["PYBANKID_PREFORK_WARMUP"] = True
+        self.app.config["PYBANKID_COLLECT_POLLER"] = True
+        self.bankid = PyBankID(self.app)
+
+    def tearDown(self):
+        state = self.app.extensions["pybankid"]["PYBANKID"]
+        if state.poller is not None:
+            state.poller.stop()
+        self.server.stop()
+
+    def test_client_is_built_by_init_app(self):
+        assert self.bankid.client_stats["builds"] == 1
+
+    def test_forked_child_reuses_client_with_fresh_connections(self):
+        with self.app.app_context():
+            client = self.bankid.client
+            poller = self.bankid.poller
+        order_ref = json.loads(
+            self.app.test_client().get("/authenticate/190001010101").data
+        )["orderRef"]
+        pools = client.client.get_adapter(self.server.api_url).poolmanager.pools
+        assert len(pools) == 1
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                with self.app.app_context():
+                    result = {
+                        "same_client": self.bankid.client is client,
+                        "pools": len(pools),
+                        "new_poller": self.bankid.poller is not poller,
+                        "status": self.app.test_client()
+                        .get("/collect/" + order_ref)
+                        .status_code,
+                    }
+                os.write(write_fd, json.dumps(result).encode("utf-8"))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, "rb") as f:
+            result = json.loads(f.read().decode("utf-8"))
+        os.waitpid(pid, 0)
+
+        assert result == {
+            "same_client": True,
+            "pools": 0,
+            "new_poller": True,
+            "status": 200,
+        }
+        assert len(pools) == 1
+        assert self.app.test_client().get("/collect/" + order_ref).status_code == 200
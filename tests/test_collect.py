@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_collect`
+===================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import json
+import threading
+import time
+import unittest
+
+import flask
+from bankid import exceptions
+
+import flask_pybankid
+from flask_pybankid import PyBankID
+
+from _fakes import FakeRedis, PyBankIDTestCase
+
+ORDER_REF = "131daac9-16c6-4618-beb0-365768f37288"
+
+
+class CollectTestCase(PyBankIDTestCase):
+    config = {}
+
+    def setUp(self):
+        super(CollectTestCase, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_CERT_PATH"] = "cert.pem"
+        self.app.config["PYBANKID_KEY_PATH"] = "key.pem"
+        self.app.config.update(self.config)
+        self.bankid = PyBankID(self.app)
+        with self.app.app_context():
+            self.client = self.bankid.client
+
+    def tearDown(self):
+        state = self.app.extensions["pybankid"]["PYBANKID"]
+        if state.poller is not None:
+            state.poller.stop()
+
+    def upstream_collects(self):
+        return sum(1 for call in self.client.calls if call[0] == "collect")
+
+    def collect(self, url="/collect/" + ORDER_REF):
+        out = self.app.test_client().get(url)
+        return out.status_code, json.loads(out.data.decode("utf-8"))
+
+
+class CollectPollerTest(CollectTestCase):
+    config = {"PYBANKID_COLLECT_POLLER": True, "PYBANKID_COLLECT_INTERVAL": 0.05}
+
+    def test_one_upstream_call_per_interval_regardless_of_watchers(self):
+        results = []
+
+        def watcher():
+            results.append(self.collect())
+
+        threads = [threading.Thread(target=watcher) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(results) == 20
+        assert all(
+            r == (200, {"progressStatus": "OUTSTANDING_TRANSACTION"}) for r in results
+        )
+        assert self.upstream_collects() == 1
+
+    def test_polling_stops_at_terminal_status(self):
+        self.client.collect_responses = [
+            {"progressStatus": "USER_SIGN"},
+            {"progressStatus": "COMPLETE", "signature": "abc"},
+        ]
+        assert self.collect() == (200, {"progressStatus": "USER_SIGN"})
+        time.sleep(0.3)
+        assert self.collect() == (
+            200,
+            {"progressStatus": "COMPLETE", "signature": "abc"},
+        )
+        assert self.upstream_collects() == 2
+
+    def test_polling_goes_on_after_maintenance(self):
+        self.client.collect_responses = [
+            exceptions.MaintenanceError("Maintenance"),
+            {"progressStatus": "USER_SIGN"},
+        ]
+        assert self.collect()[0] != 200
+        time.sleep(0.3)
+        assert self.collect()[0] == 200
+        assert self.upstream_collects() > 2
+
+    def test_failed_order_is_terminal(self):
+        self.client.collect_responses = [exceptions.UserCancelError("USER_CANCEL")]
+        status_code, body = self.collect()
+        assert status_code == 409
+        time.sleep(0.2)
+        assert self.collect()[0] == 409
+        assert self.upstream_collects() == 1
+
+
+class CollectPollerSchedulingTest(unittest.TestCase):
+    def test_slow_order_does_not_hold_up_others(self):
+        calls = []
+        release = threading.Event()
+
+        def collect(order_ref):
+            calls.append(order_ref)
+            if order_ref == "slow":
+                release.wait(5)
+            return {"progressStatus": "OUTSTANDING_TRANSACTION"}
+
+        poller = flask_pybankid._CollectPoller(collect, interval=0.05, workers=4)
+        try:
+            with poller._condition:
+                poller._watch("slow")
+            poller.status("fast")
+            time.sleep(0.5)
+            assert calls.count("slow") == 1
+            assert calls.count("fast") >= 5
+        finally:
+            release.set()
+            poller.stop()
+
+
+class CollectCacheTest(CollectTestCase):
+    config = {"PYBANKID_COLLECT_CACHE": "memory", "PYBANKID_COLLECT_CACHE_TTL": 0.2}
+
+    def test_pending_result_is_cached_for_ttl(self):
+        for _ in range(5):
+            assert self.collect() == (
+                200,
+                {"progressStatus": "OUTSTANDING_TRANSACTION"},
+            )
+        assert self.upstream_collects() == 1
+        time.sleep(0.25)
+        self.collect()
+        assert self.upstream_collects() == 2
+        with self.app.app_context():
+            assert self.bankid.cache_stats == {"_collect": {"hits": 4, "misses": 2}}
+
+    def test_terminal_results_are_pinned(self):
+        self.client.collect_responses = [exceptions.ExpiredTransactionError("x")]
+        assert self.collect()[0] == 408
+        time.sleep(0.25)
+        status_code, body = self.collect()
+        assert status_code == 408
+        assert body["message"].startswith("ExpiredTransactionError:")
+        assert self.upstream_collects() == 1
+
+    def test_transient_errors_are_not_cached(self):
+        self.client.collect_responses = [exceptions.RetryError("RETRY")]
+        assert self.collect()[0] == 500
+        assert self.collect()[0] == 200
+        assert self.upstream_collects() == 2
+
+    def test_maintenance_is_not_terminal(self):
+        self.client.collect_responses = [
+            exceptions.MaintenanceError("Maintenance"),
+            {"progressStatus": "USER_SIGN"},
+        ]
+        assert self.collect()[0] != 200
+        assert self.collect() == (200, {"progressStatus": "USER_SIGN"})
+        assert self.upstream_collects() == 2
+
+
+class MemoryCollectCacheTest(unittest.TestCase):
+    def test_lru_eviction_by_entries(self):
+        cache = flask_pybankid.MemoryCollectCache(max_entries=2)
+        cache.set("a", "1", 10)
+        cache.set("b", "2", 10)
+        cache.get("a")
+        cache.set("c", "3", 10)
+        assert cache.get("b") is None
+        assert cache.get("a") == "1"
+        assert len(cache) == 2
+
+    def test_lru_eviction_by_size(self):
+        cache = flask_pybankid.MemoryCollectCache(max_bytes=10)
+        cache.set("a", "x" * 6, 10)
+        cache.set("b", "y" * 6, 10)
+        assert cache.get("a") is None
+        assert cache.size == 6
+
+
+class RedisCollectCacheTest(CollectTestCase):
+    def setUp(self):
+        self.redis = FakeRedis()
+        self.config = {
+            "PYBANKID_COLLECT_CACHE": flask_pybankid.RedisCollectCache(self.redis)
+        }
+        super(RedisCollectCacheTest, self).setUp()
+
+    def test_results_are_shared_through_redis(self):
+        self.client.collect_responses = [{"progressStatus": "COMPLETE"}]
+        assert self.collect() == (200, {"progressStatus": "COMPLETE"})
+        assert list(self.redis.data) == ["pybankid:collect:PYBANKID:" + ORDER_REF]
+        assert self.collect() == (200, {"progressStatus": "COMPLETE"})
+        assert self.upstream_collects() == 1
+
+
+class CollectStreamTest(CollectTestCase):
+    config = {"PYBANKID_COLLECT_INTERVAL": 0.05}
+
+    def test_long_poll_returns_on_status_change(self):
+        self.client.collect_responses = [
+            {"progressStatus": "OUTSTANDING_TRANSACTION"},
+            {"progressStatus": "OUTSTANDING_TRANSACTION"},
+            {"progressStatus": "USER_SIGN"},
+        ]
+        start = time.time()
+        status_code, body = self.collect("/collect/{0}?wait=5".format(ORDER_REF))
+        assert time.time() - start < 2.0
+        assert (status_code, body) == (200, {"progressStatus": "USER_SIGN"})
+        assert self.upstream_collects() == 3
+
+    def test_long_poll_times_out_with_current_status(self):
+        status_code, body = self.collect("/collect/{0}?wait=0.2".format(ORDER_REF))
+        assert (status_code, body) == (
+            200,
+            {"progressStatus": "OUTSTANDING_TRANSACTION"},
+        )
+
+    def test_long_poll_refuses_invalid_waits(self):
+        for wait in ("nan", "inf", "-1", "0"):
+            status_code, body = self.collect(
+                "/collect/{0}?wait={1}".format(ORDER_REF, wait)
+            )
+            assert status_code == 400
+        assert self.upstream_collects() == 0
+
+    def test_long_poll_returns_newer_status_at_once(self):
+        self.client.collect_responses = [
+            {"progressStatus": "OUTSTANDING_TRANSACTION"}
+        ] + [{"progressStatus": "USER_SIGN"}] * 100
+        assert self.collect("/collect/{0}?wait=0.01".format(ORDER_REF)) == (
+            200,
+            {"progressStatus": "OUTSTANDING_TRANSACTION"},
+        )
+        time.sleep(0.2)
+        start = time.time()
+        status_code, body = self.collect(
+            "/collect/{0}?wait=5&status=OUTSTANDING_TRANSACTION".format(ORDER_REF)
+        )
+        assert time.time() - start < 1.0
+        assert (status_code, body) == (200, {"progressStatus": "USER_SIGN"})
+
+    def test_stream_sends_status_transitions(self):
+        self.client.collect_responses = [
+            {"progressStatus": "OUTSTANDING_TRANSACTION"},
+            {"progressStatus": "OUTSTANDING_TRANSACTION"},
+            {"progressStatus": "USER_SIGN"},
+            {"progressStatus": "COMPLETE"},
+        ]
+        out = self.app.test_client().get("/collect/{0}/stream".format(ORDER_REF))
+        assert out.mimetype == "text/event-stream"
+        events = [e for e in out.data.decode("utf-8").split("\n\n") if e]
+        assert events == [
+            'event: status\ndata: {"progressStatus": "OUTSTANDING_TRANSACTION"}',
+            'event: status\ndata: {"progressStatus": "USER_SIGN"}',
+            'event: status\ndata: {"progressStatus": "COMPLETE"}',
+        ]
+        assert self.upstream_collects() == 4
+
+    def test_stream_sends_mapped_errors(self):
+        self.client.collect_responses = [exceptions.UserCancelError("USER_CANCEL")]
+        out = self.app.test_client().get("/collect/{0}/stream".format(ORDER_REF))
+        event = out.data.decode("utf-8").strip().split("\n")
+        assert event[0] == "event: error"
+        data = json.loads(event[1][len("data: ") :])
+        assert data["status"] == 409
+        assert data["message"].startswith("UserCancelError:")
+
+    def test_subscribers_share_upstream_polling(self):
+        self.client.collect_responses = [{"progressStatus": "OUTSTANDING_TRANSACTION"}]
+        self.client.collect_responses += [{"progressStatus": "USER_SIGN"}] * 3
+        self.client.collect_responses += [{"progressStatus": "COMPLETE"}]
+
+        def subscriber():
+            self.app.test_client().get("/collect/{0}/stream".format(ORDER_REF)).data
+
+        threads = [threading.Thread(target=subscriber) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert self.upstream_collects() == 5
+
+
+class SingleFlightTest(CollectTestCase):
+    def test_concurrent_collects_share_one_upstream_call(self):
+        release = threading.Event()
+        collect = self.client.collect
+
+        def slow_collect(order_ref):
+            release.wait(5)
+            return collect(order_ref)
+
+        self.client.collect = slow_collect
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.collect()))
+            for _ in range(10)
+        ]
+        for t in threads:
+            t.start()
+        time.sleep(0.2)
+        release.set()
+        for t in threads:
+            t.join()
+        assert len(results) == 10
+        assert self.upstream_collects() == 1
+        with self.app.app_context():
+            assert self.bankid.single_flight_stats == {"issued": 1, "coalesced": 9}
+
+    def test_errors_are_raised_and_not_kept(self):
+        flight = flask_pybankid._SingleFlight()
+        self.assertRaises(
+            exceptions.RetryError,
+            flight.do,
+            "key",
+            lambda: (_ for _ in ()).throw(exceptions.RetryError("RETRY")),
+        )
+        assert flight.do("key", lambda: 42) == 42
+
+    def test_calls_beyond_max_keys_are_not_shared(self):
+        flight = flask_pybankid._SingleFlight(max_keys=0)
+        assert flight.do("key", lambda: {"a": 1}) == {"a": 1}
+        assert flight.stats() == {"issued": 1, "coalesced": 0}
+
+
+class BatchCollectTest(CollectTestCase):
+    config = {"PYBANKID_BATCH_WORKERS": 4, "PYBANKID_BATCH_STREAM_THRESHOLD": 10}
+
+    def post(self, data):
+        out = self.app.test_client().post(
+            "/collect", data=json.dumps(data), content_type="application/json"
+        )
+        return out
+
+    def test_results_and_errors_are_mapped_per_order(self):
+        self.app.config["PYBANKID_BATCH_WORKERS"] = 1
+        self.client.collect_responses = [
+            {"progressStatus": "USER_SIGN"},
+            exceptions.ExpiredTransactionError("EXPIRED"),
+        ]
+        out = self.post({"orderRefs": ["a", "b", "a"]})
+        assert out.status_code == 200
+        results = json.loads(out.data.decode("utf-8"))
+        assert results["a"] == {"progressStatus": "USER_SIGN"}
+        assert results["b"]["status"] == 408
+        assert results["b"]["message"].startswith("ExpiredTransactionError")
+        assert self.upstream_collects() == 2
+
+    def test_orders_are_collected_concurrently(self):
+        entered = []
+        both_entered = threading.Event()
+        collect = self.client.collect
+
+        def slow_collect(order_ref):
+            entered.append(order_ref)
+            if len(entered) == 2:
+                both_entered.set()
+            both_entered.wait(5)
+            return collect(order_ref)
+
+        self.client.collect = slow_collect
+        out = self.post(["a", "b"])
+        assert out.status_code == 200
+        assert both_entered.is_set()
+
+    def test_large_batches_are_streamed(self):
+        order_refs = ["order-{0}".format(i) for i in range(25)]
+        out = self.post(order_refs)
+        assert out.status_code == 200
+        assert out.mimetype == "application/x-ndjson"
+        lines = [
+            json.loads(line) for line in out.data.decode("utf-8").splitlines() if line
+        ]
+        assert len(lines) == 25
+        results = {}
+        for line in lines:
+            results.update(line)
+        assert sorted(results) == sorted(order_refs)
+
+    def test_invalid_and_oversized_batches_are_rejected(self):
+        assert self.post({"orderRef": "a"}).status_code == 400
+        assert self.post(["a", 1]).status_code == 400
+        self.app.config["PYBANKID_BATCH_MAX_SIZE"] = 2
+        assert self.post(["a", "b", "c"]).status_code == 413
+        assert self.upstream_collects() == 0
+
+
+class FastJSONTest(CollectTestCase):
+    config = {"PYBANKID_FAST_JSON": True}
+
+    def test_pending_results_are_served_ready_made(self):
+        out = self.app.test_client().get("/collect/" + ORDER_REF)
+        assert out.status_code == 200
+        assert out.mimetype == "application/json"
+        assert out.data == flask_pybankid._pending_bodies["OUTSTANDING_TRANSACTION"]
+        assert json.loads(out.data.decode("utf-8")) == {
+            "progressStatus": "OUTSTANDING_TRANSACTION"
+        }
+
+    def test_other_results_and_errors_are_serialized(self):
+        complete = {
+            "progressStatus": "COMPLETE",
+            "signature": "c2lnbmF0dXJl",
+            "userInfo": {"name": "Karl Karlsson", "personalNumber": "190000000000"},
+        }
+        self.client.collect_responses = [
+            complete,
+            exceptions.UserCancelError("USER_CANCEL"),
+        ]
+        assert self.collect() == (200, complete)
+        status_code, body = self.collect()
+        assert status_code == 409
+        assert body["message"].startswith("UserCancelError")
+
+    def test_standard_library_is_used_without_orjson(self):
+        original, flask_pybankid.orjson = flask_pybankid.orjson, None
+        try:
+            assert flask_pybankid._dumps({"a": [1, "b"]}) == b'{"a":[1,"b"]}'
+        finally:
+            flask_pybankid.orjson = original
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_metrics`
+===================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import flask
+from bankid import exceptions
+
+from flask_pybankid import PyBankID
+
+from _fakes import PyBankIDTestCase
+
+ORDER_REF = "131daac9-16c6-4618-beb0-365768f37288"
+
+
+class MetricsTest(PyBankIDTestCase):
+    def setUp(self):
+        super(MetricsTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_METRICS_ENDPOINT"] = "/metrics"
+        self.bankid = PyBankID(self.app)
+        with self.app.app_context():
+            self.client = self.bankid.client
+
+    def test_calls_and_responses_are_recorded(self):
+        c = self.app.test_client()
+        c.get("/authenticate/190001010101")
+        c.get("/collect/" + ORDER_REF)
+        self.client.collect_responses = [exceptions.UserCancelError("USER_CANCEL")]
+        c.get("/collect/" + ORDER_REF)
+
+        metrics = self.bankid.metrics
+        count, total = metrics.get(
+            "pybankid_call_duration_seconds", prefix="PYBANKID", operation="collect"
+        )
+        assert count == 2
+        assert total >= 0
+        assert (
+            metrics.get(
+                "pybankid_calls_in_flight", prefix="PYBANKID", operation="collect"
+            )
+            == 0
+        )
+        assert (
+            metrics.get("pybankid_responses_total", endpoint="_collect", status=409)
+            == 1
+        )
+        assert (
+            metrics.get("pybankid_responses_total", endpoint="_collect", status=200)
+            == 1
+        )
+        assert metrics.get("pybankid_client_builds_total", prefix="PYBANKID") == 1
+
+    def test_metrics_endpoint(self):
+        c = self.app.test_client()
+        c.get("/authenticate/190001010101")
+        out = c.get("/metrics")
+        assert out.status_code == 200
+        assert out.content_type.startswith("text/plain; version=0.0.4")
+        text = out.data.decode("utf-8")
+        assert (
+            'pybankid_responses_total{endpoint="_authenticate",status="200"} 1' in text
+        )
+        assert (
+            'pybankid_call_duration_seconds_bucket{operation="authenticate",'
+            'prefix="PYBANKID",le="+Inf"} 1' in text
+        )
+        assert (
+            'pybankid_call_duration_seconds_count{operation="authenticate",'
+            'prefix="PYBANKID"} 1' in text
+        )
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_order_store`
+=======================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import flask
+
+import flask_pybankid
+from flask_pybankid import PyBankID
+
+from _fakes import FakeRedis, PyBankIDTestCase
+
+
+class OrderStoreTestMixin(object):
+    def create_store(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.store = self.create_store()
+
+    def test_add_and_update(self):
+        self.store.add("ref", "sign")
+        record = self.store.get("ref")
+        assert record["orderRef"] == "ref"
+        assert record["operation"] == "sign"
+        assert record["result"] is None
+        assert not record["terminal"]
+
+        self.store.update("ref", '{"response": {}}', "COMPLETE", True)
+        record = self.store.get("ref")
+        assert record["result"] == '{"response": {}}'
+        assert record["status"] == "COMPLETE"
+        assert record["terminal"]
+        assert self.store.get("unknown") is None
+
+    def test_acquire_poll_once_per_interval(self):
+        self.store.add("ref", "authenticate")
+        assert self.store.acquire_poll("ref", 0.2)
+        assert not self.store.acquire_poll("ref", 0.2)
+        time.sleep(0.25)
+        assert self.store.acquire_poll("ref", 0.2)
+
+    def test_acquire_poll_of_unknown_order(self):
+        assert self.store.acquire_poll("other", 10)
+        assert not self.store.acquire_poll("other", 10)
+
+    def test_last_seen(self):
+        self.store.add("ref", "authenticate")
+        assert self.store.last_seen("ref") is None
+        before = time.time()
+        self.store.seen("ref")
+        assert before <= self.store.last_seen("ref") <= time.time()
+
+
+class MemoryOrderStoreTest(OrderStoreTestMixin, unittest.TestCase):
+    def create_store(self):
+        return flask_pybankid.MemoryOrderStore()
+
+
+class SQLiteOrderStoreTest(OrderStoreTestMixin, unittest.TestCase):
+    def create_store(self):
+        fd, self.path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        return flask_pybankid.SQLiteOrderStore(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+
+class RedisOrderStoreTest(OrderStoreTestMixin, unittest.TestCase):
+    def create_store(self):
+        return flask_pybankid.RedisOrderStore(FakeRedis())
+
+
+class SharedOrderStoreTest(PyBankIDTestCase):
+    """Two apps, as on two nodes, sharing one Redis order store."""
+
+    def setUp(self):
+        super(SharedOrderStoreTest, self).setUp()
+        store = flask_pybankid.RedisOrderStore(FakeRedis())
+
+        self.nodes = []
+        for _ in range(2):
+            app = flask.Flask("test")
+            app.config["PYBANKID_ORDER_STORE"] = store
+            app.config["PYBANKID_COLLECT_INTERVAL"] = 0.2
+            PyBankID(app)
+            self.nodes.append(app.test_client())
+        with app.app_context():
+            self.client = app.extensions["pybankid"]["PYBANKID"].extension.client
+
+    def upstream_collects(self):
+        return sum(1 for call in self.client.calls if call[0] == "collect")
+
+    def test_one_upstream_poll_per_interval_across_nodes(self):
+        out = self.nodes[0].get("/authenticate/190001010101")
+        order_ref = json.loads(out.data.decode("utf-8"))["orderRef"]
+        for node in self.nodes * 3:
+            out = node.get("/collect/" + order_ref)
+            assert json.loads(out.data.decode("utf-8")) == {
+                "progressStatus": "OUTSTANDING_TRANSACTION"
+            }
+        assert self.upstream_collects() == 1
+        time.sleep(0.25)
+        self.nodes[1].get("/collect/" + order_ref)
+        assert self.upstream_collects() == 2
+
+    def test_completed_orders_are_served_from_store(self):
+        self.client.collect_responses = [{"progressStatus": "COMPLETE"}]
+        out = self.nodes[0].get("/sign/190001010101?userVisibleData=x")
+        order_ref = json.loads(out.data.decode("utf-8"))["orderRef"]
+        self.nodes[0].get("/collect/" + order_ref)
+        time.sleep(0.25)
+        out = self.nodes[1].get("/collect/" + order_ref)
+        assert json.loads(out.data.decode("utf-8")) == {"progressStatus": "COMPLETE"}
+        assert self.upstream_collects() == 1
+
+
+class AuthDedupeTest(PyBankIDTestCase):
+    def setUp(self):
+        super(AuthDedupeTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.secret_key = "secret"
+        self.app.config["PYBANKID_AUTH_DEDUPE"] = True
+        PyBankID(self.app)
+        with self.app.app_context():
+            self.client = self.app.extensions["pybankid"]["PYBANKID"].extension.client
+
+    def authenticate(
+        self, personal_number="190001010101", ip="10.0.0.1", app=None, token="t0k3n"
+    ):
+        client = (app or self.app).test_client(use_cookies=False)
+        headers = {"Cookie": "pybankid_client=" + token} if token else {}
+        out = client.get(
+            "/authenticate/" + personal_number,
+            environ_base={"REMOTE_ADDR": ip},
+            headers=headers,
+        )
+        assert out.status_code == 200
+        return json.loads(out.data.decode("utf-8"))
+
+    def upstream_authentications(self):
+        return sum(1 for call in self.client.calls if call[0] == "authenticate")
+
+    def test_pending_order_is_returned_again(self):
+        first = self.authenticate()
+        assert self.authenticate() == first
+        assert self.upstream_authentications() == 1
+
+    def test_concurrent_duplicates_share_one_order(self):
+        authenticate = self.client.authenticate
+
+        def slow_authenticate(*args, **kwargs):
+            time.sleep(0.1)
+            return authenticate(*args, **kwargs)
+
+        self.client.authenticate = slow_authenticate
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.authenticate()))
+            for _ in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(set(r["orderRef"] for r in results)) == 1
+        assert self.upstream_authentications() == 1
+
+    def test_other_personal_numbers_and_end_users_get_new_orders(self):
+        first = self.authenticate()
+        assert self.authenticate("190001010102") != first
+        assert self.authenticate(ip="10.0.0.2") != first
+        assert self.upstream_authentications() == 3
+
+    def test_pending_orders_are_only_returned_to_their_client(self):
+        first = self.authenticate()
+        assert self.authenticate(token="other") != first
+        assert self.authenticate(token=None) != first
+        assert self.upstream_authentications() == 3
+
+    def test_new_clients_are_given_a_token(self):
+        client = self.app.test_client()
+        out = client.get("/authenticate/190001010101")
+        cookie = out.headers["Set-Cookie"]
+        assert cookie.startswith("pybankid_client=")
+        assert "HttpOnly" in cookie
+        first = json.loads(out.data.decode("utf-8"))
+        out = client.get("/authenticate/190001010101")
+        assert json.loads(out.data.decode("utf-8")) == first
+        assert "Set-Cookie" not in out.headers
+        assert self.upstream_authentications() == 1
+
+    def test_finished_orders_are_forgotten(self):
+        first = self.authenticate()
+        self.client.collect_responses = [{"progressStatus": "COMPLETE"}]
+        self.app.test_client().get("/collect/" + first["orderRef"])
+        assert self.authenticate() != first
+        assert self.upstream_authentications() == 2
+
+    def test_orders_are_forgotten_after_ttl(self):
+        self.app.config["PYBANKID_AUTH_DEDUPE_TTL"] = 0.1
+        first = self.authenticate()
+        time.sleep(0.15)
+        assert self.authenticate() != first
+
+    def test_shared_between_nodes_without_personal_numbers(self):
+        redis = FakeRedis()
+        self.app.config["PYBANKID_AUTH_DEDUPE"] = flask_pybankid.RedisCollectCache(
+            redis
+        )
+        other = flask.Flask("test")
+        other.secret_key = "secret"
+        other.config["PYBANKID_AUTH_DEDUPE"] = self.app.config["PYBANKID_AUTH_DEDUPE"]
+        PyBankID(other)
+        first = self.authenticate()
+        assert self.authenticate(app=other) == first
+        assert self.upstream_authentications() == 1
+        assert not any("190001010101" in key for key in redis.data)
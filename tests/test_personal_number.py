@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_personal_number`
+===========================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import datetime
+import json
+import unittest
+
+import flask
+
+import flask_pybankid
+from flask_pybankid import PyBankID, normalize_personal_number
+
+from _fakes import PyBankIDTestCase
+
+TODAY = datetime.date(2020, 6, 1)
+
+
+class NormalizePersonalNumberTest(unittest.TestCase):
+    def test_twelve_digits(self):
+        assert normalize_personal_number("198112189876", TODAY) == "198112189876"
+        assert normalize_personal_number("19811218-9876", TODAY) == "198112189876"
+
+    def test_ten_digits(self):
+        assert normalize_personal_number("8112189876", TODAY) == "198112189876"
+        assert normalize_personal_number("811218-9876", TODAY) == "198112189876"
+
+    def test_century_of_ten_digits(self):
+        assert normalize_personal_number("121212-1212", TODAY) == "201212121212"
+        assert normalize_personal_number("121212+1212", TODAY) == "191212121212"
+        assert normalize_personal_number("200601-2385", TODAY) == "202006012385"
+        assert normalize_personal_number("200602-2384", TODAY) == "192006022384"
+
+    def test_coordination_number(self):
+        assert normalize_personal_number("701063-2391", TODAY) == "197010632391"
+
+    def test_invalid_format(self):
+        for personal_number in (
+            "",
+            "abc",
+            "81121898765",
+            "811218 9876",
+            "811218--9876",
+        ):
+            with self.assertRaises(ValueError):
+                normalize_personal_number(personal_number, TODAY)
+
+    def test_non_ascii_digits(self):
+        with self.assertRaises(ValueError):
+            normalize_personal_number(
+                "\u0661\u0669\u0668\u0661\u0661\u0662\u0661\u0668\u0669\u0668\u0667\u0666",
+                TODAY,
+            )
+
+    def test_invalid_control_digit(self):
+        with self.assertRaises(ValueError):
+            normalize_personal_number("198112189875", TODAY)
+
+    def test_invalid_date(self):
+        for personal_number in ("198113189875", "190002300101", "202012189870"):
+            with self.assertRaises(ValueError):
+                normalize_personal_number(personal_number, TODAY)
+
+
+class PersonalNumberValidationTest(PyBankIDTestCase):
+    def setUp(self):
+        super(PersonalNumberValidationTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config["PYBANKID_VALIDATE_PERSONAL_NUMBER"] = True
+        self.bankid = PyBankID(self.app)
+        with self.app.app_context():
+            self.client = self.bankid.client
+
+    def test_normalized_number_is_sent(self):
+        response = self.app.test_client().get("/authenticate/811218-9876")
+        assert response.status_code == 200
+        response = self.app.test_client().get("/sign/8112189876?userVisibleData=Hi")
+        assert response.status_code == 200
+        assert self.client.calls == [
+            ("authenticate", "198112189876"),
+            ("sign", "198112189876", "Hi"),
+        ]
+
+    def test_invalid_number_is_rejected_without_calling_bankid(self):
+        response = self.app.test_client().get("/authenticate/198112189875")
+        assert response.status_code == 400
+        assert "control digit" in json.loads(response.data.decode("utf-8"))["message"]
+        response = self.app.test_client().get("/sign/19811318-9876")
+        assert response.status_code == 400
+        assert self.client.calls == []
+        assert (
+            flask_pybankid._metrics.get(
+                "pybankid_personal_number_rejections_total", prefix="PYBANKID"
+            )
+            == 2
+        )
+
+    def test_not_validated_unless_enabled(self):
+        self.app.config["PYBANKID_VALIDATE_PERSONAL_NUMBER"] = False
+        response = self.app.test_client().get("/authenticate/190001010101")
+        assert response.status_code == 200
+        assert self.client.calls == [("authenticate", "190001010101")]
+
+
+if __name__ == "__main__":
+    unittest.main()
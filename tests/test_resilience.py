@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_resilience`
+======================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import json
+import threading
+import time
+
+import flask
+from bankid import exceptions
+
+import flask_pybankid
+from flask_pybankid import PyBankID
+
+from _fakes import FakeJSONAdapter, PyBankIDTestCase
+
+ORDER_REF = "131daac9-16c6-4618-beb0-365768f37288"
+
+
+class ResilienceTestCase(PyBankIDTestCase):
+    config = {}
+
+    def setUp(self):
+        super(ResilienceTestCase, self).setUp()
+        self.app = flask.Flask("test")
+        self.app.config.update(self.config)
+        self.bankid = PyBankID(self.app)
+        with self.app.app_context():
+            self.client = self.bankid.client
+
+    def get(self, url):
+        out = self.app.test_client().get(url)
+        return out.status_code, json.loads(out.data.decode("utf-8")), out.headers
+
+
+class CircuitBreakerTest(ResilienceTestCase):
+    config = {
+        "PYBANKID_CIRCUIT_BREAKER": True,
+        "PYBANKID_BREAKER_FAILURE_THRESHOLD": 3,
+        "PYBANKID_BREAKER_RESET_TIMEOUT": 0.2,
+        "PYBANKID_SINGLE_FLIGHT": False,
+    }
+
+    def test_breaker_opens_fails_fast_and_recovers(self):
+        self.client.collect_responses = [exceptions.InternalError("x")] * 3
+        for _ in range(3):
+            assert self.get("/collect/" + ORDER_REF)[0] == 500
+        status_code, body, headers = self.get("/collect/" + ORDER_REF)
+        assert status_code == 503
+        assert headers["Retry-After"] == "1"
+        assert len(self.client.calls) == 3
+        with self.app.app_context():
+            assert self.bankid.circuit_breaker.state == "open"
+
+        time.sleep(0.25)
+        assert self.get("/collect/" + ORDER_REF)[0] == 200
+        with self.app.app_context():
+            assert self.bankid.circuit_breaker.state == "closed"
+        metrics = self.bankid.metrics
+        assert metrics.get("pybankid_circuit_state", prefix="PYBANKID") == 0
+        assert (
+            metrics.get(
+                "pybankid_circuit_transitions_total", prefix="PYBANKID", state="open"
+            )
+            == 1
+        )
+
+    def test_failed_probe_opens_breaker_again(self):
+        self.client.collect_responses = [exceptions.InternalError("x")] * 4
+        for _ in range(3):
+            self.get("/collect/" + ORDER_REF)
+        time.sleep(0.25)
+        assert self.get("/collect/" + ORDER_REF)[0] == 500
+        assert self.get("/collect/" + ORDER_REF)[0] == 503
+
+    def test_refused_orders_do_not_open_breaker(self):
+        self.client.collect_responses = [exceptions.UserCancelError("x")] * 5
+        for _ in range(5):
+            assert self.get("/collect/" + ORDER_REF)[0] == 409
+        with self.app.app_context():
+            assert self.bankid.circuit_breaker.state == "closed"
+
+    def test_slow_calls_count_as_failures(self):
+        breaker = flask_pybankid.CircuitBreaker(
+            "X", failure_threshold=2, slow_call_duration=0.5
+        )
+        breaker.record(1.0)
+        breaker.record(1.0)
+        assert breaker.state == "open"
+
+
+class AdmissionControlTest(ResilienceTestCase):
+    config = {
+        "PYBANKID_MAX_CONCURRENCY": 1,
+        "PYBANKID_MAX_QUEUE": 1,
+        "PYBANKID_QUEUE_TIMEOUT": 5.0,
+    }
+
+    def block_authenticate(self):
+        entered, release = threading.Semaphore(0), threading.Event()
+        authenticate = self.client.authenticate
+
+        def slow_authenticate(*args, **kwargs):
+            entered.release()
+            release.wait(5)
+            return authenticate(*args, **kwargs)
+
+        self.client.authenticate = slow_authenticate
+        return entered, release
+
+    def test_rate_limit_sheds_with_retry_after(self):
+        self.app.config["PYBANKID_MAX_CONCURRENCY"] = None
+        self.app.config["PYBANKID_RATE_LIMIT"] = 0.5
+        self.app.config["PYBANKID_RATE_BURST"] = 2
+        results = [self.get("/authenticate/196001010000") for _ in range(3)]
+        assert [r[0] for r in results] == [200, 200, 429]
+        assert results[2][2]["Retry-After"] == "2"
+        assert len(self.client.calls) == 2
+        assert self.get("/collect/" + ORDER_REF)[0] == 200
+        assert (
+            flask_pybankid._metrics.get(
+                "pybankid_admission_rejections_total", prefix="PYBANKID", reason="rate"
+            )
+            == 1
+        )
+
+    def test_calls_queue_for_a_slot_and_overflow_is_shed(self):
+        entered, release = self.block_authenticate()
+        results = []
+
+        def authenticate():
+            results.append(self.get("/authenticate/196001010000")[0])
+
+        threads = [threading.Thread(target=authenticate) for _ in range(2)]
+        for t in threads:
+            t.start()
+        assert entered.acquire(timeout=5)
+        deadline = time.time() + 5
+        with self.app.app_context():
+            while self.bankid.admission_control.waiting < 1:
+                assert time.time() < deadline
+                time.sleep(0.01)
+        assert (
+            flask_pybankid._metrics.get(
+                "pybankid_admission_queue_depth", prefix="PYBANKID"
+            )
+            == 1
+        )
+
+        status_code, _, headers = self.get("/sign/196001010000")
+        assert status_code == 429
+        assert headers["Retry-After"] == "1"
+
+        release.set()
+        for t in threads:
+            t.join()
+        assert results == [200, 200]
+        with self.app.app_context():
+            assert self.bankid.admission_control.active == 0
+            assert self.bankid.admission_control.waiting == 0
+
+    def test_queued_calls_time_out(self):
+        self.app.config["PYBANKID_QUEUE_TIMEOUT"] = 0.1
+        entered, release = self.block_authenticate()
+        thread = threading.Thread(target=self.get, args=("/authenticate/196001010000",))
+        thread.start()
+        assert entered.acquire(timeout=5)
+        assert self.get("/authenticate/196001010000")[0] == 429
+        release.set()
+        thread.join()
+
+    def test_apps_with_the_same_prefix_have_their_own_limits(self):
+        self.app.config["PYBANKID_MAX_CONCURRENCY"] = None
+        self.app.config["PYBANKID_RATE_LIMIT"] = 0.5
+        self.app.config["PYBANKID_RATE_BURST"] = 1
+        other = flask.Flask("other")
+        other.config["PYBANKID_RATE_LIMIT"] = 100.0
+        other.config["PYBANKID_RATE_BURST"] = 10
+        PyBankID(other)
+        assert self.get("/authenticate/196001010000")[0] == 200
+        assert self.get("/authenticate/196001010000")[0] == 429
+        for _ in range(3):
+            response = other.test_client().get("/authenticate/196001010000")
+            assert response.status_code == 200
+        with self.app.app_context():
+            assert self.bankid.admission_control.rate == 0.5
+
+
+class CollectRetryTest(ResilienceTestCase):
+    config = {
+        "PYBANKID_COLLECT_RETRIES": 2,
+        "PYBANKID_RETRY_BACKOFF": 0.001,
+        "PYBANKID_SINGLE_FLIGHT": False,
+    }
+
+    def test_transient_failures_are_retried(self):
+        self.client.collect_responses = [
+            exceptions.InternalError("x"),
+            exceptions.RetryError("x"),
+        ]
+        assert self.get("/collect/" + ORDER_REF)[0] == 200
+        assert len(self.client.calls) == 3
+        with self.app.app_context():
+            assert self.bankid.retry_stats["retries"] == 2
+
+    def test_refused_orders_are_not_retried(self):
+        self.client.collect_responses = [exceptions.UserCancelError("x")]
+        assert self.get("/collect/" + ORDER_REF)[0] == 409
+        assert len(self.client.calls) == 1
+
+    def test_retries_stop_when_budget_is_spent(self):
+        self.app.config["PYBANKID_RETRY_BUDGET_MIN"] = 1
+        self.app.config["PYBANKID_RETRY_BUDGET_RATIO"] = 0
+        self.client.collect_responses = [exceptions.InternalError("x")] * 3
+        assert self.get("/collect/" + ORDER_REF)[0] == 500
+        assert len(self.client.calls) == 2
+        with self.app.app_context():
+            assert self.bankid.retry_stats["retries"] == 1
+            assert self.bankid.retry_stats["budget_exhausted"] == 1
+
+    def test_authenticate_is_never_retried(self):
+        def authenticate(*args, **kwargs):
+            self.client.calls.append(("authenticate",))
+            raise exceptions.InternalError("x")
+
+        self.client.authenticate = authenticate
+        assert self.get("/authenticate/190001010101")[0] == 500
+        assert len(self.client.calls) == 1
+
+
+class HedgedCollectTest(ResilienceTestCase):
+    config = {
+        "PYBANKID_HEDGE_COLLECT": True,
+        "PYBANKID_HEDGE_MIN_DELAY": 0.02,
+        "PYBANKID_SINGLE_FLIGHT": False,
+    }
+
+    def test_slow_collect_is_hedged(self):
+        for _ in range(20):
+            assert self.get("/collect/" + ORDER_REF)[0] == 200
+        collect = self.client.collect
+        calls = []
+
+        def slow_first_collect(order_ref):
+            calls.append(order_ref)
+            if len(calls) == 1:
+                time.sleep(0.5)
+            return collect(order_ref)
+
+        self.client.collect = slow_first_collect
+        start = time.time()
+        assert self.get("/collect/" + ORDER_REF)[0] == 200
+        assert time.time() - start < 0.4
+        assert len(calls) == 2
+        with self.app.app_context():
+            stats = self.bankid.retry_stats
+        assert stats["hedges"] == 1
+        assert stats["hedge_wins"] == 1
+
+    def test_collects_are_not_limited_by_hedge_workers(self):
+        self.app.config["PYBANKID_HEDGE_MIN_DELAY"] = 5.0
+        self.app.config["PYBANKID_HEDGE_WORKERS"] = 2
+        collect = self.client.collect
+
+        def slow_collect(order_ref):
+            time.sleep(0.3)
+            return collect(order_ref)
+
+        self.client.collect = slow_collect
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(self.get("/collect/" + ORDER_REF)[0])
+            )
+            for _ in range(16)
+        ]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [200] * 16
+        assert time.time() - start < 0.9
+
+    def test_fast_collects_are_not_hedged(self):
+        for _ in range(25):
+            assert self.get("/collect/" + ORDER_REF)[0] == 200
+        assert len(self.client.calls) == 25
+        with self.app.app_context():
+            assert self.bankid.retry_stats["hedges"] == 0
+
+
+class AdaptiveTimeoutTest(PyBankIDTestCase):
+    def test_timeout_follows_latency_percentile(self):
+        tracker = flask_pybankid._LatencyTracker(
+            percentile=95, multiplier=2.0, minimum=0.1, maximum=30.0
+        )
+        assert tracker.timeout() == 30.0
+        for i in range(100):
+            tracker.add(0.1 if i % 10 else 1.0)
+        assert tracker.timeout() == 2.0
+        for i in range(200):
+            tracker.add(0.01)
+        assert tracker.timeout() == 0.1
+
+    def test_json_client_uses_call_timeout(self):
+        app = flask.Flask("test")
+        app.config["PYBANKID_BACKEND"] = "json"
+        app.config["PYBANKID_ADAPTIVE_TIMEOUT"] = True
+        app.config["PYBANKID_REQUEST_TIMEOUT"] = 7.0
+        bankid = PyBankID(app)
+        timeouts = []
+        adapter = FakeJSONAdapter()
+        send = adapter.send
+
+        def recording_send(request, **kwargs):
+            timeouts.append(kwargs.get("timeout"))
+            return send(request, **kwargs)
+
+        adapter.send = recording_send
+        with app.app_context():
+            bankid.client.client.mount("https://", adapter)
+        app.test_client().get("/authenticate/190001010101")
+        assert timeouts == [7.0]
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+:mod:`test_tracing`
+===================
+
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+
+import json
+import unittest
+
+import flask
+from bankid import exceptions
+
+from flask_pybankid import PyBankID
+
+from _fakes import FakeJSONAdapter, PyBankIDTestCase
+
+try:
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import (
+        InMemorySpanExporter,
+    )
+except ImportError:
+    TracerProvider = None
+
+ORDER_REF = "131daac9-16c6-4618-beb0-365768f37288"
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+TRACEPARENT = "00-{0}-00f067aa0ba902b7-01".format(TRACE_ID)
+
+
+def _tracer():
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    return provider.get_tracer("test"), exporter
+
+
+@unittest.skipIf(TracerProvider is None, "requires opentelemetry-sdk")
+class TracingTest(PyBankIDTestCase):
+    def setUp(self):
+        super(TracingTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.tracer, self.exporter = _tracer()
+        self.app.config["PYBANKID_TRACING"] = True
+        self.app.config["PYBANKID_TRACER"] = self.tracer
+        self.bankid = PyBankID(self.app)
+        with self.app.app_context():
+            self.client = self.bankid.client
+
+    def _spans(self):
+        return dict((span.name, span) for span in self.exporter.get_finished_spans())
+
+    def test_phases_of_authenticate(self):
+        response = self.app.test_client().get(
+            "/authenticate/190001010101", headers={"traceparent": TRACEPARENT}
+        )
+        order_ref = json.loads(response.data.decode("utf-8"))["orderRef"]
+        spans = self._spans()
+        assert sorted(spans) == [
+            "pybankid.authenticate",
+            "pybankid.client",
+            "pybankid.respond",
+            "pybankid.upstream",
+        ]
+        root = spans["pybankid.authenticate"]
+        assert "{0:032x}".format(root.context.trace_id) == TRACE_ID
+        assert "{0:016x}".format(root.parent.span_id) == "00f067aa0ba902b7"
+        assert root.attributes["bankid.order_ref"] == order_ref
+        for name in ("pybankid.client", "pybankid.upstream", "pybankid.respond"):
+            assert spans[name].parent.span_id == root.context.span_id
+        assert spans["pybankid.upstream"].attributes["bankid.operation"] == (
+            "authenticate"
+        )
+
+    def test_collect_attributes(self):
+        self.client.collect_responses = [{"progressStatus": "USER_SIGN"}]
+        self.app.test_client().get("/collect/" + ORDER_REF)
+        root = self._spans()["pybankid.collect"]
+        assert root.attributes["bankid.order_ref"] == ORDER_REF
+        assert root.attributes["bankid.progress_status"] == "USER_SIGN"
+        assert root.parent is None
+
+    def test_errors_are_recorded_with_their_class(self):
+        self.client.collect_responses = [exceptions.InvalidParametersError("bad")]
+        response = self.app.test_client().get("/collect/" + ORDER_REF)
+        assert response.status_code == 400
+        root = self._spans()["pybankid.collect"]
+        assert root.attributes["bankid.error_class"] == "InvalidParametersError"
+        assert root.attributes["http.status_code"] == 400
+        assert root.events[0].name == "exception"
+
+    def test_server_errors_set_the_span_status(self):
+        self.client.collect_responses = [exceptions.InternalError("down")]
+        self.app.test_client().get("/collect/" + ORDER_REF)
+        root = self._spans()["pybankid.collect"]
+        assert root.status.status_code.name == "ERROR"
+        assert root.attributes["http.status_code"] == 500
+
+    def test_no_spans_unless_enabled(self):
+        self.app.config["PYBANKID_TRACING"] = False
+        response = self.app.test_client().get("/collect/" + ORDER_REF)
+        assert response.status_code == 200
+        assert self.exporter.get_finished_spans() == ()
+
+
+@unittest.skipIf(TracerProvider is None, "requires opentelemetry-sdk")
+class JSONBackendTracingTest(PyBankIDTestCase):
+    def setUp(self):
+        super(JSONBackendTracingTest, self).setUp()
+        self.app = flask.Flask("test")
+        self.tracer, self.exporter = _tracer()
+        self.app.config["PYBANKID_BACKEND"] = "json"
+        self.app.config["PYBANKID_TRACING"] = True
+        self.app.config["PYBANKID_TRACER"] = self.tracer
+        self.bankid = PyBankID(self.app)
+        self.adapter = FakeJSONAdapter()
+        with self.app.app_context():
+            self.bankid.client.client.mount("https://", self.adapter)
+
+    def test_trace_context_is_passed_on_to_bankid(self):
+        self.app.test_client().get(
+            "/authenticate/190001010101", headers={"traceparent": TRACEPARENT}
+        )
+        upstream = [
+            span
+            for span in self.exporter.get_finished_spans()
+            if span.name == "pybankid.upstream"
+        ][0]
+        traceparent = self.adapter.headers[0]["traceparent"]
+        assert traceparent == "00-{0}-{1:016x}-01".format(
+            TRACE_ID, upstream.context.span_id
+        )
+        assert upstream.attributes["bankid.http_seconds"] >= 0
+        assert upstream.attributes["bankid.parse_seconds"] >= 0
+
+    def test_no_trace_context_unless_tracing(self):
+        self.app.config["PYBANKID_TRACING"] = False
+        self.app.test_client().get(
+            "/authenticate/190001010101", headers={"traceparent": TRACEPARENT}
+        )
+        assert "traceparent" not in self.adapter.headers[0]
+
+
+if __name__ == "__main__":
+    unittest.main()